@@ -0,0 +1,84 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os
+import json
+import socket
+
+'''
+Client side of the resident agent, kept light as it is loaded by each fetch.
+
+The agent (see agent_server) keeps plugins, backend clients and resolved
+secrets in memory. It listens on a Unix socket only reachable by the
+current user and answers one JSON line request per connection with one
+JSON line response.
+'''
+
+AGENT_SOCKET_ENV = 'ANSIBLE_VAULT_MANAGER_AGENT_SOCKET'
+AGENT_SOCKET_NAME = 'agent.sock'
+DEFAULT_IDLE_TIMEOUT = 900
+CLIENT_TIMEOUT = 30
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+
+class AgentUnavailable(Exception):
+    pass
+
+
+class AgentError(Exception):
+    pass
+
+
+def get_agent_socket_path():
+    if os.environ.get(AGENT_SOCKET_ENV):
+        return os.environ[AGENT_SOCKET_ENV]
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'ansible-vault-manager', AGENT_SOCKET_NAME)
+
+    from tempfile import gettempdir
+    return os.path.join(gettempdir(), 'ansible-vault-manager-' + str(os.getuid()), AGENT_SOCKET_NAME)
+
+
+def request_agent(request, socket_path=None, timeout=CLIENT_TIMEOUT):
+    '''
+    Send a request to the running agent and return its response.
+
+    Raise AgentUnavailable when no agent listens on the socket.
+    '''
+    if socket_path is None:
+        socket_path = get_agent_socket_path()
+    if not os.path.exists(socket_path):
+        raise AgentUnavailable('No agent socket at ' + socket_path)
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        try:
+            client.connect(socket_path)
+        except socket.error as e:
+            raise AgentUnavailable(str(e))
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        stream = client.makefile('rb')
+        try:
+            line = stream.readline(MAX_MESSAGE_SIZE)
+        finally:
+            stream.close()
+    finally:
+        client.close()
+
+    if not line:
+        raise AgentUnavailable('Agent closed connection without answer')
+
+    response = json.loads(line.decode('utf-8'))
+    if 'error' in response:
+        raise AgentError(response['error'])
+
+    return response
+
+
+def agent_fetch(plugin_name, vault_id, socket_path=None):
+    response = request_agent(
+        {'action': 'fetch', 'plugin': plugin_name, 'id': vault_id},
+        socket_path
+    )
+    return response['password']
@@ -0,0 +1,146 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os
+import sys
+import json
+import socket
+import struct
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from .cache import ensure_private_dir
+from .agent import (
+    AGENT_SOCKET_ENV,
+    DEFAULT_IDLE_TIMEOUT,
+    MAX_MESSAGE_SIZE,
+    AgentUnavailable,
+    AgentError,
+    get_agent_socket_path,
+    request_agent,
+)
+
+'''
+Resident agent server, see the agent module for the protocol.
+'''
+
+
+class AgentRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if not self.server.is_peer_allowed(self.connection):
+            return
+
+        try:
+            line = self.rfile.readline(MAX_MESSAGE_SIZE)
+            response = self.server.dispatch(json.loads(line.decode('utf-8')))
+        except Exception as e:
+            response = {'error': str(e)}
+
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+        self.wfile.flush()
+        # Shut down once the stop answer is sent, the process may exit
+        # right after
+        if self.server.stopping:
+            threading.Thread(target=self.server.shutdown).start()
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, manager, idle_timeout=DEFAULT_IDLE_TIMEOUT, ttl=None):
+        from .cache import get_cache_ttl
+        self.manager = manager
+        self.idle_timeout = idle_timeout
+        self.last_activity = time.time()
+        # Secrets are kept as long as in the shared cache, rotated or
+        # revoked passwords must not be served for the agent lifetime
+        self.ttl = get_cache_ttl() if ttl is None else ttl
+        # (plugin_name, vault_id) -> (password, fetch time)
+        self.secrets = {}
+        self.secrets_lock = threading.Lock()
+        self.stopping = False
+
+        # Socket is created with owner only permissions
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, AgentRequestHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(socket_path, 0o600)
+
+    def is_peer_allowed(self, connection):
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', credentials)
+        return uid == os.getuid()
+
+    def dispatch(self, request):
+        self.last_activity = time.time()
+        action = request.get('action')
+        if action == 'ping':
+            return {'pid': os.getpid()}
+        elif action == 'fetch':
+            return {'password': self.fetch(request['plugin'], request['id'])}
+        elif action == 'stop':
+            self.stopping = True
+            return {'pid': os.getpid()}
+
+        raise AgentError('Unknown action ' + str(action))
+
+    def fetch(self, plugin_name, vault_id):
+        key = (plugin_name, vault_id)
+        with self.secrets_lock:
+            if key in self.secrets:
+                password, fetched = self.secrets[key]
+                if time.time() - fetched < self.ttl:
+                    return password
+                del self.secrets[key]
+
+        password = self.manager.fetch_password(plugin_name, vault_id)
+        if self.ttl > 0:
+            with self.secrets_lock:
+                self.secrets[key] = (password, time.time())
+
+        return password
+
+    def watch_idle(self):
+        while True:
+            time.sleep(min(1, self.idle_timeout))
+            if time.time() - self.last_activity > self.idle_timeout:
+                self.shutdown()
+                return
+
+
+def serve(manager, socket_path=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, ttl=None):
+    if socket_path is None:
+        socket_path = get_agent_socket_path()
+    # The socket directory must be private: created here, or already 0700
+    ensure_private_dir(os.path.dirname(os.path.abspath(socket_path)))
+
+    if os.path.exists(socket_path):
+        try:
+            response = request_agent({'action': 'ping'}, socket_path)
+            raise AgentError('An agent is already running with pid ' + str(response['pid']))
+        except AgentUnavailable:
+            os.unlink(socket_path)
+
+    server = AgentServer(socket_path, manager, idle_timeout, ttl)
+    print('Agent listening on ' + socket_path, file=sys.stderr)
+    print('export ' + AGENT_SOCKET_ENV + '=' + socket_path)
+    sys.stdout.flush()
+    if idle_timeout:
+        watchdog = threading.Thread(target=server.watch_idle)
+        watchdog.daemon = True
+        watchdog.start()
+    try:
+        server.serve_forever(poll_interval=0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
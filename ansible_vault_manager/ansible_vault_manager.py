@@ -3,25 +3,46 @@
 from __future__ import print_function, absolute_import, unicode_literals
 import os.path
 import sys
-import getpass
-import argparse
-import inspect
-import fnmatch
-from tempfile import gettempdir
-from hashlib import md5
-from importlib import import_module
-from builtins import input, str
-import glob
-
-import yaml
+import time
+from collections import OrderedDict
+
+# Ansible runs the client once per vault id, so startup time matters: heavy
+# modules are imported by the functions needing them, not here.
+from .metadata import (
+    METADATA_FILE,
+    METADATA_PLUGIN_KEY,
+    METADATA_ID_KEY,
+    METADATA_VAULT_FILES,
+    MetadataException,
+    FileIndex,
+    MetadataTransaction,
+    load_metadata,
+)
+from .keyring_plugins import (
+    KeyringException,
+    KeyringNotFoundException,
+    KeyringAccessDeniedException,
+    KeyringTimeoutException,
+    KeyringThrottlingException,
+    has_async_contract,
+)
+from .metrics import metrics
+from .registry import registry
 
 PLUGIN_SEPARATOR = '%'
 CLIENT_SEPARATOR = '@'
 
-METADATA_FILE = '_metadata.yml'
-METADATA_PLUGIN_KEY = 'plugin'
-METADATA_ID_KEY = 'id'
-METADATA_VAULT_FILES = 'files'
+# Failures of usable ids: reported even when not verbose, never cached
+TRANSIENT_FAILURES = (KeyringThrottlingException, KeyringTimeoutException)
+
+DEFAULT_JOBS = 8
+DEFAULT_TIMEOUT = 20
+DEFAULT_DEADLINE = 60
+DEFAULT_NEGATIVE_CACHE_TTL = 60
+POLL_INTERVAL = 0.05
+# auto: the asyncio loop when a plugin implements the async contract, or
+# async, or threads
+RESOLVER_ENV = 'ANSIBLE_VAULT_MANAGER_RESOLVER'
 
 '''
 Print message on stderr instead of stdout
@@ -33,11 +54,10 @@ def eprint(*args, **kwargs):
 
 
 def list_plugins():
-    modules = glob.glob(os.path.join(os.path.dirname(__file__), 'keyring_plugins', '*.py'))
-    return [os.path.basename(f)[:-3] for f in modules if os.path.isfile(f) and not f.endswith('__init__.py')]
+    return registry.list_plugins()
 
 
-def recursive_glob(rootdir='.', pattern='*'):
+def recursive_glob(rootdir='.', pattern='*', skip_hidden=False):
     '''
     Search recursively for files matching a specified pattern.
 
@@ -45,8 +65,12 @@ def recursive_glob(rootdir='.', pattern='*'):
     http://stackoverflow.com/questions/2186525/use-a-glob-to-find-files-recursively-in-python
     '''
 
+    import fnmatch
     matches = []
     for root, dirnames, filenames in os.walk(rootdir):
+        if skip_hidden:
+            dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+            filenames = [filename for filename in filenames if not filename.startswith('.')]
         for filename in fnmatch.filter(filenames, pattern):
             matches.append(os.path.join(root, filename))
 
@@ -61,54 +85,43 @@ def get_metadata(path, full_path=False, base_path=None):
             metadata_file = path
         else:
             metadata_file = os.path.join(base_path, path)
-    if not os.path.exists(metadata_file):
-        return {'vault_ids': []}
-
-    with open(metadata_file, 'r') as stream:
-        try:
-            if 'FullLoader' in yaml.__dict__:
-                vault_metadata = yaml.load(stream, Loader=yaml.FullLoader)
-            else:
-                vault_metadata = yaml.load(stream)
-        except yaml.YAMLError as exc:
-            eprint(exc)
-            sys.exit(2)
 
-    if 'include' in vault_metadata:
-        for subfile in vault_metadata['include']:
-            metadata = get_metadata(subfile, True, os.path.dirname(metadata_file))
-            if 'vault_ids' in metadata:
-                vault_metadata['vault_ids'] = vault_metadata['vault_ids'] + metadata['vault_ids']
-
-    return vault_metadata
+    import yaml
+    try:
+        with metrics.timer('metadata_load'):
+            return load_metadata(metadata_file)
+    except (yaml.YAMLError, MetadataException) as exc:
+        eprint(exc)
+        sys.exit(2)
 
 
 def write_metadata(metadata, path):
-    with open(os.path.join(path, METADATA_FILE), 'w+') as stream:
-        yaml.dump(metadata, stream)
-
-
-def get_cached_password(vault_id):
-    return False
-    if os.path.isfile(os.path.join(gettempdir(), md5(vault_id.encode()).hexdigest())):
-        with open(os.path.join(gettempdir(), md5(vault_id.encode()).hexdigest()), 'r') as cached:
-            password = cached.read()
-            return password
-
-    return False
+    '''
+    Replace the content of the metadata file of path (not its includes).
+    '''
+    with MetadataTransaction(os.path.join(path, METADATA_FILE)) as transaction:
+        transaction.metadata.clear()
+        transaction.metadata.update(metadata)
+    # Refresh the compiled snapshot, only the written file is parsed again
+    get_metadata(path)
 
 
-def set_cached_password(vault_id, password):
-    with open(os.path.join(gettempdir(), md5(vault_id.encode()).hexdigest()), 'w+') as cached:
-        password = cached.write(password)
+def append_metadata_ids(entries, path):
+    '''
+    Add entries to the vault ids of the metadata file of path, safe against
+    concurrent writers.
+    '''
+    with MetadataTransaction(os.path.join(path, METADATA_FILE)) as transaction:
+        transaction.append_ids(entries)
+    get_metadata(path)
 
 
 def get_vault_lib():
     try:
         import ansible
         from ansible.parsing.vault import VaultLib
-        _ansible_ver = float('.'.join(ansible.__version__.split('.')[:2]))
-        if _ansible_ver < 2.5:
+        _ansible_ver = tuple(int(part) for part in ansible.__version__.split('.')[:2])
+        if _ansible_ver < (2, 5):
             eprint('This tool needs at least ansible 2.5 to works correctly')
             sys.exit(1)
     except ImportError:
@@ -118,6 +131,11 @@ def get_vault_lib():
     return VaultLib
 
 
+def to_secret_bytes(password):
+    # Same as ansible does with client scripts output
+    return password.encode('utf-8').strip(b'\r\n')
+
+
 def _make_secrets(secret):
     secret = secret.encode('utf-8')
 
@@ -134,9 +152,50 @@ def which(pgm):
             return p
 
 
+def split_list_args(values):
+    '''
+    Flatten repeated and comma separated option values.
+    '''
+    return [value.strip() for arg in values or [] for value in arg.split(',') if value.strip()]
+
+
+def format_identity(id, client_script):
+    '''
+    Return the ansible vault identity of a metadata entry, fetched by
+    client_script.
+    '''
+    return id[METADATA_PLUGIN_KEY] + PLUGIN_SEPARATOR + id[METADATA_ID_KEY] + CLIENT_SEPARATOR + client_script
+
+
+def add_batch_results(results, plugin_name, batch, passwords):
+    '''
+    Add the fetch_many results of a batch to results, mapping each
+    (plugin_name, vault_id) to (password, error).
+    '''
+    for vault_id in batch:
+        password = passwords.get(vault_id)
+        if isinstance(password, Exception):
+            results[(plugin_name, vault_id)] = (None, password)
+        else:
+            results[(plugin_name, vault_id)] = (password, None)
+
+
+def get_file_index(vault_path, vault_ids):
+    '''
+    Return the FileIndex of vault_ids, completed by the headers of the vault
+    files found in vault_path, and of files outside it listed by included
+    metadata (their paths are relative to vault_path, see MetadataResolver).
+    '''
+    from .vault_index import HeaderIndex, get_header_ids, read_outside_headers
+    header_ids = HeaderIndex(vault_path).load().header_ids()
+    listed_files = set(os.path.normpath(file) for id in vault_ids for file in id.get(METADATA_VAULT_FILES) or [])
+    header_ids.update(get_header_ids(read_outside_headers(vault_path, listed_files)))
+    return FileIndex(vault_ids, header_ids)
+
+
 def set_default_subcommand():
     command_args = sys.argv[1:]
-    known_subcommands = ['get-usable-ids', 'fetch', 'create']
+    known_subcommands = ['get-usable-ids', 'fetch', 'create', 'agent', 'rekey', 'encrypt', 'verify', 'which-id', 'warm']
     sub_command_defined = False
     for subcommand in known_subcommands:
         if subcommand in command_args:
@@ -147,7 +206,53 @@ def set_default_subcommand():
     return command_args
 
 
+class FetchArgs(object):
+    action = 'fetch'
+    vault_id = None
+    verbose = False
+    no_agent = False
+    no_cache = False
+    cache_ttl = None
+    plugin_path = None
+    timings = False
+    metrics_json = None
+    metrics_textfile = None
+
+
+def parse_fetch_commandline(command_args):
+    '''
+    Parse the plain fetch call ansible does on client scripts without
+    loading argparse. Return None for any other command line.
+    '''
+    args = FetchArgs()
+    command_args = list(command_args)
+    while command_args:
+        arg = command_args.pop(0)
+        if arg == 'fetch':
+            continue
+        elif arg in ('-v', '--verbose'):
+            args.verbose = True
+        elif arg == '--no-agent':
+            args.no_agent = True
+        elif arg == '--no-cache':
+            args.no_cache = True
+        elif arg == '--timings':
+            args.timings = True
+        elif arg == '--vault-id' and command_args:
+            args.vault_id = command_args.pop(0)
+        elif arg.startswith('--vault-id='):
+            args.vault_id = arg[len('--vault-id='):]
+        else:
+            return None
+
+    if args.vault_id is None:
+        return None
+
+    return args
+
+
 def parse_commandline():
+    import argparse
     parser = argparse.ArgumentParser(
         description='Script to manage and fetch ansible-vault secrets',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
@@ -170,6 +275,72 @@ def parse_commandline():
         help='Diretory path where vault files are presents.',
         required=True
     )
+    parser_usable.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=DEFAULT_JOBS,
+        help='Number of vault ids resolved concurrently.'
+    )
+    parser_usable.add_argument(
+        '--timeout',
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help='Seconds a plugin may take to answer, 0 for no limit.'
+    )
+    parser_usable.add_argument(
+        '--plugin-timeout',
+        dest='plugin_timeouts',
+        metavar='PLUGIN=SECONDS',
+        action='append',
+        help='Could be repeated, override --timeout for a plugin.',
+        required=False
+    )
+    parser_usable.add_argument(
+        '--plugin-concurrency',
+        dest='plugin_concurrencies',
+        metavar='PLUGIN=CALLS',
+        action='append',
+        help='Could be repeated, max calls of a plugin in flight when ids are resolved in the asyncio loop '
+             '(plugins implementing the async contract, or $ANSIBLE_VAULT_MANAGER_RESOLVER=async). '
+             'Default the plugin choice, else --jobs.',
+        required=False
+    )
+    parser_usable.add_argument(
+        '--deadline',
+        type=float,
+        default=DEFAULT_DEADLINE,
+        help='Seconds after which pending ids are given up and usable ones printed, 0 for no limit.'
+    )
+    parser_usable.add_argument(
+        '--negative-cache-ttl',
+        dest='negative_cache_ttl',
+        type=int,
+        default=DEFAULT_NEGATIVE_CACHE_TTL,
+        help='Seconds ids failing with not found or access denied errors are not retried, 0 to disable.'
+    )
+    parser_usable.add_argument(
+        '--lazy',
+        action='store_true',
+        help='Only probe ids with cheap permission checks, passwords are fetched when ansible needs them.',
+        required=False
+    )
+    parser_usable.add_argument(
+        '--files',
+        metavar='PATTERN',
+        action='append',
+        help='Could be repeated or comma separated, only resolve ids of vault files matching these glob patterns '
+             '(relative to vault path). Ids without files in metadata are always resolved.',
+        required=False
+    )
+    parser_usable.add_argument(
+        '--groups',
+        metavar='GROUP',
+        action='append',
+        help='Could be repeated or comma separated, only resolve ids of vault files named after these groups, '
+             'or in directories named after them (glob patterns allowed).',
+        required=False
+    )
 
     parser_fetch = subparsers.add_parser(
         'fetch',
@@ -181,6 +352,39 @@ def parse_commandline():
         help='ID of key to fetch. Format: [plugin]%' + PLUGIN_SEPARATOR + '[id at plugin format].',
         required=True
     )
+    parser_fetch.add_argument(
+        '--no-agent',
+        dest='no_agent',
+        action='store_true',
+        help='Do not ask the running agent, always fetch in process.',
+        required=False
+    )
+
+    parser_agent = subparsers.add_parser(
+        'agent',
+        description='Run a resident agent serving passwords over a Unix socket',
+        help='Run a resident agent serving passwords over a Unix socket'
+    )
+    parser_agent.add_argument(
+        '--socket',
+        metavar='PATH',
+        help='Socket path, default $ANSIBLE_VAULT_MANAGER_AGENT_SOCKET or a per-user runtime dir. '
+             'Its directory is created 0700 or must already be private to the current user.',
+        required=False
+    )
+    parser_agent.add_argument(
+        '--idle-timeout',
+        dest='idle_timeout',
+        type=int,
+        default=900,
+        help='Seconds without request before the agent exits, 0 to never exit.'
+    )
+    parser_agent.add_argument(
+        '--stop',
+        action='store_true',
+        help='Stop the running agent.',
+        required=False
+    )
 
     parser_create = subparsers.add_parser(
         'create',
@@ -212,12 +416,238 @@ def parse_commandline():
         help='Could be repeated, key=value param for plugin.',
         required=False
     )
+    parser_create.add_argument(
+        '--manifest',
+        metavar='MANIFEST',
+        help='YAML list of files to create at once, each with a file key and optional plugin, plugin_params '
+             'and password (generated when missing) keys.',
+        required=False
+    )
+    parser_create.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=DEFAULT_JOBS,
+        help='Number of passwords stored concurrently with --manifest.'
+    )
+    parser_create.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='Number of processes encrypting files with --manifest, default the number of CPUs.'
+    )
     parser_create.add_argument(
         'file',
         metavar='FILE_PATH',
+        nargs='?',
         help='File path to create.'
     )
 
+    parser_rekey = subparsers.add_parser(
+        'rekey',
+        description='Rotate passwords of vault files: store new ids and re-encrypt files with them',
+        help='Rotate passwords of vault files'
+    )
+    parser_rekey.add_argument(
+        '--vault-path',
+        metavar='PATH',
+        help='Diretory path where vault files are presents.',
+        required=True
+    )
+    parser_rekey.add_argument(
+        '--plugin',
+        help='Plugin name to use to store new passwords, default the plugin of each current id.',
+        required=False
+    )
+    parser_rekey.add_argument(
+        '--plugin-param',
+        dest='plugin_vars',
+        action='append',
+        help='Could be repeated, key=value param for plugin.',
+        required=False
+    )
+    parser_rekey.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=DEFAULT_JOBS,
+        help='Number of passwords fetched and stored concurrently.'
+    )
+    parser_rekey.add_argument(
+        '--timeout',
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help='Seconds a plugin may take to answer, 0 for no limit.'
+    )
+    parser_rekey.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='Number of processes re-encrypting files, default the number of CPUs.'
+    )
+    parser_rekey.add_argument(
+        'files',
+        metavar='FILE_PATH',
+        nargs='*',
+        help='Vault files to rekey (relative to vault path), default all files of the metadata file.'
+    )
+
+    parser_encrypt = subparsers.add_parser(
+        'encrypt',
+        description='Encrypt existing files, each one with a new id and generated password',
+        help='Encrypt existing files with new ids'
+    )
+    parser_encrypt.add_argument(
+        '--vault-path',
+        metavar='PATH',
+        help='Diretory path where vault files are presents.',
+        required=True
+    )
+    parser_encrypt.add_argument(
+        '--plugin',
+        help='Plugin name to use to store new passwords.',
+        required=False
+    )
+    parser_encrypt.add_argument(
+        '--plugin-param',
+        dest='plugin_vars',
+        action='append',
+        help='Could be repeated, key=value param for plugin.',
+        required=False
+    )
+    parser_encrypt.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=DEFAULT_JOBS,
+        help='Number of passwords stored concurrently.'
+    )
+    parser_encrypt.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='Number of processes encrypting files, default the number of CPUs.'
+    )
+    parser_encrypt.add_argument(
+        'files',
+        metavar='FILE_PATH',
+        nargs='+',
+        help='Files to encrypt (relative to vault path).'
+    )
+
+    parser_verify = subparsers.add_parser(
+        'verify',
+        description='Check that every vault file of metadata can be decrypted with its id',
+        help='Check that every vault file of metadata can be decrypted with its id'
+    )
+    parser_verify.add_argument(
+        '--vault-path',
+        metavar='PATH',
+        help='Diretory path where vault files are presents.',
+        required=True
+    )
+    parser_verify.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=DEFAULT_JOBS,
+        help='Number of vault ids resolved concurrently.'
+    )
+    parser_verify.add_argument(
+        '--timeout',
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help='Seconds a plugin may take to answer, 0 for no limit.'
+    )
+    parser_verify.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='Number of processes decrypting files, default the number of CPUs.'
+    )
+    parser_verify.add_argument(
+        '--format',
+        choices=['text', 'json'],
+        default='text',
+        help='Report format.'
+    )
+
+    parser_which = subparsers.add_parser(
+        'which-id',
+        description='Show vault ids protecting files, or files protected by vault ids',
+        help='Show vault ids protecting files, or files protected by vault ids'
+    )
+    parser_which.add_argument(
+        '--vault-path',
+        metavar='PATH',
+        help='Diretory path where vault files are presents.',
+        required=True
+    )
+    parser_which.add_argument(
+        '--id',
+        dest='ids',
+        metavar='PLUGIN%ID',
+        action='append',
+        help='Could be repeated, show files protected by this vault id.',
+        required=False
+    )
+    parser_which.add_argument(
+        'files',
+        metavar='FILE_PATH',
+        nargs='*',
+        help='Vault files (relative to vault path, or absolute) to show vault ids of.'
+    )
+
+    parser_warm = subparsers.add_parser(
+        'warm',
+        description='Resolve all usable ids ahead of a deployment: fill the password cache (and the running '
+                    'agent) and write an identity list file to source before ansible commands',
+        help='Resolve all usable ids and write an identity list file'
+    )
+    parser_warm.add_argument(
+        '--vault-path',
+        metavar='PATH',
+        help='Diretory path where vault files are presents.',
+        required=True
+    )
+    parser_warm.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=DEFAULT_JOBS,
+        help='Number of vault ids resolved concurrently.'
+    )
+    parser_warm.add_argument(
+        '--timeout',
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help='Seconds a plugin may take to answer, 0 for no limit.'
+    )
+    parser_warm.add_argument(
+        '--deadline',
+        type=float,
+        default=DEFAULT_DEADLINE,
+        help='Seconds after which pending ids are given up, 0 for no limit.'
+    )
+    parser_warm.add_argument(
+        '--ttl',
+        type=int,
+        default=None,
+        help='Seconds the identity list stays valid, default the password cache TTL.'
+    )
+    parser_warm.add_argument(
+        '--refresh',
+        action='store_true',
+        help='Fetch passwords from keyrings even when cached, restarting their cache TTL.',
+        required=False
+    )
+    parser_warm.add_argument(
+        '--output',
+        metavar='FILE',
+        help='Also write the identity list file to FILE.',
+        required=False
+    )
+
     parser.add_argument(
         '--verbose',
         '-v',
@@ -225,6 +655,53 @@ def parse_commandline():
         default=False,
         help='Verbose mode for outputs'
     )
+    parser.add_argument(
+        '--plugin-path',
+        dest='plugin_path',
+        metavar='PATHS',
+        default=None,
+        help='Directories (separated by \'' + os.pathsep + '\') searched for extra keyring plugins modules, '
+             'in addition to $ANSIBLE_VAULT_MANAGER_PLUGIN_PATH.'
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        dest='cache_ttl',
+        type=int,
+        default=None,
+        help='Seconds fetched passwords stay in the shared encrypted cache, 0 to disable. '
+             'Default $ANSIBLE_VAULT_MANAGER_CACHE_TTL or 900.'
+    )
+    parser.add_argument(
+        '--no-cache',
+        dest='no_cache',
+        action='store_true',
+        default=False,
+        help='Do not read nor write the shared password cache'
+    )
+
+    parser.add_argument(
+        '--timings',
+        action='store_true',
+        default=False,
+        help='Print timings and counters of metadata loads, plugin imports and keyring calls on stderr. '
+             'Also enabled by $ANSIBLE_VAULT_MANAGER_TIMINGS=1.'
+    )
+    parser.add_argument(
+        '--metrics-json',
+        dest='metrics_json',
+        metavar='FILE',
+        default=None,
+        help='Append the metrics of this invocation as a JSON line to FILE, - for stderr. '
+             'Default $ANSIBLE_VAULT_MANAGER_METRICS_JSON.'
+    )
+    parser.add_argument(
+        '--metrics-textfile',
+        dest='metrics_textfile',
+        metavar='FILE',
+        default=None,
+        help='Add the metrics of this invocation to the totals of a prometheus textfile collector file. '
+             'Default $ANSIBLE_VAULT_MANAGER_METRICS_TEXTFILE.'
+    )
 
     args = parser.parse_args(set_default_subcommand())
     return parser, args
@@ -237,50 +714,109 @@ class HelpException(Exception):
 class VaultManager:
     def __init__(self, args):
         self.args = args
+        if getattr(args, 'plugin_path', None):
+            registry.add_plugin_path(args.plugin_path)
+        self._secret_cache = None
+        self._failure_cache = None
+        self.abandoned_fetches = False
+        self.refresh_cache = False
         if self.args.action == 'fetch':
             self.fetch()
         elif self.args.action == 'get-usable-ids':
             self.get_usable_ids()
         elif self.args.action == 'create':
             self.create()
+        elif self.args.action == 'agent':
+            self.agent()
         elif self.args.action == 'rekey':
-            self.not_ready()
+            self.rekey()
         elif self.args.action == 'encrypt':
-            self.not_ready()
+            self.encrypt()
+        elif self.args.action == 'verify':
+            self.verify()
+        elif self.args.action == 'which-id':
+            self.which_id()
+        elif self.args.action == 'warm':
+            self.warm()
 
     def fetch(self):
         vault_id = self.args.vault_id.split(PLUGIN_SEPARATOR, -1)
-        password = self.fetch_password(vault_id[0], vault_id[1])
+        password = None
+        if not self.args.no_agent:
+            import socket
+            from .agent import agent_fetch, AgentUnavailable, AgentError
+            try:
+                with metrics.timer('agent_fetch', plugin=vault_id[0]):
+                    password = agent_fetch(vault_id[0], vault_id[1])
+            except (AgentUnavailable, AgentError, socket.error, ValueError) as e:
+                # Any agent failure falls back to the in process resolution
+                if self.args.verbose:
+                    eprint('Agent not available, fetch in process: ' + str(e))
+        if password is None:
+            password = self.fetch_password(vault_id[0], vault_id[1])
         print(password)
 
+    def agent(self):
+        from .agent import request_agent, AgentUnavailable, AgentError
+        from .agent_server import serve
+        try:
+            if self.args.stop:
+                response = request_agent({'action': 'stop'}, self.args.socket)
+                eprint('Agent ' + str(response['pid']) + ' stopped')
+            else:
+                ttl = 0 if self.args.no_cache else self.args.cache_ttl
+                serve(self, self.args.socket, self.args.idle_timeout, ttl)
+        except (AgentUnavailable, AgentError, OSError) as e:
+            eprint(e)
+            sys.exit(2)
+
     def get_usable_ids(self):
         vault_metadata = get_metadata(self.args.vault_path)
 
         usable_ids = []
-        # client_script is current script call path
-        client_script = inspect.stack()[0][1]
         client_script = which('ansible-vault-manager-client')
-        for id in vault_metadata['vault_ids']:
-            try:
-                password = self.fetch_password(id[METADATA_PLUGIN_KEY], id[METADATA_ID_KEY])
-                if password:
-                    usable_ids.append(
-                        id[METADATA_PLUGIN_KEY]
-                        + PLUGIN_SEPARATOR
-                        + id[METADATA_ID_KEY]
-                        + CLIENT_SEPARATOR
-                        + client_script
-                    )
-            except Exception as e:
+        vault_ids = vault_metadata['vault_ids']
+        if self.args.files or self.args.groups:
+            vault_ids = get_file_index(self.args.vault_path, vault_ids).filter(
+                split_list_args(self.args.files),
+                split_list_args(self.args.groups)
+            )
+        elif not self.args.no_cache:
+            from .warm import load_identities
+            usable_ids = load_identities(self.args.vault_path, vault_metadata)
+            if usable_ids is not None:
+                if self.args.verbose:
+                    eprint('Identity list warmed for ' + self.args.vault_path + ' reused')
+                if usable_ids:
+                    print(','.join(usable_ids))
+                return
+            usable_ids = []
+        results = self.resolve_passwords(vault_ids, probe=self.args.lazy)
+        for id, (password, error) in zip(vault_ids, results):
+            if isinstance(error, TRANSIENT_FAILURES):
+                eprint('Id ' + id[METADATA_PLUGIN_KEY] + PLUGIN_SEPARATOR + id[METADATA_ID_KEY]
+                       + ' skipped: ' + str(error))
+            elif error is not None:
                 if self.args.verbose:
-                    eprint(e)
+                    eprint(error)
+            elif password:
+                usable_ids.append(format_identity(id, client_script))
 
-        if not usable_ids:
-            sys.exit(0)
+        if usable_ids:
+            print(','.join(usable_ids))
 
-        print(','.join(usable_ids))
+        if self.abandoned_fetches:
+            # Worker threads still blocked on a backend would delay exit
+            metrics.report()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
 
     def create(self):
+        import getpass
+        from builtins import input, str
+        if self.args.manifest:
+            return self.create_from_manifest()
         try:
             print('')
             new_file = self.args.file
@@ -295,7 +831,11 @@ class VaultManager:
                 plugin_name = input(
                     'Keyring plugin name to use [' + ', '.join(list_plugins()) + ']: '
                 )
-            plugin = self.get_plugin_instance(plugin_name)
+            try:
+                plugin = self.get_plugin_instance(plugin_name)
+            except KeyringException as e:
+                eprint(e)
+                sys.exit(2)
             id = plugin.generate_id(self.args.plugin_vars)
 
             print('New ID to use: ' + id)
@@ -323,15 +863,15 @@ class VaultManager:
             new_version = plugin.set_password(id, password)
             id = plugin.append_id_version(new_version)
 
-            vault_metadata = get_metadata(self.args.vault_path)
-            vault_metadata['vault_ids'].append(
-                {
+            # Only the local metadata file is changed, not its includes
+            append_metadata_ids(
+                [{
                     METADATA_ID_KEY: id,
                     METADATA_PLUGIN_KEY: plugin_name,
                     METADATA_VAULT_FILES: [new_file]
-                }
+                }],
+                self.args.vault_path
             )
-            write_metadata(vault_metadata, self.args.vault_path)
 
             VaultLib = get_vault_lib()
             vault_api = VaultLib(_make_secrets(password))
@@ -345,45 +885,492 @@ class VaultManager:
                 import traceback
                 traceback.print_exc()
 
-    def not_ready(self):
-        print("Action not yet ready !!!")
-        sys.exit(2)
+    def create_from_manifest(self):
+        from .encrypt import CreatePipeline, load_manifest
+        from .rekey import RekeyException
+        try:
+            pipeline = CreatePipeline(
+                self,
+                self.args.vault_path,
+                load_manifest(self.args.manifest),
+                self.args.plugin,
+                self.args.plugin_vars,
+                self.args.processes
+            )
+            pipeline.run()
+        except (RekeyException, KeyringException, MetadataException, IOError, OSError) as e:
+            eprint(e)
+            sys.exit(2)
+        except KeyboardInterrupt:
+            eprint('Creation interrupted, no file created')
+            sys.exit(1)
 
-    def fetch_password(self, vault_plugin, vault_id):
-        if get_cached_password(vault_id):
-            return (0, get_cached_password(vault_id), "")
+    def rekey(self):
+        from .rekey import RekeyPipeline, RekeyException
+        pipeline = RekeyPipeline(
+            self,
+            self.args.vault_path,
+            self.args.files,
+            self.args.plugin,
+            self.args.plugin_vars,
+            self.args.processes
+        )
+        try:
+            pipeline.run()
+        except (RekeyException, KeyringException, MetadataException, IOError, OSError) as e:
+            eprint(e)
+            sys.exit(2)
+        except KeyboardInterrupt:
+            eprint('Rekey interrupted, vault files left unchanged')
+            sys.exit(1)
+
+    def encrypt(self):
+        from builtins import input
+        from .encrypt import EncryptPipeline
+        from .rekey import RekeyException
+        plugin_name = self.args.plugin
+        if plugin_name is None:
+            plugin_name = input(
+                'Keyring plugin name to use [' + ', '.join(list_plugins()) + ']: '
+            )
+        pipeline = EncryptPipeline(
+            self,
+            self.args.vault_path,
+            self.args.files,
+            plugin_name,
+            self.args.plugin_vars,
+            self.args.processes
+        )
+        try:
+            pipeline.run()
+        except (RekeyException, KeyringException, MetadataException, IOError, OSError) as e:
+            eprint(e)
+            sys.exit(2)
+        except KeyboardInterrupt:
+            eprint('Encryption interrupted, files left unchanged')
+            sys.exit(1)
+
+    def verify(self):
+        '''
+        Exit 1 when any issue is found, so it can gate a CI pipeline.
+        '''
+        from .verify import VaultVerifier, format_report
+        report = VaultVerifier(self, self.args.vault_path, self.args.processes).run()
+        if self.args.format == 'json':
+            import json
+            print(json.dumps(report, indent=2, sort_keys=True))
         else:
-            plugin = self.get_plugin_instance(vault_plugin)
-            return plugin.fetch(vault_id)
+            print(format_report(report))
+
+        if report['failures'] or report['orphans'] or report['unreferenced_ids'] or report['unresolved_ids']:
+            sys.exit(1)
+
+    def which_id(self):
+        vault_ids = get_metadata(self.args.vault_path)['vault_ids']
+        file_index = get_file_index(self.args.vault_path, vault_ids)
+
+        not_found = False
+        for file in self.args.files:
+            # Files of included metadata may be given by absolute path
+            if os.path.isabs(file):
+                file = os.path.relpath(file, self.args.vault_path)
+            ids = file_index.get_ids(file)
+            if not ids:
+                eprint('No vault id found for ' + file)
+                not_found = True
+                continue
+            labels = [id[METADATA_PLUGIN_KEY] + PLUGIN_SEPARATOR + id[METADATA_ID_KEY] for id in ids]
+            print(file + ': ' + ', '.join(labels))
+
+        for label in self.args.ids or []:
+            files = [
+                files for id, files in zip(vault_ids, file_index.files_by_id)
+                if id[METADATA_PLUGIN_KEY] + PLUGIN_SEPARATOR + id[METADATA_ID_KEY] == label
+            ]
+            if not files:
+                eprint('Vault id ' + label + ' not found in metadata')
+                not_found = True
+                continue
+            print(label + ': ' + ', '.join(files[0]))
+
+        if not_found:
+            sys.exit(1)
+
+    def warm(self):
+        '''
+        Print the path of the identity list file, to be sourced.
+        '''
+        from .cache import get_cache_ttl
+        from .warm import get_identity_file_path, metadata_fingerprint, write_identity_file
+        start = time.time()
+        self.refresh_cache = self.args.refresh
+        vault_metadata = get_metadata(self.args.vault_path)
+        vault_ids = vault_metadata['vault_ids']
+        client_script = which('ansible-vault-manager-client')
+
+        usable_ids = []
+        passwords = {}
+        transient_failures = 0
+        for id, (password, error) in zip(vault_ids, self.resolve_passwords(vault_ids)):
+            label = id[METADATA_PLUGIN_KEY] + PLUGIN_SEPARATOR + id[METADATA_ID_KEY]
+            if error is not None:
+                eprint('Unusable id ' + label + ': ' + str(error))
+                transient_failures += isinstance(error, TRANSIENT_FAILURES)
+            elif password:
+                usable_ids.append(format_identity(id, client_script))
+                passwords[(id[METADATA_PLUGIN_KEY], id[METADATA_ID_KEY])] = password
+
+        agent_count = self.warm_agent(list(passwords))
+
+        ttl = self.args.ttl
+        if ttl is None:
+            ttl = get_cache_ttl() if self.args.cache_ttl is None else self.args.cache_ttl
+        expires = start + ttl
+        if transient_failures:
+            # Ids may be usable, sourcing the list must resolve them again
+            eprint('{0} ids failed transiently, identity list written already expired'.format(transient_failures))
+            expires = start
+        fingerprint = metadata_fingerprint(vault_metadata)
+        identity_file = get_identity_file_path(self.args.vault_path)
+        try:
+            write_identity_file(identity_file, self.args.vault_path, usable_ids, fingerprint, expires, client_script)
+            if self.args.output:
+                write_identity_file(
+                    self.args.output, self.args.vault_path, usable_ids, fingerprint, expires, client_script
+                )
+        except (IOError, OSError) as e:
+            eprint(e)
+            sys.exit(2)
+
+        eprint('{0}/{1} ids usable{2}, identity list valid {3}s, warmed in {4:.2f}s'.format(
+            len(usable_ids),
+            len(vault_ids),
+            '' if agent_count is None else ', {0} loaded in agent'.format(agent_count),
+            int(expires - start),
+            time.time() - start
+        ))
+        print(self.args.output or identity_file)
+
+        if self.abandoned_fetches:
+            metrics.report()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
+
+    def warm_agent(self, keys):
+        '''
+        Have the running agent load (plugin_name, vault_id) keys, from the
+        password cache just filled when it is enabled. Return the number of
+        loaded keys, None when no agent runs.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        from .agent import agent_fetch, request_agent, AgentUnavailable
+        try:
+            request_agent({'action': 'ping'})
+        except AgentUnavailable:
+            return None
+
+        def load(key):
+            try:
+                agent_fetch(key[0], key[1])
+                return True
+            except Exception as e:
+                eprint('Agent could not load ' + key[0] + PLUGIN_SEPARATOR + key[1] + ': ' + str(e))
+                return False
+
+        if not keys:
+            return 0
+        with ThreadPoolExecutor(max_workers=max(1, min(self.args.jobs, len(keys)))) as executor:
+            return sum(executor.map(load, keys))
+
+    def resolve_passwords(self, vault_ids, probe=False):
+        '''
+        Fetch passwords of all metadata entries, in batches per plugin
+        resolved concurrently. Batches running longer than their plugin
+        timeout, or still running once the global deadline is reached, are
+        reported as failed. With probe, plugins only check ids look usable
+        and password may just be True.
+
+        Return a list of (password, error) tuples in the same order as vault_ids.
+        '''
+        with metrics.timer('resolve_passwords', probe=bool(probe)):
+            return self._resolve_passwords(vault_ids, probe)
+
+    def _resolve_passwords(self, vault_ids, probe):
+        ids_by_plugin = OrderedDict()
+        for id in vault_ids:
+            ids_by_plugin.setdefault(id[METADATA_PLUGIN_KEY], OrderedDict())[id[METADATA_ID_KEY]] = True
+
+        results = {}
+        batches = []
+        for plugin_name, ids in ids_by_plugin.items():
+            try:
+                plugin = self.get_plugin_instance(plugin_name)
+            except Exception as e:
+                for vault_id in ids:
+                    results[(plugin_name, vault_id)] = (None, e)
+                continue
+            plugin.timeout = self.get_plugin_timeout(plugin_name)
+            fetchable_ids = []
+            for vault_id in ids:
+                error = self.get_cached_failure(plugin_name, vault_id)
+                if error is None:
+                    fetchable_ids.append(vault_id)
+                else:
+                    results[(plugin_name, vault_id)] = (None, error)
+            if fetchable_ids:
+                for batch in plugin.split_batches(fetchable_ids):
+                    batches.append((plugin_name, plugin, batch))
+
+        if batches:
+            for (plugin_name, vault_id), result in self.run_batches(batches, probe).items():
+                results[(plugin_name, vault_id)] = result
+                # Probes use other backend calls and permissions than
+                # fetches (e.g. DescribeParameters), their failures must
+                # not make a later fetch refuse the id
+                if not probe and isinstance(result[1], (KeyringNotFoundException, KeyringAccessDeniedException)):
+                    self.set_cached_failure(plugin_name, vault_id, result[1])
+
+        return [results[(id[METADATA_PLUGIN_KEY], id[METADATA_ID_KEY])] for id in vault_ids]
+
+    def run_batches(self, batches, probe=False):
+        '''
+        Run fetch_passwords on each (plugin_name, plugin, batch) in a thread
+        pool, and return a dict mapping (plugin_name, vault_id) to
+        (password, error).
+        '''
+        if self.use_async_resolver([plugin for plugin_name, plugin, batch in batches]):
+            from .async_resolver import resolve
+            return resolve(self, 'run_batches', batches, probe)
+
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        results = {}
+        started_at = {}
+
+        def run(index, plugin_name, plugin, batch):
+            started_at[index] = time.time()
+            return self.fetch_passwords(plugin_name, plugin, batch, probe)
+
+        deadline = None
+        if getattr(self.args, 'deadline', None):
+            deadline = time.time() + self.args.deadline
+
+        jobs = max(1, min(self.args.jobs, len(batches)))
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        pending = {}
+        for index, (plugin_name, plugin, batch) in enumerate(batches):
+            future = executor.submit(run, index, plugin_name, plugin, batch)
+            pending[future] = (index, plugin_name, plugin, batch)
+
+        while pending:
+            done, not_done = wait(list(pending), timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, plugin_name, plugin, batch = pending.pop(future)
+                try:
+                    passwords = future.result()
+                except Exception as e:
+                    passwords = dict((vault_id, e) for vault_id in batch)
+                add_batch_results(results, plugin_name, batch, passwords)
+
+            now = time.time()
+            for future in not_done:
+                index, plugin_name, plugin, batch = pending[future]
+                if deadline is not None and now > deadline:
+                    error = KeyringTimeoutException(
+                        'Deadline of ' + str(self.args.deadline) + 's reached before ' + plugin_name + ' answered'
+                    )
+                elif plugin.timeout and index in started_at and now - started_at[index] > plugin.timeout:
+                    error = KeyringTimeoutException(
+                        'Plugin ' + plugin_name + ' did not answer within ' + str(plugin.timeout) + 's'
+                    )
+                else:
+                    continue
+                if not future.cancel():
+                    self.abandoned_fetches = True
+                del pending[future]
+                for vault_id in batch:
+                    results[(plugin_name, vault_id)] = (None, error)
+
+        executor.shutdown(wait=not self.abandoned_fetches)
+        return results
+
+    def use_async_resolver(self, plugins):
+        mode = os.environ.get(RESOLVER_ENV, 'auto')
+        if sys.version_info < (3, 5) or mode == 'threads':
+            return False
+        from .async_resolver import loop_running
+        if loop_running():
+            # Called from a coroutine, use AsyncResolver directly instead
+            return False
+
+        return mode == 'async' or any(has_async_contract(plugin) for plugin in plugins)
+
+    def set_passwords(self, items):
+        '''
+        Store passwords concurrently, items are (plugin_name, plugin, id,
+        password) tuples. Return a list of (new_version, error) tuples in
+        the same order.
+        '''
+        if self.use_async_resolver([item[1] for item in items]):
+            from .async_resolver import resolve
+            return resolve(self, 'set_passwords', items)
+
+        def store(plugin_name, plugin, id, password):
+            try:
+                return plugin.set_password(id, password), None
+            except Exception as e:
+                return None, e
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max(1, min(self.args.jobs, len(items)))) as executor:
+            return [future.result() for future in [executor.submit(store, *item) for item in items]]
+
+    def get_plugin_concurrency(self, plugin_name):
+        concurrencies = dict(
+            couple.split('=', 1) for couple in (getattr(self.args, 'plugin_concurrencies', None) or [])
+        )
+        if plugin_name in concurrencies:
+            return int(concurrencies[plugin_name])
+
+        return None
+
+    def get_plugin_timeout(self, plugin_name):
+        timeouts = dict(
+            couple.split('=', 1) for couple in (getattr(self.args, 'plugin_timeouts', None) or [])
+        )
+        if plugin_name in timeouts:
+            return float(timeouts[plugin_name])
+
+        return getattr(self.args, 'timeout', None)
+
+    @property
+    def failure_cache(self):
+        if self._failure_cache is None:
+            from .cache import SecretCache
+            ttl = 0 if self.args.no_cache else getattr(self.args, 'negative_cache_ttl', 0)
+            self._failure_cache = SecretCache(namespace='failures', ttl=ttl)
+        return self._failure_cache
+
+    def get_cached_failure(self, vault_plugin, vault_id):
+        try:
+            message = self.failure_cache.get(vault_plugin + PLUGIN_SEPARATOR + vault_id)
+        except Exception:
+            return None
+        if message is None:
+            return None
+
+        return KeyringException(message + ' (cached failure)')
+
+    def set_cached_failure(self, vault_plugin, vault_id, error):
+        try:
+            self.failure_cache.set(vault_plugin + PLUGIN_SEPARATOR + vault_id, str(error))
+        except Exception as e:
+            if self.args.verbose:
+                eprint('Failure cache unavailable: ' + str(e))
+
+    def fetch_passwords(self, plugin_name, plugin, vault_ids, probe=False):
+        passwords, missing_ids = self.get_cached_passwords(plugin_name, vault_ids)
+        if missing_ids:
+            fetched = plugin.probe(missing_ids) if probe else plugin.fetch_many(missing_ids)
+            self.set_fetched_passwords(plugin_name, missing_ids, fetched)
+            passwords.update(fetched)
+
+        return passwords
+
+    def get_cached_passwords(self, plugin_name, vault_ids):
+        '''
+        Return a dict of cached passwords of vault_ids and the list of the
+        other ids.
+        '''
+        passwords = {}
+        missing_ids = []
+        for vault_id in vault_ids:
+            password = self.get_cached_password(plugin_name, vault_id)
+            if password is None:
+                missing_ids.append(vault_id)
+            else:
+                passwords[vault_id] = password
+
+        return passwords, missing_ids
+
+    def set_fetched_passwords(self, plugin_name, vault_ids, fetched):
+        for vault_id in vault_ids:
+            # Probes only return a password when they fell back to a fetch
+            if not isinstance(fetched.get(vault_id), (Exception, bool)):
+                self.set_cached_password(plugin_name, vault_id, fetched.get(vault_id))
+
+    def fetch_password(self, vault_plugin, vault_id):
+        with metrics.timer('fetch_password', plugin=vault_plugin):
+            password = self.get_cached_password(vault_plugin, vault_id)
+            if password is None:
+                plugin = self.get_plugin_instance(vault_plugin)
+                password = plugin.fetch(vault_id)
+                self.set_cached_password(vault_plugin, vault_id, password)
+
+        return password
+
+    @property
+    def secret_cache(self):
+        if self._secret_cache is None:
+            from .cache import SecretCache
+            self._secret_cache = SecretCache(ttl=0 if self.args.no_cache else self.args.cache_ttl)
+        return self._secret_cache
+
+    def get_cached_password(self, vault_plugin, vault_id):
+        if self.refresh_cache:
+            return None
+        try:
+            password = self.secret_cache.get(vault_plugin + PLUGIN_SEPARATOR + vault_id)
+        except Exception as e:
+            if self.args.verbose:
+                eprint('Password cache unavailable: ' + str(e))
+            return None
+        if self.secret_cache.enabled:
+            metrics.increment('cache_misses' if password is None else 'cache_hits', plugin=vault_plugin)
+
+        return password
+
+    def set_cached_password(self, vault_plugin, vault_id, password):
+        if not password:
+            return
+        try:
+            self.secret_cache.set(vault_plugin + PLUGIN_SEPARATOR + vault_id, password)
+        except Exception as e:
+            if self.args.verbose:
+                eprint('Password cache unavailable: ' + str(e))
 
     def get_plugin_instance(self, plugin_name):
-        if __name__ == '__main__':
-            module_path = 'keyring_plugins.' + plugin_name
-            package = None
-        else:
-            module_path = '.keyring_plugins.' + plugin_name
-            package = ('.').join(__name__.split('.')[:-1])
         if self.args.verbose:
-            print('Import module : ' + module_path)
+            eprint('Load keyring plugin : ' + plugin_name)
 
         try:
-            module = import_module(module_path, package)
-            KeyringPlugin = module.KeyringPlugin
+            with metrics.timer('plugin_load', plugin=plugin_name):
+                return metrics.instrument(plugin_name, registry.get_instance(plugin_name))
         except ImportError as e:
             if self.args.verbose:
-                print(e)
-            eprint('Keyring manager client plugin ' + plugin_name + ' not found')
-
-        return KeyringPlugin()
+                eprint(e)
+            raise KeyringException('Keyring manager client plugin ' + plugin_name + ' could not be imported')
 
 
 def main():
+    args = parse_fetch_commandline(sys.argv[1:])
+    if args is not None:
+        metrics.configure(args.action, args.timings)
+        try:
+            VaultManager(args)
+        finally:
+            metrics.report()
+        return
+
     parser, args = parse_commandline()
+    metrics.configure(args.action, args.timings, args.metrics_json, args.metrics_textfile)
     try:
         VaultManager(args)
     except HelpException as e:
         print(e.message)
         parser.print_help()
+    finally:
+        metrics.report()
 
 
 if __name__ == '__main__':
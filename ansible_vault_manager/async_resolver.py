@@ -0,0 +1,179 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import asyncio
+import functools
+
+from .keyring_plugins import KeyringTimeoutException, has_async_contract
+from .metrics import metrics
+
+'''
+asyncio resolution loop, python 3 only. The core uses it instead of its
+thread pool when a plugin implements the async contract (see
+keyring_plugins), or when $ANSIBLE_VAULT_MANAGER_RESOLVER is async.
+
+Each plugin gets a semaphore bounding its calls in flight (--plugin-concurrency,
+else its concurrency attribute, else --jobs). Coroutines of async plugins run
+on the loop, so a high latency backend can have many requests in flight
+without a thread each, while sync plugins are called in a pool of --jobs
+threads.
+'''
+
+
+def loop_running():
+    get_running_loop = getattr(asyncio, '_get_running_loop', None)
+    return get_running_loop is not None and get_running_loop() is not None
+
+
+def run(coroutine):
+    '''
+    Run coroutine to completion in a new event loop.
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncPlugin(object):
+    '''
+    Async view of a keyring plugin: its coroutines when it defines them,
+    its sync methods run in executor otherwise.
+    '''
+
+    def __init__(self, manager, plugin_name, plugin, executor, concurrency):
+        self.manager = manager
+        self.plugin_name = plugin_name
+        self.plugin = plugin
+        self.executor = executor
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(self, method, *args):
+        async with self.semaphore:
+            coroutine_function = getattr(self.plugin, method + '_async', None)
+            if coroutine_function is not None:
+                with metrics.timer('plugin_call', plugin=self.plugin_name, method=method + '_async'):
+                    result = await self.with_timeout(coroutine_function(*args), False)
+                metrics.count_call(self.plugin_name, method, args, result)
+                return result
+
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(self.executor, functools.partial(getattr(self.plugin, method), *args))
+            return await self.with_timeout(future, True)
+
+    async def with_timeout(self, awaitable, in_thread):
+        if not self.plugin.timeout:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(awaitable, self.plugin.timeout)
+        except asyncio.TimeoutError:
+            if in_thread:
+                # The thread can't be interrupted and would delay exit
+                self.manager.abandoned_fetches = True
+            raise KeyringTimeoutException(
+                'Plugin ' + self.plugin_name + ' did not answer within ' + str(self.plugin.timeout) + 's'
+            )
+
+    async def fetch(self, vault_id):
+        return await self.call('fetch', vault_id)
+
+    async def fetch_many(self, vault_ids):
+        if hasattr(self.plugin, 'fetch_async') and not hasattr(self.plugin, 'fetch_many_async'):
+            passwords = await asyncio.gather(*[self.fetch(vault_id) for vault_id in vault_ids], return_exceptions=True)
+            return dict(zip(vault_ids, passwords))
+
+        return await self.call('fetch_many', vault_ids)
+
+    async def probe(self, vault_ids):
+        return await self.call('probe', vault_ids)
+
+    async def set_password(self, id, password):
+        return await self.call('set_password', id, password)
+
+
+class AsyncResolver(object):
+    def __init__(self, manager, executor):
+        self.manager = manager
+        self.executor = executor
+        self.plugins = {}
+
+    def get_plugin(self, plugin_name, plugin):
+        if plugin_name not in self.plugins:
+            concurrency = self.manager.get_plugin_concurrency(plugin_name) or plugin.concurrency \
+                or self.manager.args.jobs
+            self.plugins[plugin_name] = AsyncPlugin(self.manager, plugin_name, plugin, self.executor, concurrency)
+        return self.plugins[plugin_name]
+
+    async def fetch_passwords(self, plugin_name, plugin, vault_ids, probe=False):
+        '''
+        Same as VaultManager.fetch_passwords, backend calls run on the loop.
+        '''
+        passwords, missing_ids = self.manager.get_cached_passwords(plugin_name, vault_ids)
+        if missing_ids:
+            async_plugin = self.get_plugin(plugin_name, plugin)
+            if probe:
+                fetched = await async_plugin.probe(missing_ids)
+            else:
+                fetched = await async_plugin.fetch_many(missing_ids)
+            self.manager.set_fetched_passwords(plugin_name, missing_ids, fetched)
+            passwords.update(fetched)
+
+        return passwords
+
+    async def run_batches(self, batches, probe=False):
+        '''
+        Same as VaultManager.run_batches: return a dict mapping
+        (plugin_name, vault_id) to (password, error).
+        '''
+        from .ansible_vault_manager import add_batch_results
+        tasks = [
+            asyncio.ensure_future(self.fetch_passwords(plugin_name, plugin, batch, probe))
+            for plugin_name, plugin, batch in batches
+        ]
+        deadline = getattr(self.manager.args, 'deadline', None) or None
+        done, pending = await asyncio.wait(tasks, timeout=deadline)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        results = {}
+        for task, (plugin_name, plugin, batch) in zip(tasks, batches):
+            if task in pending:
+                if not has_async_contract(plugin):
+                    self.manager.abandoned_fetches = True
+                error = KeyringTimeoutException(
+                    'Deadline of ' + str(deadline) + 's reached before ' + plugin_name + ' answered'
+                )
+                passwords = dict((vault_id, error) for vault_id in batch)
+            elif task.exception() is not None:
+                passwords = dict((vault_id, task.exception()) for vault_id in batch)
+            else:
+                passwords = task.result()
+            add_batch_results(results, plugin_name, batch, passwords)
+
+        return results
+
+    async def set_passwords(self, items):
+        '''
+        Same as VaultManager.set_passwords.
+        '''
+        async def store(plugin_name, plugin, id, password):
+            try:
+                return await self.get_plugin(plugin_name, plugin).set_password(id, password), None
+            except Exception as e:
+                return None, e
+
+        return list(await asyncio.gather(*[store(*item) for item in items]))
+
+
+def resolve(manager, method, *args):
+    '''
+    Run an AsyncResolver method in a new event loop, with a pool of --jobs
+    threads for sync plugins.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    executor = ThreadPoolExecutor(max_workers=max(1, manager.args.jobs))
+    try:
+        return run(getattr(AsyncResolver(manager, executor), method)(*args))
+    finally:
+        executor.shutdown(wait=not manager.abandoned_fetches)
@@ -0,0 +1,255 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os
+import errno
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+'''
+Secret cache shared by all processes of the current user.
+
+Entries are encrypted with a per-user key, written atomically with 0600
+permissions in a 0700 directory, expire after a TTL and are evicted least
+recently used first once the cache holds too many entries.
+'''
+
+CACHE_DIR_ENV = 'ANSIBLE_VAULT_MANAGER_CACHE_DIR'
+CACHE_KEY_ENV = 'ANSIBLE_VAULT_MANAGER_CACHE_KEY'
+CACHE_TTL_ENV = 'ANSIBLE_VAULT_MANAGER_CACHE_TTL'
+CACHE_SIZE_ENV = 'ANSIBLE_VAULT_MANAGER_CACHE_SIZE'
+
+DEFAULT_TTL = 900
+DEFAULT_MAX_ENTRIES = 1000
+LOCK_FILE = '.lock'
+ENTRY_SUFFIX = '.entry'
+
+
+class CacheException(Exception):
+    pass
+
+
+def ensure_private_dir(path):
+    '''
+    Create path with 0700 permissions, refuse to use it if it belongs to
+    another user. An existing directory open to other users is refused
+    too, never chmoded, as it may be shared on purpose.
+    '''
+    created = True
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        created = False
+
+    stat = os.lstat(path)
+    if stat.st_uid != os.getuid():
+        raise OSError(errno.EPERM, 'Directory is not owned by current user', path)
+    if stat.st_mode & 0o077:
+        if not created:
+            raise OSError(errno.EPERM, 'Directory is accessible by other users', path)
+        # makedirs mode is masked by umask, never widened
+        os.chmod(path, 0o700)
+
+
+def get_user_dir(env, default_base, *parts):
+    base = os.environ.get(env) or os.path.join(os.path.expanduser('~'), default_base)
+    return os.path.join(base, 'ansible-vault-manager', *parts)
+
+
+def get_cache_dir(*parts):
+    if os.environ.get(CACHE_DIR_ENV):
+        return os.path.join(os.environ[CACHE_DIR_ENV], *parts)
+
+    return get_user_dir('XDG_CACHE_HOME', '.cache', *parts)
+
+
+def get_cache_ttl(default=DEFAULT_TTL):
+    return int(os.environ.get(CACHE_TTL_ENV, default))
+
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def atomic_write(path, data, mode=0o600):
+    '''
+    Write bytes to path through a temporary file renamed over it, so readers
+    never see a partial file.
+    '''
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(data)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        remove_file(tmp_path)
+        raise
+
+
+class FileLock(object):
+    '''
+    Exclusive advisory lock on a file, shared between processes.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+def load_user_key():
+    '''
+    Return the per-user cache key, from environment or from a 0600 key file
+    created on first use outside of the cache directory.
+    '''
+    from cryptography.fernet import Fernet
+    if os.environ.get(CACHE_KEY_ENV):
+        return os.environ[CACHE_KEY_ENV].encode('utf-8')
+
+    key_dir = get_user_dir('XDG_CONFIG_HOME', '.config')
+    key_file = os.path.join(key_dir, 'cache.key')
+    if not os.path.exists(key_file):
+        ensure_private_dir(key_dir)
+        try:
+            fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as stream:
+                stream.write(Fernet.generate_key())
+        except OSError as e:
+            # Another process created it meanwhile
+            if e.errno != errno.EEXIST:
+                raise
+
+    with open(key_file, 'rb') as stream:
+        return stream.read().strip()
+
+
+class SecretCache(object):
+    def __init__(self, namespace='secrets', ttl=None, max_entries=None, cache_dir=None):
+        self.ttl = get_cache_ttl() if ttl is None else ttl
+        if max_entries is None:
+            max_entries = int(os.environ.get(CACHE_SIZE_ENV, DEFAULT_MAX_ENTRIES))
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir or get_cache_dir(namespace)
+        self.enabled = self.ttl > 0
+        self._fernet = None
+
+    @property
+    def fernet(self):
+        if self._fernet is None:
+            try:
+                from cryptography.fernet import Fernet
+            except ImportError:
+                # Never store secrets in plain text
+                self.enabled = False
+                return None
+            try:
+                self._fernet = Fernet(load_user_key())
+            except ValueError:
+                raise CacheException('Invalid cache key, it must be a urlsafe base64 encoded 32 bytes key')
+        return self._fernet
+
+    def entry_path(self, key):
+        import hashlib
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + ENTRY_SUFFIX)
+
+    def get(self, key):
+        if not self.enabled or self.fernet is None:
+            return None
+
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as stream:
+                token = stream.read()
+        except IOError:
+            return None
+
+        from cryptography.fernet import InvalidToken
+        try:
+            value = self.fernet.decrypt(token, ttl=self.ttl)
+        except InvalidToken:
+            # Expired or written with another key
+            self.delete(key)
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return value.decode('utf-8')
+
+    def set(self, key, value):
+        if not self.enabled or self.fernet is None:
+            return
+
+        ensure_private_dir(self.cache_dir)
+        token = self.fernet.encrypt(value.encode('utf-8'))
+        with FileLock(os.path.join(self.cache_dir, LOCK_FILE)):
+            atomic_write(self.entry_path(key), token)
+            self._evict()
+
+    def delete(self, key):
+        remove_file(self.entry_path(key))
+
+    def clear(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        with FileLock(os.path.join(self.cache_dir, LOCK_FILE)):
+            for path, mtime in self._entries():
+                remove_file(path)
+
+    def _entries(self):
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                entries.append((path, os.stat(path).st_mtime))
+            except OSError:
+                pass
+
+        return entries
+
+    def _evict(self):
+        '''
+        Remove expired entries, then least recently used ones above
+        max_entries. Caller must hold the cache lock.
+        '''
+        now = time.time()
+        # Do not drop entries still valid for processes using the default TTL
+        ttl = max(self.ttl, DEFAULT_TTL)
+        entries = []
+        for path, mtime in self._entries():
+            # mtime is bumped on each read, so it is never older than creation
+            if now - mtime > ttl:
+                remove_file(path)
+            else:
+                entries.append((mtime, path))
+
+        entries.sort()
+        for mtime, path in entries[:max(0, len(entries) - self.max_entries)]:
+            remove_file(path)
@@ -0,0 +1,252 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os
+
+from .ansible_vault_manager import get_vault_lib, to_secret_bytes, PLUGIN_SEPARATOR
+from .cache import remove_file
+from .metadata import (
+    METADATA_PLUGIN_KEY,
+    METADATA_ID_KEY,
+    METADATA_VAULT_FILES,
+    MetadataTransaction,
+)
+from .rekey import RekeyPipeline, RekeyException, make_temporary_file
+from .vault_format import (
+    VAULT_HEADER,
+    VAULT_VERSION,
+    VAULT_CIPHER,
+    decrypt_stream,
+    encrypt_file,
+    encrypt_stream,
+    read_vault_header,
+)
+
+'''
+Encryption of existing files, each one with a new id and generated
+password. Files are streamed through the vault format in fixed size
+chunks, so memory use does not depend on their size, and encrypted in a
+process pool. Like rekey, files and metadata are only changed when every
+file was encrypted.
+'''
+
+# Vault files up to this size are also checked with VaultLib, which needs
+# several times their size in memory
+VAULTLIB_VERIFY_MAX_SIZE = 4 * 1024 * 1024
+
+
+def verify_vault_file(path, password, vault_label, plaintext_digest):
+    '''
+    Decrypt path and check it gives the content whose SHA-256 digest is
+    plaintext_digest. Files are decrypted in chunks, small ones are also
+    decrypted with VaultLib, which holds the whole file in memory.
+    '''
+    import hashlib
+    from ansible.parsing.vault import VaultSecret
+    with open(path, 'rb') as stream:
+        header = stream.readline()
+        if header.rstrip(b'\n') != b';'.join([VAULT_HEADER, VAULT_VERSION, VAULT_CIPHER, vault_label.encode('utf-8')]):
+            raise RekeyException(path + ' has an unexpected vault header')
+        content_digest = hashlib.sha256()
+        try:
+            for chunk in decrypt_stream(stream, password):
+                content_digest.update(chunk)
+        except ValueError as e:
+            raise RekeyException(path + ' does not decrypt: ' + str(e))
+        if content_digest.digest() != plaintext_digest:
+            raise RekeyException(path + ' does not decrypt to the source content')
+
+        if os.fstat(stream.fileno()).st_size <= VAULTLIB_VERIFY_MAX_SIZE:
+            stream.seek(0)
+            VaultLib = get_vault_lib()
+            plaintext = VaultLib([(vault_label, VaultSecret(password))]).decrypt(stream.read())
+            if hashlib.sha256(plaintext).digest() != plaintext_digest:
+                raise RekeyException(path + ' does not decrypt to the source content with VaultLib')
+
+
+def encrypt_vault_file(path, password, vault_label):
+    '''
+    Process pool worker: write path encrypted with password, labelled with
+    vault_label, to a temporary file and return its path. The temporary
+    file is decrypted and checked against the source before it may replace
+    it.
+    '''
+    tmp_path = make_temporary_file(path)
+    try:
+        secret = to_secret_bytes(password)
+        plaintext_digest = encrypt_file(path, tmp_path, secret, vault_label)
+        verify_vault_file(tmp_path, secret, vault_label, plaintext_digest)
+    except Exception as e:
+        remove_file(tmp_path)
+        raise RekeyException(str(e).strip())
+
+    return tmp_path
+
+
+def get_file_signature(path):
+    stat = os.stat(path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+class EncryptPipeline(RekeyPipeline):
+    done_message = 'Encrypted'
+
+    def select_rotations(self, vault_ids):
+        # Signatures of sources when selected, checked again before their
+        # plaintext is replaced
+        self.source_signatures = {}
+        known_files = set(
+            os.path.normpath(file) for entry in vault_ids for file in entry.get(METADATA_VAULT_FILES) or []
+        )
+        errors = []
+        for file in self.files:
+            path = os.path.join(self.vault_path, file)
+            if not os.path.isfile(path):
+                errors.append(file + ': no such file')
+            elif file in known_files:
+                errors.append(file + ': already in metadata, use rekey to change its password')
+            elif read_vault_header(path) is not None:
+                errors.append(file + ': already vault encrypted')
+            else:
+                self.rotations.append([None, [file], None, None])
+                self.source_signatures[path] = get_file_signature(path)
+        if errors:
+            raise RekeyException('Unable to encrypt files:\n' + '\n'.join(errors))
+
+    def resolve_old_passwords(self):
+        return [None] * len(self.rotations)
+
+    def process_files(self, old_passwords):
+        tasks = []
+        for entry, files, new_entry, new_password in self.rotations:
+            label = new_entry[METADATA_PLUGIN_KEY] + PLUGIN_SEPARATOR + new_entry[METADATA_ID_KEY]
+            tasks.append((os.path.join(self.vault_path, files[0]), new_password, label))
+
+        self.run_file_tasks(encrypt_vault_file, tasks)
+
+    def replace_files(self):
+        changed = [
+            path for path in self.temporary_files
+            if not os.path.exists(path) or get_file_signature(path) != self.source_signatures[path]
+        ]
+        if changed:
+            raise RekeyException('Files changed while being encrypted:\n' + '\n'.join(changed))
+        super(EncryptPipeline, self).replace_files()
+
+    def update_metadata(self, metadata_file):
+        with MetadataTransaction(metadata_file) as transaction:
+            transaction.append_ids([rotation[2] for rotation in self.rotations])
+
+
+def create_vault_file(path, password, vault_label, content=b'---\n'):
+    '''
+    Process pool worker: write content encrypted with password, labelled
+    with vault_label, to a temporary file next to path and return its path.
+    '''
+    import io
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.')
+    try:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.fchmod(fd, 0o666 & ~umask)
+        with os.fdopen(fd, 'wb') as stream:
+            encrypt_stream(io.BytesIO(content), stream, to_secret_bytes(password), vault_label)
+    except Exception as e:
+        remove_file(tmp_path)
+        raise RekeyException(str(e).strip())
+
+    return tmp_path
+
+
+def load_manifest(manifest_file):
+    '''
+    Return entries of a create manifest, a YAML list of mappings:
+
+        - file: group_vars/web.yml
+          plugin: aws_ssm
+          plugin_params: {region: eu-west-1, profile: customer, path: /ansible/dev/}
+          password: optional, generated when missing
+    '''
+    import yaml
+    try:
+        with open(manifest_file, 'rb') as stream:
+            manifest = yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    except yaml.YAMLError as e:
+        raise RekeyException('Invalid manifest ' + manifest_file + ': ' + str(e))
+
+    if not isinstance(manifest, list) or not all(isinstance(entry, dict) and entry.get('file') for entry in manifest):
+        raise RekeyException('Manifest ' + manifest_file + ' must be a list of mappings with a file key')
+
+    return manifest
+
+
+class CreatePipeline(EncryptPipeline):
+    '''
+    Create new vault files, with an empty document, from a manifest. All
+    secrets and files are created before the metadata file is committed
+    once.
+    '''
+    done_message = 'Created'
+
+    def __init__(self, manager, vault_path, manifest, plugin_name=None, plugin_vars=None, processes=None):
+        super(CreatePipeline, self).__init__(
+            manager,
+            vault_path,
+            [entry['file'] for entry in manifest],
+            plugin_name,
+            plugin_vars,
+            processes
+        )
+        self.manifest = dict((os.path.normpath(entry['file']), entry) for entry in manifest)
+        self.created_files = []
+
+    def select_rotations(self, vault_ids):
+        errors = []
+        for file in self.files:
+            entry = self.manifest[file]
+            path = os.path.join(self.vault_path, file)
+            if os.path.exists(path):
+                errors.append(file + ': already exists')
+            elif not os.path.isdir(os.path.dirname(path)):
+                errors.append(file + ': no such directory')
+            elif not (entry.get('plugin') or self.plugin_name):
+                errors.append(file + ': no plugin given')
+            else:
+                self.rotations.append([None, [file], None, None])
+        if len(self.manifest) != len(self.files):
+            errors.append('files are listed several times')
+        if errors:
+            raise RekeyException('Unable to create files:\n' + '\n'.join(errors))
+
+    def get_new_id_options(self, rotation):
+        entry = self.manifest[rotation[1][0]]
+        plugin_vars = list(self.plugin_vars or [])
+        plugin_vars += [key + '=' + str(value) for key, value in (entry.get('plugin_params') or {}).items()]
+        password = entry.get('password')
+        if password is not None and not str(password).strip():
+            raise RekeyException(entry['file'] + ': password is empty')
+
+        return entry.get('plugin') or self.plugin_name, plugin_vars, None if password is None else str(password).strip()
+
+    def process_files(self, old_passwords):
+        tasks = []
+        for entry, files, new_entry, new_password in self.rotations:
+            label = new_entry[METADATA_PLUGIN_KEY] + PLUGIN_SEPARATOR + new_entry[METADATA_ID_KEY]
+            tasks.append((os.path.join(self.vault_path, files[0]), new_password, label))
+
+        self.run_file_tasks(create_vault_file, tasks)
+
+    def replace_files(self):
+        for path, tmp_path in self.temporary_files.items():
+            # Unlike rename, link fails when the file was created meanwhile
+            os.link(tmp_path, path)
+            self.created_files.append(path)
+            remove_file(tmp_path)
+
+    def restore_files(self):
+        for path in self.created_files:
+            remove_file(path)
+        self.created_files = []
+
+    def rollback(self):
+        self.restore_files()
+        super(CreatePipeline, self).rollback()
@@ -1,25 +1,69 @@
 from __future__ import (absolute_import, division, print_function)
-import uuid
 
 __all__ = ["BaseKeyringPlugin"]
 
+# Optional async contract, python 3 only: plugins may also define
+# coroutines fetch_async(vault_id), fetch_many_async(vault_ids) and
+# set_password_async(id, password), with the same results as their sync
+# counterparts. Ids are then resolved in an asyncio loop (see
+# async_resolver), where the sync methods of other plugins run in threads.
+ASYNC_METHODS = ('fetch_async', 'fetch_many_async', 'set_password_async')
+
 
 class KeyringException(Exception):
     pass
 
 
+class KeyringNotFoundException(KeyringException):
+    pass
+
+
+class KeyringAccessDeniedException(KeyringException):
+    pass
+
+
+class KeyringTimeoutException(KeyringException):
+    pass
+
+
+class KeyringThrottlingException(KeyringException):
+    '''
+    Backend rate limit still exceeded after retries: the id may be usable,
+    so the failure is not cached.
+    '''
+    pass
+
+
+def has_async_contract(plugin):
+    return any(hasattr(plugin, name) for name in ASYNC_METHODS)
+
+
 class BaseKeyringPlugin:
     verbose = False
+    # Seconds a backend call may last, set by the core, None for no limit
+    timeout = None
+    # Max number of ids a single fetch_many call should receive
+    batch_size = 1
+    # Max number of calls in flight in the async loop, None for --jobs
+    concurrency = None
 
     def __init__(self, verbose=True):
         self.verbose = verbose
 
     def generate_id(self, plugin_vars=None):
+        import uuid
         self.id = str(uuid.uuid4())
         return self.id
 
-    def append_id_version(self, new_version):
-        return self.id
+    def append_id_version(self, new_version, id=None):
+        return self.id if id is None else id
+
+    def derive_id(self, id):
+        '''
+        Return a new id stored at the same location as id, without asking
+        anything, or None when the plugin can't: generate_id is then used.
+        '''
+        return None
 
     def parse_plugin_vars(self, vars):
         params = {}
@@ -35,5 +79,45 @@ class BaseKeyringPlugin:
     def fetch(self, vault_id):
         pass
 
+    def split_batches(self, vault_ids):
+        '''
+        Split vault ids into groups that fetch_many can resolve together.
+        '''
+        return [vault_ids[i:i + self.batch_size] for i in range(0, len(vault_ids), self.batch_size)]
+
+    def fetch_many(self, vault_ids):
+        '''
+        Fetch several passwords at once.
+
+        Return a dict mapping each vault id to its password, or to the
+        exception raised while fetching it.
+        '''
+        passwords = {}
+        for vault_id in vault_ids:
+            try:
+                passwords[vault_id] = self.fetch(vault_id)
+            except Exception as e:
+                passwords[vault_id] = e
+
+        return passwords
+
+    def probe(self, vault_ids):
+        '''
+        Cheaply check that ids look usable, without fetching passwords when
+        the backend allows it.
+
+        Return a dict mapping each vault id to True, or to the exception
+        making it unusable. This default falls back to fetch_many, and maps
+        usable ids to their password.
+        '''
+        return self.fetch_many(vault_ids)
+
     def set_password(self, id, password):
         pass
+
+    def delete_password(self, id):
+        '''
+        Remove a password stored by set_password, used to roll back failed
+        rotations.
+        '''
+        raise KeyringException('Password removal is not supported by this plugin')
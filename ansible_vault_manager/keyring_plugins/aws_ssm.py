@@ -1,81 +1,366 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
-import os.path
-from hashlib import md5
-from builtins import input
-from tempfile import gettempdir
-import uuid
+from collections import OrderedDict
 import getpass
+import os
+import random
+import threading
+import time
 
 try:
     import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError, NoCredentialsError, ProfileNotFound
+    from botocore.exceptions import ConnectionError as BotoConnectionError
 except ImportError as e:
     raise RuntimeError('You need to install boto3 python lib to use this plugin')
 
-from . import BaseKeyringPlugin
+from . import (
+    BaseKeyringPlugin,
+    KeyringNotFoundException,
+    KeyringAccessDeniedException,
+    KeyringThrottlingException,
+)
+from ..metrics import metrics
 
 CONFIG_SEPARATOR = ':'
+# GetParameters accepts at most 10 names per request
+SSM_BATCH_SIZE = 10
+# DescribeParameters filters accept at most 50 values
+SSM_DESCRIBE_BATCH_SIZE = 50
 
+# Calls per second allowed to each (profile, region), 0 for no limit
+SSM_RATE_ENV = 'ANSIBLE_VAULT_MANAGER_SSM_RATE'
+SSM_DEFAULT_RATE = 40
+# Attempts of a throttled or transiently failing call, first one included
+SSM_MAX_ATTEMPTS_ENV = 'ANSIBLE_VAULT_MANAGER_SSM_MAX_ATTEMPTS'
+SSM_DEFAULT_MAX_ATTEMPTS = 6
+# Full jitter exponential backoff between attempts, in seconds
+SSM_BACKOFF_BASE = 0.1
+SSM_BACKOFF_CAP = 5.0
+# Throttling answers within this many seconds halve the rate once
+SSM_THROTTLING_WINDOW = 0.2
 
-def get_cached_password(vault_id):
-    if (os.path.isfile(os.path.join(gettempdir(), md5(vault_id.encode()).hexdigest()))):
-        with open(os.path.join(gettempdir(), md5(vault_id.encode()).hexdigest()), 'r') as cached:
-            password = cached.read()
-            return password
+# SSM clients shared by all fetches of the process, keyed by (profile,
+# region, timeout) as the timeout is part of the client config
+_ssm_clients = {}
+_ssm_clients_lock = threading.Lock()
+# Rate limiters, keyed like clients
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
 
+NOT_FOUND_ERROR_CODES = ('ParameterNotFound', 'ParameterVersionNotFound')
+ACCESS_DENIED_ERROR_CODES = (
+    'AccessDeniedException',
+    'UnrecognizedClientException',
+    'InvalidClientTokenId',
+    'ExpiredTokenException',
+    'KMS.AccessDeniedException',
+)
+THROTTLING_ERROR_CODES = (
+    'ThrottlingException',
+    'Throttling',
+    'TooManyUpdates',
+    'RequestLimitExceeded',
+)
+TRANSIENT_ERROR_CODES = (
+    'InternalServerError',
+    'InternalFailure',
+    'ServiceUnavailable',
+)
+
+
+def get_error_code(e):
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code')
+    return None
+
+
+def is_throttling(e):
+    return get_error_code(e) in THROTTLING_ERROR_CODES
+
+
+def is_transient(e):
+    '''
+    Errors worth retrying for calls which can safely be sent twice.
+    '''
+    if isinstance(e, BotoConnectionError):
+        return True
+    if isinstance(e, ClientError):
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return get_error_code(e) in TRANSIENT_ERROR_CODES or status >= 500
     return False
 
 
-def set_cached_password(vault_id, password):
-    with open(os.path.join(gettempdir(), md5(vault_id.encode()).hexdigest()), 'w+') as cached:
-        password = cached.write(password)
+def classify_error(e):
+    '''
+    Translate boto errors meaning an id is not usable into keyring exceptions.
+    '''
+    if isinstance(e, (NoCredentialsError, ProfileNotFound)):
+        return KeyringAccessDeniedException(str(e))
+    if isinstance(e, ClientError):
+        code = get_error_code(e)
+        if code in NOT_FOUND_ERROR_CODES:
+            return KeyringNotFoundException(str(e))
+        if code in ACCESS_DENIED_ERROR_CODES:
+            return KeyringAccessDeniedException(str(e))
+        if code in THROTTLING_ERROR_CODES:
+            return KeyringThrottlingException(str(e))
+
+    return e
+
+
+def get_ssm_client(account, region, timeout=None):
+    '''
+    Return the pooled SSM client of a profile, region and timeout, creating
+    it on first use. Clients are thread-safe, sessions are not, so sessions
+    are only used under lock to build clients.
+    '''
+    key = (account, region, timeout or None)
+    client = _ssm_clients.get(key)
+    if client is None:
+        with _ssm_clients_lock:
+            client = _ssm_clients.get(key)
+            if client is None:
+                session = boto3.Session(
+                    profile_name=account,
+                    region_name=region
+                )
+                # call_ssm retries, botocore must not retry on its own
+                config = Config(retries={'max_attempts': 0})
+                if timeout:
+                    config = config.merge(Config(connect_timeout=timeout, read_timeout=timeout))
+                client = session.client('ssm', config=config)
+                _ssm_clients[key] = client
+
+    return client
+
+
+class RateLimiter(object):
+    '''
+    Token bucket of calls to SSM, with a burst of one second (at least one
+    call, for rates below one call per second). Its rate is
+    halved when SSM throttles and grows back by one call per second each
+    second, so concurrent fetches settle under the account quota instead
+    of all retrying at once.
+    '''
+
+    def __init__(self, max_rate):
+        self.max_rate = float(max_rate)
+        self.min_rate = min(1.0, self.max_rate)
+        self.rate = self.max_rate
+        self.tokens = max(1.0, self.max_rate)
+        self.updated = time.time()
+        self.decreased = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        elapsed = max(0.0, now - self.updated)
+        self.updated = now
+        self.rate = min(self.max_rate, self.rate + elapsed)
+        self.tokens = min(max(1.0, self.rate), self.tokens + elapsed * self.rate)
+
+    def acquire(self, deadline=None):
+        '''
+        Wait until a call is allowed. Raise KeyringThrottlingException
+        when it would not be before deadline (a time.time() value).
+        '''
+        while True:
+            with self.lock:
+                now = time.time()
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise KeyringThrottlingException(
+                    'SSM rate limit of {0:g} calls/s leaves no call before the timeout'.format(self.rate)
+                )
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            now = time.time()
+            self.refill(now)
+            # Calls of the same burst are throttled together, decrease once
+            if now - self.decreased < SSM_THROTTLING_WINDOW:
+                return
+            self.decreased = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
 
 
-def get_ssm_client(account, region):
-    boto3.setup_default_session(
-        profile_name=account,
-        region_name=region
-    )
+def get_env_number(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
 
-    return boto3.client('ssm')
 
+def get_rate_limiter(account, region):
+    '''
+    Return the rate limiter of a profile and region, None when rate
+    limiting is disabled.
+    '''
+    key = (account, region)
+    limiter = _rate_limiters.get(key)
+    if limiter is None:
+        with _rate_limiters_lock:
+            if key not in _rate_limiters:
+                rate = get_env_number(SSM_RATE_ENV, SSM_DEFAULT_RATE)
+                _rate_limiters[key] = RateLimiter(rate) if rate > 0 else None
+            limiter = _rate_limiters[key]
 
-def get_ssm_parameter(account, region, ssm_key, asked_version=None):
-    id = account + region + ssm_key + str(asked_version)
-    if get_cached_password(id):
-        value = get_cached_password(id)
+    return limiter
+
+
+def call_ssm(account, region, operation, timeout=None, idempotent=True, **kwargs):
+    '''
+    Call an SSM client method under the rate limit of the profile and
+    region. Throttled calls are retried with jittered exponential backoff,
+    and so are transient errors of idempotent calls, while attempts remain
+    and the next one would start within timeout seconds of the first.
+    Waiting for the rate limit is bounded by the same timeout.
+    '''
+    ssm = get_ssm_client(account, region, timeout)
+    limiter = get_rate_limiter(account, region)
+    max_attempts = max(1, int(get_env_number(SSM_MAX_ATTEMPTS_ENV, SSM_DEFAULT_MAX_ATTEMPTS)))
+    started = time.time()
+    deadline = started + timeout if timeout else None
+    attempt = 0
+    while True:
+        attempt += 1
+        if limiter is not None:
+            limiter.acquire(deadline)
+        try:
+            return getattr(ssm, operation)(**kwargs)
+        except Exception as e:
+            throttled = is_throttling(e)
+            if throttled and limiter is not None:
+                limiter.throttled()
+            if attempt >= max_attempts or not (throttled or (idempotent and is_transient(e))):
+                raise
+            delay = random.uniform(0, min(SSM_BACKOFF_CAP, SSM_BACKOFF_BASE * 2 ** attempt))
+            if timeout and time.time() + delay - started > timeout:
+                raise
+            metrics.increment('ssm_retries', operation=operation, error=get_error_code(e) or type(e).__name__)
+            time.sleep(delay)
+
+
+def get_selector(ssm_key, asked_version=None):
+    '''
+    Return the name:version selector of a parameter version, usable with
+    GetParameter(s), or the name alone for the last version. Return None
+    for other versions (labels), which need a history scan.
+    '''
+    if asked_version is None:
+        return ssm_key
+    if asked_version.isdigit():
+        return ssm_key + CONFIG_SEPARATOR + asked_version
+    return None
+
+
+def paginate_ssm(account, region, operation, timeout=None, **kwargs):
+    '''
+    Yield the Parameters of all pages of an SSM list operation, each page
+    requested through call_ssm.
+    '''
+    while True:
+        response = call_ssm(account, region, operation, timeout, **kwargs)
+        for parameter in response.get('Parameters', []):
+            yield parameter
+        if not response.get('NextToken'):
+            return
+        kwargs['NextToken'] = response['NextToken']
+
+
+def get_ssm_parameter(account, region, ssm_key, asked_version=None, timeout=None):
+    selector = get_selector(ssm_key, asked_version)
+    if selector is not None:
+        response = call_ssm(
+            account, region, 'get_parameter', timeout,
+            Name=selector,
+            WithDecryption=True
+        )
+        value = response['Parameter']['Value']
     else:
-        ssm = get_ssm_client(account, region)
+        # Scan the history only when no selector matches the asked version
+        value = None
+        for key_data in paginate_ssm(account, region, 'get_parameter_history', timeout,
+                                     Name=ssm_key, WithDecryption=True):
+            if asked_version in (key_data.get('Labels') or []):
+                value = key_data['Value']
 
-        if asked_version is None:
-            response = ssm.get_parameter(
-                Name=ssm_key,
-                WithDecryption=True
-            )
-            value = response['Parameter']['Value']
-        else:
-            paginator = ssm.get_paginator('get_parameter_history')
-            page_iterator = paginator.paginate(
-                Name=ssm_key,
+    if (value is None):
+        raise KeyringNotFoundException('Parameter not found on SSM')
+
+    return value
+
+
+def get_ssm_parameters(account, region, selectors, timeout=None):
+    '''
+    Fetch several parameters with GetParameters calls, selectors are names
+    for last versions or name:version, see get_selector.
+
+    Return a dict mapping each selector to its value, or to the exception
+    raised while fetching it.
+    '''
+    values = {}
+    missing_keys = list(OrderedDict.fromkeys(selectors))
+    for i in range(0, len(missing_keys), SSM_BATCH_SIZE):
+        chunk = missing_keys[i:i + SSM_BATCH_SIZE]
+        try:
+            response = call_ssm(
+                account, region, 'get_parameters', timeout,
+                Names=chunk,
                 WithDecryption=True
             )
-            filtered_iterator = page_iterator.search(
-                "Parameters[?Version==`" + asked_version + "`]"
-            )
-            value = None
-            for key_data in filtered_iterator:
-                value = key_data['Value']
+        except Exception as e:
+            for ssm_key in chunk:
+                values[ssm_key] = classify_error(e)
+            continue
 
-        if (value is None):
-            raise Exception('Parameter not found on SSM')
+        for parameter in response['Parameters']:
+            # Parameters fetched with a selector have it in Selector (":3"),
+            # the Name being the bare parameter name
+            selector = (parameter.get('Selector') or '').lstrip(CONFIG_SEPARATOR)
+            key = parameter['Name'] + (CONFIG_SEPARATOR + selector if selector else '')
+            if key not in chunk:
+                key = parameter['Name'] + CONFIG_SEPARATOR + str(parameter['Version'])
+            values[key] = parameter['Value']
+        for ssm_key in chunk:
+            if ssm_key not in values:
+                values[ssm_key] = KeyringNotFoundException('Parameter not found on SSM: ' + ssm_key)
 
-        set_cached_password(id, value)
+    return values
 
-    return value
+
+def describe_ssm_parameters(account, region, ssm_keys, timeout=None):
+    '''
+    Return a dict mapping each existing key to its last version, using
+    DescribeParameters which neither reads nor decrypts values.
+    '''
+    versions = {}
+    ssm_keys = list(OrderedDict.fromkeys(ssm_keys))
+    for i in range(0, len(ssm_keys), SSM_DESCRIBE_BATCH_SIZE):
+        parameters = paginate_ssm(
+            account, region, 'describe_parameters', timeout,
+            ParameterFilters=[{
+                'Key': 'Name',
+                'Option': 'Equals',
+                'Values': ssm_keys[i:i + SSM_DESCRIBE_BATCH_SIZE]
+            }]
+        )
+        for parameter in parameters:
+            versions[parameter['Name']] = parameter['Version']
+
+    return versions
 
 
 class KeyringPlugin(BaseKeyringPlugin):
+    batch_size = SSM_BATCH_SIZE
 
     def parse_vault_id(self, vault_id):
         vault_id = vault_id.split(CONFIG_SEPARATOR)
@@ -90,36 +375,130 @@ class KeyringPlugin(BaseKeyringPlugin):
 
     def fetch(self, vault_id):
         account, region, ssm_key, asked_version = self.parse_vault_id(vault_id)
-        return get_ssm_parameter(account, region, ssm_key, asked_version)
+        try:
+            return get_ssm_parameter(account, region, ssm_key, asked_version, self.timeout)
+        except Exception as e:
+            raise classify_error(e)
+
+    def split_batches(self, vault_ids):
+        '''
+        Group ids sharing the same profile and region in GetParameters sized
+        batches. Ids pinned to a label are fetched one by one.
+        '''
+        batches = []
+        grouped_ids = OrderedDict()
+        for vault_id in vault_ids:
+            account, region, ssm_key, asked_version = self.parse_vault_id(vault_id)
+            if get_selector(ssm_key, asked_version) is not None:
+                grouped_ids.setdefault((account, region), []).append(vault_id)
+            else:
+                batches.append([vault_id])
+
+        for ids in grouped_ids.values():
+            batches += [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+
+        return batches
+
+    def fetch_many(self, vault_ids):
+        passwords = {}
+        grouped_keys = OrderedDict()
+        for vault_id in vault_ids:
+            try:
+                account, region, ssm_key, asked_version = self.parse_vault_id(vault_id)
+                selector = get_selector(ssm_key, asked_version)
+                if selector is not None:
+                    grouped_keys.setdefault((account, region), []).append((vault_id, selector))
+                else:
+                    passwords[vault_id] = get_ssm_parameter(account, region, ssm_key, asked_version, self.timeout)
+            except Exception as e:
+                passwords[vault_id] = classify_error(e)
+
+        for (account, region), keys in grouped_keys.items():
+            values = get_ssm_parameters(account, region, [selector for vault_id, selector in keys], self.timeout)
+            for vault_id, selector in keys:
+                passwords[vault_id] = values[selector]
+
+        return passwords
+
+    def probe(self, vault_ids):
+        '''
+        Check parameters exist with DescribeParameters. It does not check
+        GetParameter nor KMS permissions, so an id may still fail at fetch.
+        '''
+        results = {}
+        grouped_ids = OrderedDict()
+        for vault_id in vault_ids:
+            try:
+                account, region, ssm_key, asked_version = self.parse_vault_id(vault_id)
+                grouped_ids.setdefault((account, region), []).append((vault_id, ssm_key, asked_version))
+            except Exception as e:
+                results[vault_id] = e
+
+        for (account, region), ids in grouped_ids.items():
+            try:
+                ssm_keys = [ssm_key for vault_id, ssm_key, asked_version in ids]
+                versions = describe_ssm_parameters(account, region, ssm_keys, self.timeout)
+            except Exception as e:
+                for vault_id, ssm_key, asked_version in ids:
+                    results[vault_id] = classify_error(e)
+                continue
+            for vault_id, ssm_key, asked_version in ids:
+                if ssm_key not in versions:
+                    results[vault_id] = KeyringNotFoundException('Parameter not found on SSM: ' + ssm_key)
+                elif asked_version is not None and asked_version.isdigit() \
+                        and int(asked_version) > versions[ssm_key]:
+                    results[vault_id] = KeyringNotFoundException(
+                        'Parameter version not found on SSM: ' + ssm_key + ':' + asked_version
+                    )
+                else:
+                    results[vault_id] = True
+
+        return results
 
     def set_password(self, id, password):
         account, region, ssm_key, asked_version = self.parse_vault_id(id)
 
-        ssm = get_ssm_client(account, region)
-        response = ssm.put_parameter(
-            Name=ssm_key,
-            Overwrite=True,
-            Type='SecureString',
-            Value=password
-        )
-        ssm.add_tags_to_resource(
-            ResourceType='Parameter',
-            ResourceId=ssm_key,
-            Tags=[
-               {
-                  "Key": "CreatedBy",
-                  "Value": "ansible-vault-manager"
-               },
-               {
-                  "Key":"CalledBy",
-                  "Value": getpass.getuser()
-               }
-            ]
-        )
+        try:
+            # A put answered with a transient error may have been applied,
+            # only throttled puts are retried
+            response = call_ssm(
+                account, region, 'put_parameter', self.timeout, idempotent=False,
+                Name=ssm_key,
+                Overwrite=True,
+                Type='SecureString',
+                Value=password
+            )
+            call_ssm(
+                account, region, 'add_tags_to_resource', self.timeout,
+                ResourceType='Parameter',
+                ResourceId=ssm_key,
+                Tags=[
+                   {
+                      "Key": "CreatedBy",
+                      "Value": "ansible-vault-manager"
+                   },
+                   {
+                      "Key":"CalledBy",
+                      "Value": getpass.getuser()
+                   }
+                ]
+            )
+        except Exception as e:
+            raise classify_error(e)
         new_version = str(response['Version'])
         return new_version
 
+    def delete_password(self, id):
+        account, region, ssm_key, asked_version = self.parse_vault_id(id)
+
+        try:
+            call_ssm(account, region, 'delete_parameter', self.timeout, Name=ssm_key)
+        except Exception as e:
+            raise classify_error(e)
+
     def generate_id(self, plugin_vars=None):
+        import uuid
+        from builtins import input
         params = {}
         if plugin_vars is not None:
             params = self.parse_plugin_vars(plugin_vars)
@@ -141,5 +520,13 @@ class KeyringPlugin(BaseKeyringPlugin):
         self.id = CONFIG_SEPARATOR.join([aws_account, aws_region, aws_scope + str(uuid.uuid4())])
         return self.id
 
-    def append_id_version(self, new_version):
-        return self.id + ('' if new_version is None else CONFIG_SEPARATOR + str(new_version))
+    def derive_id(self, id):
+        import uuid
+        account, region, ssm_key, asked_version = self.parse_vault_id(id)
+        path = ssm_key.rsplit('/', 1)[0] + '/' if '/' in ssm_key else ''
+        return CONFIG_SEPARATOR.join([account, region, path + str(uuid.uuid4())])
+
+    def append_id_version(self, new_version, id=None):
+        if id is None:
+            id = self.id
+        return id + ('' if new_version is None else CONFIG_SEPARATOR + str(new_version))
@@ -1,23 +1,207 @@
 from __future__ import print_function
 import os.path
-from builtins import input
-import uuid
+import errno
+import struct
+import threading
 
-from . import BaseKeyringPlugin, KeyringException
+from . import BaseKeyringPlugin, KeyringException, KeyringNotFoundException, KeyringAccessDeniedException
 
 CONFIG_SEPARATOR = ':'
 
 '''
-Vault ID format : 
+Vault ID format :
 [basepath]:[file]:[version]
+
+Passwords are stored in [basepath]/[file].[version] files, or in the
+keystore file of basepath when it exists (see migrate_keystore): a single
+file read with one open, which matters on network mounts.
+
+Keystore layout, integers are big endian:
+  header: magic (8 bytes), committed data end (8 bytes), record count (8 bytes)
+  records: version (4 bytes), name length (2 bytes), value length (4 bytes),
+           name, value. Removed versions have a 0xFFFFFFFF value length and
+           no value.
+Records are only appended, under an exclusive lock, and the header is
+updated once they are synced: readers never use data after the committed
+end, so they don't need the lock.
 '''
 
+KEYSTORE_FILE = '.ansible-vault-manager.keystore'
+KEYSTORE_MAGIC = b'AVMKS\x00\x00\x01'
+KEYSTORE_HEADER = struct.Struct('>8sQQ')
+KEYSTORE_RECORD = struct.Struct('>IHI')
+KEYSTORE_TOMBSTONE = 0xFFFFFFFF
+
+# Parsed keystores of the process: path -> (stat signature, index)
+_keystores = {}
+_keystores_lock = threading.Lock()
+
+
+def get_keystore_path(basepath):
+    return os.path.join(basepath, KEYSTORE_FILE)
+
+
+def parse_keystore(content):
+    '''
+    Return the index of a keystore content (bytes or mmap), mapping each
+    (name, version) to its password, or None for removed versions.
+    '''
+    if len(content) < KEYSTORE_HEADER.size:
+        raise KeyringException('Truncated keystore header')
+    magic, data_end, record_count = KEYSTORE_HEADER.unpack_from(content, 0)
+    if magic != KEYSTORE_MAGIC:
+        raise KeyringException('Not a keystore file, or unsupported keystore version')
+
+    index = {}
+    offset = KEYSTORE_HEADER.size
+    for i in range(record_count):
+        version, name_length, value_length = KEYSTORE_RECORD.unpack_from(content, offset)
+        offset += KEYSTORE_RECORD.size
+        name = content[offset:offset + name_length].decode('utf-8')
+        offset += name_length
+        if value_length == KEYSTORE_TOMBSTONE:
+            index[(name, version)] = None
+            continue
+        index[(name, version)] = content[offset:offset + value_length].decode('utf-8')
+        offset += value_length
+    if offset != data_end:
+        raise KeyringException('Corrupted keystore, records do not match header')
+
+    return index
+
+
+def read_keystore(basepath):
+    '''
+    Return the index of the keystore of basepath, None when there is none.
+    Indexes are kept in memory while the file is unchanged.
+    '''
+    import mmap
+    path = get_keystore_path(basepath)
+    try:
+        stream = open(path, 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        if e.errno in (errno.EACCES, errno.EPERM):
+            raise KeyringAccessDeniedException(str(e))
+        raise
+
+    with stream:
+        stat = os.fstat(stream.fileno())
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime)
+        cached = _keystores.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        if stat.st_size == 0:
+            return {}
+        content = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            index = parse_keystore(content)
+        finally:
+            content.close()
+
+    with _keystores_lock:
+        _keystores[path] = (signature, index)
+    return index
+
+
+def append_keystore(basepath, records, mode=0o600):
+    '''
+    Append (name, version, password) records to the keystore of basepath,
+    creating it with mode if needed. password None removes a version.
+    Existing versions can't be overridden.
+    '''
+    from ..cache import FileLock
+    path = get_keystore_path(basepath)
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT, mode))
+    with FileLock(path):
+        with open(path, 'r+b') as stream:
+            content = stream.read()
+            if content:
+                index = parse_keystore(content)
+                magic, data_end, record_count = KEYSTORE_HEADER.unpack_from(content, 0)
+            else:
+                index = {}
+                data_end, record_count = KEYSTORE_HEADER.size, 0
+
+            data = b''
+            for name, version, password in records:
+                if password is not None and index.get((name, int(version))) is not None:
+                    raise KeyringException(
+                        "You can't override an existing version ({0}:{1}) ! Increment version before.".format(
+                            name, version
+                        )
+                    )
+                name = name.encode('utf-8')
+                if password is None:
+                    data += KEYSTORE_RECORD.pack(int(version), len(name), KEYSTORE_TOMBSTONE) + name
+                else:
+                    value = password.encode('utf-8')
+                    data += KEYSTORE_RECORD.pack(int(version), len(name), len(value)) + name + value
+                record_count += 1
+
+            # Data after the committed end is a write interrupted before
+            # its header update, it is overwritten
+            stream.seek(data_end)
+            stream.write(data)
+            stream.truncate()
+            stream.flush()
+            os.fsync(stream.fileno())
+            stream.seek(0)
+            stream.write(KEYSTORE_HEADER.pack(KEYSTORE_MAGIC, data_end + len(data), record_count))
+            stream.flush()
+            os.fsync(stream.fileno())
+
+
+def migrate_keystore(basepath):
+    '''
+    Copy [file].[version] password files of basepath to its keystore,
+    creating it. Files are left in place, the keystore is read first.
+
+    The keystore is a single file with one owner and mode: it is created
+    with the most restrictive mode of the copied files, and per file
+    ownership or ACLs are not carried over. Unreadable files are skipped.
+
+    Return the number of copied passwords, and a dict mapping skipped
+    files to the exception raised reading them.
+    '''
+    index = read_keystore(basepath) or {}
+    records = []
+    skipped = {}
+    mode = 0o666
+    for filename in sorted(os.listdir(basepath)):
+        name, extension = os.path.splitext(filename)
+        filepath = os.path.join(basepath, filename)
+        if filename.startswith('.') or not extension[1:].isdigit() or not os.path.isfile(filepath):
+            continue
+        if (name, int(extension[1:])) in index:
+            continue
+        try:
+            with open(filepath, 'r') as file:
+                records.append((name, int(extension[1:]), file.read()))
+                mode &= os.fstat(file.fileno()).st_mode
+        except IOError as e:
+            if e.errno in (errno.EACCES, errno.EPERM):
+                e = KeyringAccessDeniedException('Permission denied: ' + filepath)
+            skipped[filepath] = e
+
+    append_keystore(basepath, records, mode & 0o666 if records else 0o600)
+    return len(records), skipped
+
 
 class KeyringPlugin(BaseKeyringPlugin):
-    def append_id_version(self, new_version):
-        return self.id + ('' if new_version is None else CONFIG_SEPARATOR + str(new_version))
+    # Ids of a basepath are resolved with a single keystore read, see
+    # fetch_many
+    batch_size = 100
+
+    def append_id_version(self, new_version, id=None):
+        if id is None:
+            id = self.id
+        return id + ('' if new_version is None else CONFIG_SEPARATOR + str(new_version))
 
     def generate_id(self, plugin_vars=None):
+        import uuid
+        from builtins import input
         params = {}
         if plugin_vars is not None:
             params = self.parse_plugin_vars(plugin_vars)
@@ -25,11 +209,16 @@ class KeyringPlugin(BaseKeyringPlugin):
         if 'basepath' not in params:
             basepath = input('Base path (ex. /mnt/secrets/myproject/): ')
         else:
-            basepath = params['path']
-        
+            basepath = params['basepath']
+
         self.id = CONFIG_SEPARATOR.join([basepath, str(uuid.uuid4())])
         return self.id
 
+    def derive_id(self, id):
+        import uuid
+        basepath, filename, asked_version = self.parse_vault_id(id)
+        return CONFIG_SEPARATOR.join([basepath, str(uuid.uuid4())])
+
     def parse_vault_id(self, vault_id):
         vault_id = vault_id.split(CONFIG_SEPARATOR)
         basepath = vault_id[0]
@@ -40,14 +229,116 @@ class KeyringPlugin(BaseKeyringPlugin):
 
         return (basepath, filename, asked_version)
 
-    def fetch(self, vault_id):
+    def get_filepath(self, vault_id):
         basepath, filename, asked_version = self.parse_vault_id(vault_id)
         if asked_version is None:
             asked_version = 1
-        filepath = os.path.join(basepath, filename + '.' + str(asked_version))
-        with open(filepath, 'r') as file:
-            password = file.read()
-        
+        return os.path.join(basepath, filename + '.' + str(asked_version))
+
+    def get_keystore_key(self, vault_id):
+        basepath, filename, asked_version = self.parse_vault_id(vault_id)
+        if asked_version is None:
+            asked_version = 1
+        return (filename, int(asked_version))
+
+    def split_batches(self, vault_ids):
+        '''
+        Group ids sharing the same basepath.
+        '''
+        grouped_ids = {}
+        for vault_id in vault_ids:
+            grouped_ids.setdefault(self.parse_vault_id(vault_id)[0], []).append(vault_id)
+
+        batches = []
+        for ids in grouped_ids.values():
+            batches += [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+        return batches
+
+    def read_keystores(self, vault_ids):
+        '''
+        Return the keystore index of each basepath of vault_ids, None for
+        basepaths without keystore, or the exception raised reading it.
+        '''
+        keystores = {}
+        for vault_id in vault_ids:
+            basepath = self.parse_vault_id(vault_id)[0]
+            if basepath in keystores:
+                continue
+            try:
+                keystores[basepath] = read_keystore(basepath)
+            except Exception as e:
+                keystores[basepath] = e
+
+        return keystores
+
+    def probe(self, vault_ids):
+        results = {}
+        keystores = self.read_keystores(vault_ids)
+        for vault_id in vault_ids:
+            try:
+                keystore = keystores[self.parse_vault_id(vault_id)[0]]
+                if isinstance(keystore, Exception):
+                    raise keystore
+                key = self.get_keystore_key(vault_id)
+            except Exception as e:
+                results[vault_id] = e
+                continue
+            if keystore is not None and key in keystore:
+                if keystore[key] is None:
+                    results[vault_id] = KeyringNotFoundException('Password removed from keystore: ' + vault_id)
+                else:
+                    results[vault_id] = True
+                continue
+
+            filepath = self.get_filepath(vault_id)
+            if os.access(filepath, os.R_OK):
+                results[vault_id] = True
+            elif os.path.exists(filepath):
+                results[vault_id] = KeyringAccessDeniedException('Permission denied: ' + filepath)
+            else:
+                results[vault_id] = KeyringNotFoundException('No such file: ' + filepath)
+
+        return results
+
+    def fetch_many(self, vault_ids):
+        passwords = {}
+        keystores = self.read_keystores(vault_ids)
+        for vault_id in vault_ids:
+            try:
+                keystore = keystores[self.parse_vault_id(vault_id)[0]]
+                if isinstance(keystore, Exception):
+                    raise keystore
+                passwords[vault_id] = self.fetch_from(vault_id, keystore)
+            except Exception as e:
+                passwords[vault_id] = e
+
+        return passwords
+
+    def fetch(self, vault_id):
+        return self.fetch_from(vault_id, read_keystore(self.parse_vault_id(vault_id)[0]))
+
+    def fetch_from(self, vault_id, keystore):
+        '''
+        Return the password of vault_id from the keystore index of its
+        basepath, or from its password file when missing from it.
+        '''
+        key = self.get_keystore_key(vault_id)
+        if keystore is not None and key in keystore:
+            if keystore[key] is None:
+                raise KeyringNotFoundException('Password removed from keystore: ' + vault_id)
+            return keystore[key]
+
+        filepath = self.get_filepath(vault_id)
+        try:
+            with open(filepath, 'r') as file:
+                password = file.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyringNotFoundException(str(e))
+            if e.errno in (errno.EACCES, errno.EPERM):
+                raise KeyringAccessDeniedException(str(e))
+            raise
+
         return password
 
     def set_password(self, id, password):
@@ -56,8 +347,12 @@ class KeyringPlugin(BaseKeyringPlugin):
         if asked_version is None:
             new_version = 1
         else:
-            new_version = asked_version + 1
-        
+            new_version = int(asked_version) + 1
+
+        if read_keystore(basepath) is not None:
+            append_keystore(basepath, [(filename, new_version, password)])
+            return new_version
+
         new_filepath = os.path.join(basepath, filename + '.' + str(new_version))
         if os.path.exists(new_filepath):
             raise KeyringException(
@@ -67,4 +362,31 @@ class KeyringPlugin(BaseKeyringPlugin):
         with open(new_filepath, 'w') as file:
             file.write(password)
 
-        return new_version
\ No newline at end of file
+        return new_version
+
+    def delete_password(self, id):
+        basepath, filename, asked_version = self.parse_vault_id(id)
+        if read_keystore(basepath) is not None:
+            append_keystore(basepath, [(filename, asked_version or 1, None)])
+            return
+
+        filepath = self.get_filepath(id)
+        try:
+            os.remove(filepath)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyringNotFoundException(str(e))
+            raise
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3 or sys.argv[1] != 'migrate':
+        print('Usage: python -m ansible_vault_manager.keyring_plugins.local_fs migrate BASEPATH', file=sys.stderr)
+        sys.exit(2)
+    count, skipped = migrate_keystore(sys.argv[2])
+    for filepath, error in sorted(skipped.items()):
+        print('Skipped ' + filepath + ': ' + str(error), file=sys.stderr)
+    print('{0} passwords copied to {1}'.format(count, get_keystore_path(sys.argv[2])))
+    if skipped:
+        sys.exit(1)
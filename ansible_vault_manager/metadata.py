@@ -0,0 +1,446 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os.path
+from collections import OrderedDict
+
+METADATA_FILE = '_metadata.yml'
+METADATA_PLUGIN_KEY = 'plugin'
+METADATA_ID_KEY = 'id'
+METADATA_VAULT_FILES = 'files'
+METADATA_INCLUDE_KEY = 'include'
+METADATA_IDS_KEY = 'vault_ids'
+
+SNAPSHOT_VERSION = 2
+# Files modified this close to a snapshot build are checked by content, as
+# filesystem mtime resolution may hide a later change
+MTIME_GRACE = 2
+
+
+class MetadataException(Exception):
+    pass
+
+
+def file_signature(path, content=None):
+    import hashlib
+    stat = os.stat(path)
+    if content is None:
+        with open(path, 'rb') as stream:
+            content = stream.read()
+    return {
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'sha256': hashlib.sha256(content).hexdigest(),
+    }
+
+
+def load_metadata_file(metadata_file, content=None):
+    import yaml
+    if content is None:
+        with open(metadata_file, 'rb') as stream:
+            content = stream.read()
+    # libyaml based loader is an order of magnitude faster when available
+    vault_metadata = yaml.load(content, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+    if vault_metadata is None:
+        vault_metadata = {}
+    if not isinstance(vault_metadata, dict):
+        raise MetadataException('Metadata file ' + metadata_file + ' is not a mapping')
+
+    return vault_metadata
+
+
+def dump_metadata(data):
+    import yaml
+    return yaml.safe_dump(data, default_flow_style=False)
+
+
+class MetadataTransaction(object):
+    '''
+    Read-modify-write of a single metadata file, its includes are left
+    alone. Writers are serialized with an exclusive lock on the file, and
+    changes replace it atomically on exit, unless an exception was raised.
+
+        with MetadataTransaction(metadata_file) as transaction:
+            transaction.append_ids([{'plugin': ..., 'id': ..., 'files': [...]}])
+
+    Ids only appended to a block style vault_ids list ending the file are
+    written as text after the current content, so the file is not parsed
+    nor dumped again and keeps its comments and layout.
+    '''
+
+    def __init__(self, metadata_file):
+        self.metadata_file = metadata_file
+        self.fd = None
+        self.content = None
+        self.appended = []
+        self._metadata = None
+
+    def __enter__(self):
+        from .cache import fcntl
+        while True:
+            fd = os.open(self.metadata_file, os.O_RDWR | os.O_CREAT, 0o666)
+            if fcntl is None:
+                break
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # The previous lock holder may have replaced the file meanwhile
+            try:
+                if os.path.samestat(os.fstat(fd), os.stat(self.metadata_file)):
+                    break
+            except OSError:
+                pass
+            os.close(fd)
+
+        self.fd = fd
+        with os.fdopen(os.dup(fd), 'rb') as stream:
+            self.content = stream.read()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+    @property
+    def metadata(self):
+        '''
+        Parsed content of the file, changes made to it are written on commit.
+        '''
+        if self._metadata is None:
+            self._metadata = load_metadata_file(self.metadata_file, self.content)
+        return self._metadata
+
+    def append_ids(self, entries):
+        self.appended += entries
+
+    def append_content(self):
+        '''
+        Return the file content with appended ids, or None when the file
+        layout does not allow a text append.
+        '''
+        import re
+        text = self.content.decode('utf-8')
+        if not text.strip():
+            return dump_metadata({METADATA_IDS_KEY: self.appended})
+
+        lines = text.splitlines()
+        for position in range(len(lines) - 1, -1, -1):
+            line = lines[position]
+            if line.strip() and not line.startswith((' ', '\t', '-', '#')):
+                break
+        else:
+            return None
+        if not re.match(r'^' + METADATA_IDS_KEY + r':\s*(#.*)?$', line):
+            return None
+
+        items = [item for item in lines[position + 1:] if item.strip() and not item.lstrip().startswith('#')]
+        if not items or not items[0].lstrip().startswith('-'):
+            return None
+        indent = items[0][:len(items[0]) - len(items[0].lstrip())]
+
+        appended = ''.join(indent + line + '\n' for line in dump_metadata(self.appended).splitlines())
+        if not text.endswith('\n'):
+            text += '\n'
+        return text + appended
+
+    def commit(self):
+        from .cache import atomic_write
+        content = None
+        if self._metadata is None:
+            if not self.appended:
+                return
+            content = self.append_content()
+        if content is None:
+            metadata = self.metadata
+            metadata[METADATA_IDS_KEY] = list(metadata.get(METADATA_IDS_KEY) or []) + self.appended
+            content = dump_metadata(metadata)
+
+        atomic_write(self.metadata_file, content.encode('utf-8'), os.fstat(self.fd).st_mode & 0o777)
+
+
+def merge_vault_ids(vault_ids, other_ids):
+    '''
+    Append other_ids to vault_ids, entries sharing plugin and id are merged
+    into the first one and their files lists joined.
+    '''
+    known = dict(((id.get(METADATA_PLUGIN_KEY), id.get(METADATA_ID_KEY)), id) for id in vault_ids)
+    for id in other_ids:
+        key = (id.get(METADATA_PLUGIN_KEY), id.get(METADATA_ID_KEY))
+        if key not in known:
+            known[key] = dict(id)
+            vault_ids.append(known[key])
+            continue
+
+        files = id.get(METADATA_VAULT_FILES) or []
+        if files:
+            merged_files = list(known[key].get(METADATA_VAULT_FILES) or [])
+            merged_files += [file for file in files if file not in merged_files]
+            known[key][METADATA_VAULT_FILES] = merged_files
+
+    return vault_ids
+
+
+def rebase_vault_ids(vault_ids, from_dir, to_dir):
+    '''
+    Return vault_ids with their files, relative to from_dir, made relative
+    to to_dir. Entries with files are copied, not changed.
+    '''
+    if from_dir == to_dir:
+        return vault_ids
+
+    rebased = []
+    for id in vault_ids:
+        files = id.get(METADATA_VAULT_FILES)
+        if files:
+            id = dict(id)
+            id[METADATA_VAULT_FILES] = [
+                os.path.normpath(os.path.relpath(os.path.join(from_dir, file), to_dir)) for file in files
+            ]
+        rebased.append(id)
+
+    return rebased
+
+
+class FileIndex(object):
+    '''
+    Inverted index from vault files to the metadata entries protecting them.
+
+    header_ids optionally maps vault files to the (plugin, id) named by
+    their header, see vault_index.HeaderIndex: files are then also mapped
+    to the entry of that id, listed in its files or not, first.
+    '''
+
+    def __init__(self, vault_ids, header_ids=None):
+        self.vault_ids = vault_ids
+        self.ids_by_file = OrderedDict()
+        self.files_by_id = []
+        for position, id in enumerate(vault_ids):
+            files = [os.path.normpath(file) for file in id.get(METADATA_VAULT_FILES) or []]
+            self.files_by_id.append(files)
+            for file in files:
+                self.ids_by_file.setdefault(file, []).append(position)
+
+        positions = {}
+        for position, id in enumerate(vault_ids):
+            positions.setdefault((id.get(METADATA_PLUGIN_KEY), id.get(METADATA_ID_KEY)), position)
+        for file, key in sorted((header_ids or {}).items()):
+            position = positions.get(key)
+            if position is None:
+                continue
+            file_positions = self.ids_by_file.setdefault(file, [])
+            if position in file_positions:
+                file_positions.remove(position)
+            file_positions.insert(0, position)
+            if file not in self.files_by_id[position]:
+                self.files_by_id[position].append(file)
+
+        # Entries without files could protect anything
+        self.unmapped = [position for position, files in enumerate(self.files_by_id) if not files]
+
+    def get_ids(self, file):
+        '''
+        Return entries protecting file, the one named by its header first.
+        '''
+        return [self.vault_ids[position] for position in self.ids_by_file.get(os.path.normpath(file), [])]
+
+    def match_files(self, patterns=None, groups=None):
+        '''
+        Return files matching any path pattern, or whose name without
+        extension or a parent directory name matches any group pattern,
+        so group_vars/<group>.yml and group_vars/<group>/vault.yml both
+        belong to <group>.
+        '''
+        import fnmatch
+        matched = []
+        for file in self.ids_by_file:
+            directories, filename = os.path.split(file)
+            names = [os.path.splitext(filename)[0]] + [name for name in directories.split(os.sep) if name]
+            if any(fnmatch.fnmatch(file, pattern) for pattern in patterns or []) \
+                    or any(fnmatch.fnmatch(name, group) for group in groups or [] for name in names):
+                matched.append(file)
+
+        return matched
+
+    def filter(self, patterns=None, groups=None):
+        '''
+        Return entries protecting files matched by patterns or groups, in
+        metadata order. Entries without files are always kept.
+        '''
+        positions = set(self.unmapped)
+        for file in self.match_files(patterns, groups):
+            positions.update(self.ids_by_file[file])
+
+        return [id for position, id in enumerate(self.vault_ids) if position in positions]
+
+
+class MetadataResolver(object):
+    '''
+    Load a metadata file and all its includes. Each file is parsed at most
+    once, files included through several paths contribute their vault ids
+    once, and include cycles raise a MetadataException.
+
+    Files of an entry are relative to the directory of the metadata file
+    defining it, they are made relative to the directory of the including
+    file when merged, so resolved files are all relative to the root.
+    '''
+
+    def __init__(self, parsed=None):
+        self.parsed = dict(parsed or {})
+        self.resolved = {}
+        # Signatures of files parsed by this resolver, None for missing files
+        self.sources = {}
+
+    def parse(self, metadata_file):
+        if metadata_file not in self.parsed:
+            with open(metadata_file, 'rb') as stream:
+                content = stream.read()
+            self.sources[metadata_file] = file_signature(metadata_file, content)
+            self.parsed[metadata_file] = load_metadata_file(metadata_file, content)
+        return self.parsed[metadata_file]
+
+    def resolve(self, metadata_file, stack=()):
+        metadata_file = os.path.realpath(metadata_file)
+        if metadata_file in stack:
+            cycle = list(stack[stack.index(metadata_file):]) + [metadata_file]
+            raise MetadataException('Include cycle detected: ' + ' -> '.join(cycle))
+        if metadata_file in self.resolved:
+            return self.resolved[metadata_file]
+        if not os.path.exists(metadata_file):
+            self.sources[metadata_file] = None
+            return {METADATA_IDS_KEY: []}
+
+        vault_metadata = dict(self.parse(metadata_file))
+        vault_ids = merge_vault_ids([], vault_metadata.get(METADATA_IDS_KEY) or [])
+        for subfile in vault_metadata.get(METADATA_INCLUDE_KEY) or []:
+            subfile = os.path.realpath(os.path.join(os.path.dirname(metadata_file), subfile))
+            metadata = self.resolve(subfile, stack + (metadata_file,))
+            merge_vault_ids(vault_ids, rebase_vault_ids(
+                metadata[METADATA_IDS_KEY], os.path.dirname(subfile), os.path.dirname(metadata_file)
+            ))
+        vault_metadata[METADATA_IDS_KEY] = vault_ids
+
+        self.resolved[metadata_file] = vault_metadata
+        return vault_metadata
+
+
+def get_snapshot_path(metadata_file):
+    import hashlib
+    from .cache import get_cache_dir
+    key = hashlib.sha256(os.path.realpath(metadata_file).encode('utf-8')).hexdigest()
+    return get_cache_dir('metadata', key + '.json')
+
+
+def read_snapshot(snapshot_path):
+    import json
+    try:
+        with open(snapshot_path, 'r') as stream:
+            snapshot = json.load(stream)
+    except (IOError, ValueError):
+        return None
+
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+
+    return snapshot
+
+
+def get_metadata_sources(metadata_file):
+    '''
+    Return the existing files metadata_file resolved from (itself and its
+    includes), as recorded by its snapshot.
+    '''
+    metadata_file = os.path.realpath(metadata_file)
+    snapshot = read_snapshot(get_snapshot_path(metadata_file))
+    if snapshot is None:
+        return [metadata_file]
+
+    return sorted(path for path, source in snapshot['sources'].items() if source is not None)
+
+
+def check_source(path, signature, created):
+    '''
+    Check a snapshot source against the file on disk, by mtime and size
+    first, by content hash when they differ or the mtime is too recent.
+
+    Return the up to date signature, or False when the file changed.
+    '''
+    if signature is None:
+        return False if os.path.exists(path) else None
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != signature['size']:
+        return False
+    if stat.st_mtime == signature['mtime'] and stat.st_mtime < created - MTIME_GRACE:
+        return signature
+
+    try:
+        refreshed = file_signature(path)
+    except (IOError, OSError):
+        return False
+    if refreshed['sha256'] != signature['sha256']:
+        return False
+
+    return refreshed
+
+
+def load_metadata(metadata_file):
+    '''
+    Return resolved metadata of metadata_file and its includes.
+
+    The result is stored in a compiled snapshot in the user cache dir, with
+    signature and parsed content of each source. Next loads reuse it as is
+    while sources are unchanged, and only parse the changed ones otherwise.
+    '''
+    import json
+    import time
+    from .cache import ensure_private_dir, atomic_write
+    metadata_file = os.path.realpath(metadata_file)
+    snapshot_path = get_snapshot_path(metadata_file)
+    snapshot = read_snapshot(snapshot_path)
+
+    parsed = {}
+    signatures = {}
+    if snapshot is not None:
+        up_to_date = True
+        for path, source in snapshot['sources'].items():
+            signature = source and source['signature']
+            checked = check_source(path, signature, snapshot['created'])
+            if checked is False:
+                up_to_date = False
+            elif source is not None:
+                parsed[path] = source['data']
+                signatures[path] = checked
+                up_to_date = up_to_date and checked is signature
+        if up_to_date:
+            return snapshot['metadata']
+
+    created = time.time()
+    resolver = MetadataResolver(parsed)
+    vault_metadata = resolver.resolve(metadata_file)
+
+    sources = {}
+    for path in resolver.resolved:
+        signature = resolver.sources.get(path) or signatures[path]
+        sources[path] = {'signature': signature, 'data': resolver.parsed[path]}
+    for path, signature in resolver.sources.items():
+        if signature is None:
+            sources[path] = None
+
+    try:
+        ensure_private_dir(os.path.dirname(snapshot_path))
+        atomic_write(snapshot_path, json.dumps({
+            'version': SNAPSHOT_VERSION,
+            'root': metadata_file,
+            'created': created,
+            'sources': sources,
+            'metadata': vault_metadata,
+        }, default=str).encode('utf-8'))
+    except (IOError, OSError):
+        # Snapshot is only an optimisation, e.g. home may be read only
+        pass
+
+    return vault_metadata
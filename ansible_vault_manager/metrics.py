@@ -0,0 +1,270 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os
+import sys
+import threading
+import time
+
+'''
+Hot path instrumentation.
+
+Operations (metadata load, plugin import, password fetch, plugin backend
+calls) are timed per labels, and counters kept for cache hits and misses,
+errors and password bytes. Nothing is recorded unless an output is
+selected, by option or environment so that fetch calls made by ansible are
+measured too:
+
+  --timings, ANSIBLE_VAULT_MANAGER_TIMINGS=1
+      summary on stderr
+  --metrics-json FILE, ANSIBLE_VAULT_MANAGER_METRICS_JSON=FILE
+      one JSON line per invocation appended to FILE, - for stderr
+  --metrics-textfile FILE, ANSIBLE_VAULT_MANAGER_METRICS_TEXTFILE=FILE
+      totals of all invocations, in the format of the prometheus node
+      exporter textfile collector
+'''
+
+TIMINGS_ENV = 'ANSIBLE_VAULT_MANAGER_TIMINGS'
+METRICS_JSON_ENV = 'ANSIBLE_VAULT_MANAGER_METRICS_JSON'
+METRICS_TEXTFILE_ENV = 'ANSIBLE_VAULT_MANAGER_METRICS_TEXTFILE'
+PROMETHEUS_PREFIX = 'ansible_vault_manager_'
+INSTRUMENTED_METHODS = ('fetch', 'fetch_many', 'probe', 'set_password', 'delete_password')
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+    def __init__(self, metrics, operation, labels):
+        self.metrics = metrics
+        self.operation = operation
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.operation, self.labels, time.time() - self.start)
+        if exc_type is not None and not issubclass(exc_type, SystemExit):
+            self.metrics.increment('errors', operation=self.operation, error=exc_type.__name__, **dict(self.labels))
+        return False
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels
+    ]
+    return '{' + ','.join(key + '="' + value + '"' for key, value in escaped) + '}'
+
+
+def password_bytes(password):
+    if isinstance(password, (Exception, bool)) or not password:
+        return 0
+    return len(password.encode('utf-8'))
+
+
+class Metrics(object):
+    def __init__(self):
+        self.enabled = False
+        self.summary = False
+        self.json_file = None
+        self.textfile = None
+        self.action = None
+        self.started = time.time()
+        self.reported = False
+        self._lock = threading.Lock()
+        self._calls = threading.local()
+        # (operation, labels) -> [calls, total seconds, max seconds]
+        self.timings = {}
+        # (name, labels) -> value
+        self.counters = {}
+
+    def configure(self, action, summary=False, json_file=None, textfile=None):
+        self.action = action
+        self.summary = summary or os.environ.get(TIMINGS_ENV, '') not in ('', '0')
+        self.json_file = json_file or os.environ.get(METRICS_JSON_ENV) or None
+        self.textfile = textfile or os.environ.get(METRICS_TEXTFILE_ENV) or None
+        self.enabled = bool(self.summary or self.json_file or self.textfile)
+
+    def timer(self, operation, **labels):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, operation, tuple(sorted(labels.items())))
+
+    def record(self, operation, labels, seconds):
+        key = (operation, labels)
+        with self._lock:
+            timing = self.timings.setdefault(key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def increment(self, name, value=1, **labels):
+        if not self.enabled or not value:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def instrument(self, plugin_name, plugin):
+        '''
+        Time the backend calls of a plugin instance and count their errors
+        and password bytes.
+        '''
+        if not self.enabled or getattr(plugin, '_metrics_instrumented', False):
+            return plugin
+        for method in INSTRUMENTED_METHODS:
+            setattr(plugin, method, self.wrap(plugin_name, method, getattr(plugin, method)))
+        plugin._metrics_instrumented = True
+        return plugin
+
+    def wrap(self, plugin_name, method, function):
+        def instrumented(*args, **kwargs):
+            # Calls made by the plugin itself, like fetch by the default
+            # fetch_many, are part of the outer call
+            if getattr(self._calls, 'active', False):
+                return function(*args, **kwargs)
+            self._calls.active = True
+            try:
+                with self.timer('plugin_call', plugin=plugin_name, method=method):
+                    result = function(*args, **kwargs)
+            finally:
+                self._calls.active = False
+            self.count_call(plugin_name, method, args, result)
+            return result
+
+        return instrumented
+
+    def count_call(self, plugin_name, method, args, result):
+        '''
+        Count password bytes and per id errors of a plugin call result.
+        '''
+        if method == 'fetch':
+            self.increment('bytes', password_bytes(result), plugin=plugin_name, direction='fetched')
+        elif method in ('fetch_many', 'probe'):
+            for value in result.values():
+                if isinstance(value, Exception):
+                    self.increment(
+                        'errors', operation='plugin_call', error=type(value).__name__,
+                        plugin=plugin_name, method=method
+                    )
+                else:
+                    self.increment('bytes', password_bytes(value), plugin=plugin_name, direction='fetched')
+        elif method == 'set_password':
+            self.increment('bytes', password_bytes(args[1]), plugin=plugin_name, direction='stored')
+
+    def report(self):
+        '''
+        Write the selected outputs once, at the end of the invocation.
+        Output failures are printed but never fail the command.
+        '''
+        if not self.enabled or self.reported:
+            return
+        self.reported = True
+        self.record('invocation', (('action', str(self.action)),), time.time() - self.started)
+
+        outputs = []
+        if self.summary:
+            outputs.append(lambda: print(self.format_summary(), file=sys.stderr))
+        if self.json_file:
+            outputs.append(self.write_json)
+        if self.textfile:
+            outputs.append(self.write_textfile)
+        for output in outputs:
+            try:
+                output()
+            except (IOError, OSError, ValueError) as e:
+                print('Metrics not written: ' + str(e), file=sys.stderr)
+
+    def format_summary(self):
+        lines = ['{0:<64} {1:>6} {2:>10} {3:>10} {4:>10}'.format('operation', 'calls', 'total', 'mean', 'max')]
+        for (operation, labels), (calls, total, maximum) in sorted(self.timings.items()):
+            lines.append('{0:<64} {1:>6} {2:>9.4f}s {3:>9.4f}s {4:>9.4f}s'.format(
+                operation + format_labels(labels), calls, total, total / calls, maximum
+            ))
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append('{0:<64} {1:>6}'.format(name + format_labels(labels), value))
+
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return {
+            'time': round(self.started, 3),
+            'pid': os.getpid(),
+            'action': self.action,
+            'timings': [
+                {'operation': operation, 'labels': dict(labels), 'calls': calls,
+                 'seconds': round(total, 6), 'max_seconds': round(maximum, 6)}
+                for (operation, labels), (calls, total, maximum) in sorted(self.timings.items())
+            ],
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+        }
+
+    def write_json(self):
+        import json
+        line = json.dumps(self.to_dict(), sort_keys=True) + '\n'
+        if self.json_file == '-':
+            sys.stderr.write(line)
+            return
+        # A single append write, lines of concurrent invocations do not mix
+        fd = os.open(self.json_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def prometheus_samples(self):
+        samples = {}
+        for (operation, labels), (calls, total, maximum) in self.timings.items():
+            name = PROMETHEUS_PREFIX + operation + '_seconds'
+            samples[name + '_sum' + format_labels(labels)] = total
+            samples[name + '_count' + format_labels(labels)] = calls
+        for (name, labels), value in self.counters.items():
+            samples[PROMETHEUS_PREFIX + name + '_total' + format_labels(labels)] = value
+
+        return samples
+
+    def write_textfile(self):
+        '''
+        Add the samples of this invocation to the totals of the textfile,
+        under a lock as invocations run concurrently.
+        '''
+        from .cache import FileLock, atomic_write
+        samples = self.prometheus_samples()
+        with FileLock(self.textfile + '.lock'):
+            try:
+                with open(self.textfile, 'r') as stream:
+                    for line in stream:
+                        if line.startswith('#') or not line.strip():
+                            continue
+                        sample, value = line.rsplit(' ', 1)
+                        samples[sample] = samples.get(sample, 0) + float(value)
+            except IOError:
+                pass
+
+            families = {}
+            for sample, value in samples.items():
+                name = sample.split('{', 1)[0]
+                family = name.rsplit('_', 1)[0] if name.endswith(('_seconds_sum', '_seconds_count')) else name
+                families.setdefault(family, []).append((sample, value))
+
+            lines = []
+            for family, family_samples in sorted(families.items()):
+                lines.append('# TYPE ' + family + (' summary' if family.endswith('_seconds') else ' counter'))
+                lines += [sample + ' ' + repr(float(value)) for sample, value in sorted(family_samples)]
+            atomic_write(self.textfile, ('\n'.join(lines) + '\n').encode('utf-8'), 0o644)
+
+
+metrics = Metrics()
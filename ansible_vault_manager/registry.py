@@ -0,0 +1,129 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os
+import threading
+
+from .keyring_plugins import KeyringException
+
+'''
+Keyring plugins registry.
+
+Plugins are looked up by name, in this order:
+  * built-in modules of the keyring_plugins package
+  * "<name>.py" modules of the plugin path directories
+  * setuptools entry points of the ansible_vault_manager.keyring_plugins group
+
+A plugin module exposes a KeyringPlugin class, an entry point may also
+point directly to the class. Modules are imported on first use only, and a
+single instance of each plugin is shared by the whole process.
+'''
+
+ENTRY_POINT_GROUP = 'ansible_vault_manager.keyring_plugins'
+PLUGIN_PATH_ENV = 'ANSIBLE_VAULT_MANAGER_PLUGIN_PATH'
+BUILTIN_PACKAGE = __name__.rsplit('.', 1)[0] + '.keyring_plugins'
+
+
+def iter_entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(group))
+
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=group))
+    return list(eps.get(group, []))
+
+
+def load_module_from_path(name, path):
+    module_name = 'ansible_vault_manager_plugin_' + name
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError:
+        import imp
+        return imp.load_source(module_name, path)
+
+    spec = spec_from_file_location(module_name, path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class PluginRegistry(object):
+    def __init__(self, plugin_path=None):
+        if plugin_path is None:
+            plugin_path = os.environ.get(PLUGIN_PATH_ENV, '')
+        self.plugin_path = [path for path in plugin_path.split(os.pathsep) if path]
+        self._lock = threading.RLock()
+        self._classes = {}
+        self._instances = {}
+        self._builtins = None
+        self._path_modules = None
+        self._entry_points = None
+
+    def add_plugin_path(self, plugin_path):
+        with self._lock:
+            self.plugin_path += [path for path in plugin_path.split(os.pathsep) if path]
+            self._path_modules = None
+
+    def builtin_names(self):
+        if self._builtins is None:
+            import pkgutil
+            package_dir = os.path.join(os.path.dirname(__file__), 'keyring_plugins')
+            self._builtins = [name for finder, name, ispkg in pkgutil.iter_modules([package_dir])]
+        return self._builtins
+
+    def path_modules(self):
+        if self._path_modules is None:
+            modules = {}
+            for directory in self.plugin_path:
+                if not os.path.isdir(directory):
+                    continue
+                for filename in sorted(os.listdir(directory)):
+                    name, extension = os.path.splitext(filename)
+                    if extension == '.py' and not name.startswith('_') and name not in modules:
+                        modules[name] = os.path.join(directory, filename)
+            self._path_modules = modules
+        return self._path_modules
+
+    def entry_points(self):
+        if self._entry_points is None:
+            entry_points = {}
+            for entry_point in iter_entry_points(ENTRY_POINT_GROUP):
+                entry_points.setdefault(entry_point.name, entry_point)
+            self._entry_points = entry_points
+        return self._entry_points
+
+    def list_plugins(self):
+        names = set(self.builtin_names()) | set(self.path_modules()) | set(self.entry_points())
+        return sorted(names)
+
+    def get_class(self, plugin_name):
+        with self._lock:
+            if plugin_name not in self._classes:
+                self._classes[plugin_name] = self._load_class(plugin_name)
+            return self._classes[plugin_name]
+
+    def _load_class(self, plugin_name):
+        if plugin_name in self.builtin_names():
+            from importlib import import_module
+            return import_module(BUILTIN_PACKAGE + '.' + plugin_name).KeyringPlugin
+
+        if plugin_name in self.path_modules():
+            return load_module_from_path(plugin_name, self.path_modules()[plugin_name]).KeyringPlugin
+
+        # Entry points are only scanned for names not found locally
+        if plugin_name in self.entry_points():
+            loaded = self.entry_points()[plugin_name].load()
+            return getattr(loaded, 'KeyringPlugin', loaded)
+
+        raise KeyringException('Keyring manager client plugin ' + plugin_name + ' not found')
+
+    def get_instance(self, plugin_name):
+        with self._lock:
+            if plugin_name not in self._instances:
+                self._instances[plugin_name] = self.get_class(plugin_name)()
+            return self._instances[plugin_name]
+
+
+registry = PluginRegistry()
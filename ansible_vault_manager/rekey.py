@@ -0,0 +1,334 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os
+import sys
+import time
+import base64
+import tempfile
+from collections import OrderedDict
+
+from .ansible_vault_manager import eprint, get_file_index, get_vault_lib, to_secret_bytes, PLUGIN_SEPARATOR
+from .cache import remove_file
+from .metadata import (
+    METADATA_FILE,
+    METADATA_PLUGIN_KEY,
+    METADATA_ID_KEY,
+    METADATA_VAULT_FILES,
+    METADATA_IDS_KEY,
+    MetadataTransaction,
+    load_metadata_file,
+)
+
+'''
+Password rotation of vault files.
+
+Old passwords are resolved in bulk, new ids and passwords are stored through
+keyring plugins, then files are re-encrypted in a process pool (the crypto
+is CPU bound) to temporary files. Files are only replaced, and metadata
+written once, when every step succeeded; otherwise new passwords are
+removed from keyrings and vault files are left untouched.
+'''
+
+BACKUP_SUFFIX = '.rekey-backup'
+
+
+class RekeyException(Exception):
+    pass
+
+
+def generate_password(size=32):
+    return base64.urlsafe_b64encode(os.urandom(size)).decode('ascii').rstrip('=')
+
+
+def make_temporary_file(path):
+    '''
+    Create an empty temporary file next to path with path permissions, and
+    return its path.
+    '''
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path),
+        prefix='.' + os.path.basename(path) + '.'
+    )
+    os.close(fd)
+    try:
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+    except Exception:
+        remove_file(tmp_path)
+        raise
+
+    return tmp_path
+
+
+def write_temporary_file(path, content):
+    '''
+    Write content next to path in a temporary file with path permissions,
+    and return the temporary file path.
+    '''
+    tmp_path = make_temporary_file(path)
+    try:
+        with open(tmp_path, 'wb') as stream:
+            stream.write(content)
+    except Exception:
+        remove_file(tmp_path)
+        raise
+
+    return tmp_path
+
+
+def reencrypt_file(path, old_password, new_password, vault_label):
+    '''
+    Process pool worker: write path re-encrypted with new_password, labelled
+    with vault_label, to a temporary file and return its path.
+    '''
+    from ansible.parsing.vault import VaultSecret
+    VaultLib = get_vault_lib()
+
+    try:
+        with open(path, 'rb') as stream:
+            ciphertext = stream.read()
+        plaintext = VaultLib([(vault_label, VaultSecret(to_secret_bytes(old_password)))]).decrypt(ciphertext)
+        encrypted = VaultLib([]).encrypt(plaintext, VaultSecret(to_secret_bytes(new_password)), vault_label)
+    except Exception as e:
+        # Only the message crosses the process boundary, not ansible objects
+        raise RekeyException(str(e).strip())
+
+    return write_temporary_file(path, encrypted)
+
+
+class RekeyPipeline(object):
+    done_message = 'Rekeyed'
+
+    def __init__(self, manager, vault_path, files=None, plugin_name=None, plugin_vars=None, processes=None):
+        self.manager = manager
+        self.vault_path = vault_path
+        self.files = [os.path.normpath(file) for file in files or []]
+        self.plugin_name = plugin_name
+        self.plugin_vars = plugin_vars
+        self.processes = processes
+        # (old entry, rotated files, new entry, new password)
+        self.rotations = []
+        # (plugin name, plugin vars) -> first id generated with them
+        self.generated_ids = {}
+        self.temporary_files = {}
+        self.backups = {}
+
+    def run(self):
+        start = time.time()
+        metadata_file = os.path.join(self.vault_path, METADATA_FILE)
+        vault_metadata = load_metadata_file(metadata_file) if os.path.exists(metadata_file) else {}
+        self.select_rotations(vault_metadata.get(METADATA_IDS_KEY) or [])
+        if not self.rotations:
+            raise RekeyException('No vault file to process')
+
+        old_passwords = self.resolve_old_passwords()
+        try:
+            self.store_new_passwords()
+            self.process_files(old_passwords)
+            self.replace_files()
+            try:
+                self.update_metadata(metadata_file)
+            except Exception:
+                self.restore_files()
+                raise
+        except BaseException:
+            self.rollback()
+            raise
+        self.remove_backups()
+
+        elapsed = time.time() - start
+        count = len(self.temporary_files)
+        eprint(
+            '{0} {1} files with {2} new ids in {3:.2f}s ({4:.1f} files/s)'.format(
+                self.done_message, count, len(self.rotations), elapsed, count / elapsed if elapsed else 0
+            )
+        )
+
+    def select_rotations(self, vault_ids):
+        # Files whose header names an entry are rotated with it, even when
+        # missing from its files list
+        file_index = get_file_index(self.vault_path, vault_ids)
+        for position, entry in enumerate(vault_ids):
+            # A file protected by several entries is rotated once, with the
+            # one named by its header if any
+            files = [file for file in file_index.files_by_id[position] if file_index.ids_by_file[file][0] == position]
+            if self.files:
+                files = [file for file in files if file in self.files]
+            if files:
+                self.rotations.append([entry, files, None, None])
+
+        if self.files:
+            known_files = set(file for rotation in self.rotations for file in rotation[1])
+            unknown_files = [file for file in self.files if file not in known_files]
+            if unknown_files:
+                raise RekeyException('Files not referenced in metadata: ' + ', '.join(unknown_files))
+
+    def resolve_old_passwords(self):
+        entries = [rotation[0] for rotation in self.rotations]
+        old_passwords = []
+        errors = []
+        for entry, (password, error) in zip(entries, self.manager.resolve_passwords(entries)):
+            if error is not None or not password:
+                label = entry[METADATA_PLUGIN_KEY] + PLUGIN_SEPARATOR + entry[METADATA_ID_KEY]
+                errors.append(label + ': ' + str(error))
+            old_passwords.append(password)
+        if errors:
+            raise RekeyException('Unable to fetch current passwords:\n' + '\n'.join(errors))
+
+        eprint('Fetched {0} current passwords'.format(len(old_passwords)))
+        return old_passwords
+
+    def get_new_id_options(self, rotation):
+        '''
+        Return plugin name, plugin vars and password (None to generate one)
+        of the new id of a rotation.
+        '''
+        return self.plugin_name or rotation[0][METADATA_PLUGIN_KEY], self.plugin_vars, None
+
+    def get_new_id(self, rotation, plugin_name, plugin, plugin_vars):
+        '''
+        Return the new id of a rotation. It is stored next to the current
+        id unless another plugin or --plugin-param relocate it; relocated
+        ids are generated once per plugin and vars, which may prompt, the
+        next ones derived from the first.
+        '''
+        entry = rotation[0]
+        if entry is not None and entry[METADATA_PLUGIN_KEY] == plugin_name and not self.plugin_vars:
+            new_id = plugin.derive_id(entry[METADATA_ID_KEY])
+            if new_id is not None:
+                return new_id
+
+        key = (plugin_name, tuple(plugin_vars or ()))
+        if key in self.generated_ids:
+            new_id = plugin.derive_id(self.generated_ids[key])
+            if new_id is not None:
+                return new_id
+
+        try:
+            new_id = plugin.generate_id(plugin_vars)
+        except EOFError:
+            raise RekeyException(
+                'Plugin ' + plugin_name + ' needs parameters to create new ids, give them with --plugin-param'
+            )
+        self.generated_ids.setdefault(key, new_id)
+        return new_id
+
+    def store_new_passwords(self):
+        # generate_id may prompt for plugin parameters, run it sequentially
+        # and before any password is stored
+        new_ids = []
+        for rotation in self.rotations:
+            plugin_name, plugin_vars, password = self.get_new_id_options(rotation)
+            plugin = self.manager.get_plugin_instance(plugin_name)
+            new_ids.append((plugin_name, plugin, self.get_new_id(rotation, plugin_name, plugin, plugin_vars), password))
+
+        items = [
+            (plugin_name, plugin, id, generate_password() if password is None else password)
+            for plugin_name, plugin, id, password in new_ids
+        ]
+        errors = []
+        for index, (item, (new_version, error)) in enumerate(zip(items, self.manager.set_passwords(items))):
+            plugin_name, plugin, id, password = item
+            if error is not None:
+                errors.append(error)
+                continue
+            self.rotations[index][2] = {
+                METADATA_ID_KEY: plugin.append_id_version(new_version, id),
+                METADATA_PLUGIN_KEY: plugin_name,
+                METADATA_VAULT_FILES: self.rotations[index][1],
+            }
+            self.rotations[index][3] = password
+        if errors:
+            # Stored ones are removed by the rollback
+            raise errors[0]
+
+        eprint('Stored {0} new passwords'.format(len(self.rotations)))
+
+    def process_files(self, old_passwords):
+        tasks = []
+        for rotation, old_password in zip(self.rotations, old_passwords):
+            entry, files, new_entry, new_password = rotation
+            label = new_entry[METADATA_PLUGIN_KEY] + PLUGIN_SEPARATOR + new_entry[METADATA_ID_KEY]
+            for file in files:
+                tasks.append((os.path.join(self.vault_path, file), old_password, new_password, label))
+
+        self.run_file_tasks(reencrypt_file, tasks)
+
+    def run_file_tasks(self, worker, tasks):
+        '''
+        Run worker on each task in a process pool, workers take the file
+        path first and return the temporary file to swap it with.
+        '''
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        errors = []
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            futures = dict((executor.submit(worker, *task), task[0]) for task in tasks)
+            for done, future in enumerate(as_completed(futures), 1):
+                path = futures[future]
+                try:
+                    self.temporary_files[path] = future.result()
+                    eprint('[{0}/{1}] {2}'.format(done, len(tasks), path))
+                except Exception as e:
+                    errors.append(path + ': ' + str(e))
+                    eprint('[{0}/{1}] {2} FAILED'.format(done, len(tasks), path))
+
+        if errors:
+            raise RekeyException('Unable to encrypt files:\n' + '\n'.join(errors))
+
+    def replace_files(self):
+        for path, tmp_path in self.temporary_files.items():
+            backup = path + BACKUP_SUFFIX
+            remove_file(backup)
+            os.link(path, backup)
+            self.backups[path] = backup
+            os.rename(tmp_path, path)
+
+    def restore_files(self):
+        for path, backup in self.backups.items():
+            os.rename(backup, path)
+        self.backups = {}
+
+    def remove_backups(self):
+        for backup in self.backups.values():
+            remove_file(backup)
+
+    def update_metadata(self, metadata_file):
+        '''
+        Apply rotations to the metadata file as it is now, it may have been
+        changed by a concurrent writer since it was read.
+        '''
+        rotated_files = set(file for rotation in self.rotations for file in rotation[1])
+        new_entries = OrderedDict(
+            ((rotation[0][METADATA_PLUGIN_KEY], rotation[0][METADATA_ID_KEY]), rotation[2])
+            for rotation in self.rotations
+        )
+        with MetadataTransaction(metadata_file) as transaction:
+            vault_ids = []
+            for entry in transaction.metadata.get(METADATA_IDS_KEY) or []:
+                files = entry.get(METADATA_VAULT_FILES) or []
+                remaining = [file for file in files if os.path.normpath(file) not in rotated_files]
+                if len(remaining) != len(files):
+                    entry[METADATA_VAULT_FILES] = remaining
+                # Entries left without files are replaced by the new ones
+                if remaining or not files:
+                    vault_ids.append(entry)
+                key = (entry.get(METADATA_PLUGIN_KEY), entry.get(METADATA_ID_KEY))
+                if key in new_entries:
+                    vault_ids.append(new_entries.pop(key))
+            transaction.metadata[METADATA_IDS_KEY] = vault_ids
+            transaction.append_ids(list(new_entries.values()))
+
+    def rollback(self):
+        if self.backups:
+            self.restore_files()
+        for tmp_path in self.temporary_files.values():
+            remove_file(tmp_path)
+
+        for rotation in self.rotations:
+            new_entry = rotation[2]
+            if new_entry is None:
+                continue
+            plugin = self.manager.get_plugin_instance(new_entry[METADATA_PLUGIN_KEY])
+            try:
+                plugin.delete_password(new_entry[METADATA_ID_KEY])
+            except Exception as e:
+                eprint('Unable to remove new password ' + new_entry[METADATA_ID_KEY] + ': ' + str(e))
+        sys.stderr.flush()
@@ -0,0 +1,226 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os
+from binascii import hexlify, unhexlify
+
+'''
+Streaming implementation of the ansible vault 1.2 AES256 format, so files
+of any size are encrypted with bounded memory (VaultLib works on whole
+byte strings).
+
+    $ANSIBLE_VAULT;1.2;AES256;<label>
+    hexlify(hexlify(salt) \n hexlify(hmac) \n hexlify(ciphertext)), 80 columns
+
+Keys come from PBKDF2-SHA256 (10000 iterations) of the password and salt:
+32 bytes AES key, 32 bytes HMAC key, 16 bytes CTR nonce. Plaintext is PKCS7
+padded, and the HMAC-SHA256 of the ciphertext precedes it, so the
+ciphertext is spooled to a temporary file while the source is read, once,
+and copied after the HMAC. Decryption streams the same way, the HMAC is
+checked once the whole ciphertext was read.
+'''
+
+VAULT_HEADER = b'$ANSIBLE_VAULT'
+VAULT_VERSION = b'1.2'
+VAULT_CIPHER = b'AES256'
+KDF_ITERATIONS = 10000
+KEY_LENGTH = 32
+IV_LENGTH = 16
+SALT_LENGTH = 32
+LINE_WIDTH = 80
+# Multiple of the AES block size
+CHUNK_SIZE = 1024 * 1024
+
+
+def read_vault_header(path):
+    '''
+    Return the (version, cipher, label) of a vault file header, label is
+    None before format 1.2. Return None for files not vault encrypted.
+    '''
+    with open(path, 'rb') as stream:
+        line = stream.readline(1024).strip()
+    parts = line.split(b';')
+    if parts[0] != VAULT_HEADER or len(parts) < 3:
+        return None
+
+    label = parts[3].decode('utf-8') if len(parts) > 3 else None
+    return (parts[1].decode('utf-8'), parts[2].decode('utf-8'), label)
+
+
+def derive_keys(password, salt):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=2 * KEY_LENGTH + IV_LENGTH,
+        salt=salt,
+        iterations=KDF_ITERATIONS,
+        backend=default_backend()
+    )
+    derived_key = kdf.derive(password)
+
+    return derived_key[:KEY_LENGTH], derived_key[KEY_LENGTH:2 * KEY_LENGTH], derived_key[2 * KEY_LENGTH:]
+
+
+def iter_ciphertext(stream, key, iv, chunk_size=CHUNK_SIZE, plaintext_digest=None):
+    '''
+    Yield ciphertext chunks of the padded content of stream, updating
+    plaintext_digest, when given, with the content read.
+    '''
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    encryptor = Cipher(algorithms.AES(key), modes.CTR(iv), default_backend()).encryptor()
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if plaintext_digest is not None:
+            plaintext_digest.update(chunk)
+        yield encryptor.update(padder.update(chunk))
+    yield encryptor.update(padder.finalize()) + encryptor.finalize()
+
+
+class WrappedWriter(object):
+    '''
+    Write hexlified data to a stream, wrapped to LINE_WIDTH columns.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = b''
+
+    def write(self, data):
+        data = self.pending + hexlify(data)
+        lines_end = len(data) - len(data) % LINE_WIDTH
+        for i in range(0, lines_end, LINE_WIDTH):
+            self.stream.write(data[i:i + LINE_WIDTH] + b'\n')
+        self.pending = data[lines_end:]
+
+    def close(self):
+        if self.pending:
+            self.stream.write(self.pending + b'\n')
+        self.pending = b''
+
+
+def encrypt_stream(source, target, password, label, chunk_size=CHUNK_SIZE):
+    '''
+    Write the content of the source stream vault encrypted with password
+    (bytes) to target, with label in the header. Source is read once.
+
+    Return the SHA-256 digest of the content read.
+    '''
+    import hashlib
+    import tempfile
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, hmac
+    salt = os.urandom(SALT_LENGTH)
+    key, hmac_key, iv = derive_keys(password, salt)
+
+    plaintext_digest = hashlib.sha256()
+    digest = hmac.HMAC(hmac_key, hashes.SHA256(), default_backend())
+    with tempfile.SpooledTemporaryFile(max_size=chunk_size) as ciphertext:
+        for chunk in iter_ciphertext(source, key, iv, chunk_size, plaintext_digest):
+            digest.update(chunk)
+            ciphertext.write(chunk)
+        ciphertext.seek(0)
+
+        target.write(b';'.join([VAULT_HEADER, VAULT_VERSION, VAULT_CIPHER, label.encode('utf-8')]) + b'\n')
+        writer = WrappedWriter(target)
+        writer.write(hexlify(salt) + b'\n' + hexlify(digest.finalize()) + b'\n')
+        while True:
+            chunk = ciphertext.read(chunk_size)
+            if not chunk:
+                break
+            writer.write(hexlify(chunk))
+        writer.close()
+
+    return plaintext_digest.digest()
+
+
+def iter_unhexlified(chunks):
+    '''
+    Yield the bytes of hexlified chunks, ignoring line breaks.
+    '''
+    pending = b''
+    for chunk in chunks:
+        data = pending + b''.join(chunk.split())
+        end = len(data) - len(data) % 2
+        pending = data[end:]
+        if end:
+            yield unhexlify(data[:end])
+    if pending:
+        raise ValueError('Odd length vault data')
+
+
+def decrypt_stream(source, password, chunk_size=CHUNK_SIZE):
+    '''
+    Yield the plaintext chunks of the vault data of the source stream,
+    read after its header line, decrypted with password (bytes). Raise
+    ValueError when the data is invalid or its HMAC does not match, which
+    is only known after the last ciphertext chunk: content yielded before
+    must be discarded then.
+    '''
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, hmac, padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    data = iter_unhexlified(iter(lambda: source.read(chunk_size), b''))
+
+    head = b''
+    for chunk in data:
+        head += chunk
+        if head.count(b'\n') >= 2:
+            break
+    parts = head.split(b'\n', 2)
+    if len(parts) < 3:
+        raise ValueError('Truncated vault data')
+    salt, expected_hmac = unhexlify(parts[0]), unhexlify(parts[1])
+
+    def ciphertext_chunks():
+        yield parts[2]
+        for chunk in data:
+            yield chunk
+
+    key, hmac_key, iv = derive_keys(password, salt)
+    decryptor = Cipher(algorithms.AES(key), modes.CTR(iv), default_backend()).decryptor()
+    unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+    digest = hmac.HMAC(hmac_key, hashes.SHA256(), default_backend())
+    for ciphertext in iter_unhexlified(ciphertext_chunks()):
+        digest.update(ciphertext)
+        yield unpadder.update(decryptor.update(ciphertext))
+    try:
+        digest.verify(expected_hmac)
+    except InvalidSignature:
+        raise ValueError('HMAC verification failed')
+    yield unpadder.update(decryptor.finalize()) + unpadder.finalize()
+
+
+def encrypt_file(source_path, target_path, password, label, chunk_size=CHUNK_SIZE):
+    '''
+    Encrypt source_path to target_path, see encrypt_stream. Raise IOError
+    when the source is changed while it is read.
+
+    Return the SHA-256 digest of the source content.
+    '''
+    with open(source_path, 'rb') as source:
+        before = os.fstat(source.fileno())
+        with open(target_path, 'wb') as target:
+            plaintext_digest = encrypt_stream(source, target, password, label, chunk_size)
+        after = os.fstat(source.fileno())
+
+    if (before.st_size, before.st_mtime) != (after.st_size, after.st_mtime) or source_path_changed(source_path, after):
+        raise IOError(source_path + ' was changed while being encrypted')
+
+    return plaintext_digest
+
+
+def source_path_changed(path, stat):
+    '''
+    Tell whether path is no longer the file stat was taken from.
+    '''
+    try:
+        current = os.stat(path)
+    except OSError:
+        return True
+    return (current.st_dev, current.st_ino) != (stat.st_dev, stat.st_ino)
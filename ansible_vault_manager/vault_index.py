@@ -0,0 +1,162 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os.path
+
+from .ansible_vault_manager import recursive_glob, PLUGIN_SEPARATOR
+from .metadata import METADATA_FILE, MTIME_GRACE
+from .vault_format import read_vault_header
+
+'''
+Persistent index of the vault headers of the files of a vault path.
+
+Only the first line of each file is read, and only when its mtime or size
+changed since the index was saved in the user cache dir, so finding which
+id protects a file does not need to read the whole tree again. Hidden files
+and directories (VCS data, temporary files) are ignored.
+'''
+
+INDEX_VERSION = 1
+
+
+def get_index_path(vault_path):
+    import hashlib
+    from .cache import get_cache_dir
+    key = hashlib.sha256(os.path.realpath(vault_path).encode('utf-8')).hexdigest()
+    return get_cache_dir('index', key + '.json')
+
+
+def split_label(label):
+    '''
+    Return the (plugin, id) of a plugin%id vault label, None for other
+    labels.
+    '''
+    if label is None or PLUGIN_SEPARATOR not in label:
+        return None
+    return tuple(label.split(PLUGIN_SEPARATOR, 1))
+
+
+def read_outside_headers(vault_path, files):
+    '''
+    Return the header label of each vault file of files outside vault_path
+    (listed by included metadata), which HeaderIndex does not scan.
+    '''
+    headers = {}
+    for file in files:
+        if not (os.path.isabs(file) or file.split(os.sep, 1)[0] == os.pardir):
+            continue
+        try:
+            header = read_vault_header(os.path.join(vault_path, file))
+        except (IOError, OSError):
+            continue
+        if header is not None:
+            headers[file] = header[2]
+
+    return headers
+
+
+def get_header_ids(headers):
+    '''
+    Return the (plugin, id) named by each header label of headers, for
+    files labelled by this tool.
+    '''
+    header_ids = {}
+    for file, label in headers.items():
+        key = split_label(label)
+        if key is not None:
+            header_ids[file] = key
+
+    return header_ids
+
+
+class HeaderIndex(object):
+    def __init__(self, vault_path):
+        self.vault_path = vault_path
+        self.index_path = get_index_path(vault_path)
+        # Relative path -> {mtime, size, vault, label}
+        self.entries = {}
+
+    def read(self):
+        import json
+        try:
+            with open(self.index_path, 'r') as stream:
+                index = json.load(stream)
+        except (IOError, ValueError):
+            return None
+
+        if index.get('version') != INDEX_VERSION:
+            return None
+
+        return index
+
+    def write(self, created):
+        import json
+        from .cache import ensure_private_dir, atomic_write
+        try:
+            ensure_private_dir(os.path.dirname(self.index_path))
+            atomic_write(self.index_path, json.dumps({
+                'version': INDEX_VERSION,
+                'root': os.path.realpath(self.vault_path),
+                'created': created,
+                'entries': self.entries,
+            }).encode('utf-8'))
+        except (IOError, OSError):
+            # Like the metadata snapshot, the index is only an optimisation
+            pass
+
+    def load(self):
+        '''
+        Refresh the index from disk, reading headers of new and changed
+        files only, and return it.
+        '''
+        import time
+        index = self.read() or {'created': 0, 'entries': {}}
+        cached = index['entries']
+        created = time.time()
+
+        changed = False
+        entries = {}
+        for path in recursive_glob(self.vault_path, skip_hidden=True):
+            file = os.path.relpath(path, self.vault_path)
+            if os.path.basename(file) == METADATA_FILE:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entry = cached.get(file)
+            # Recent mtimes may hide a later change, see MTIME_GRACE
+            if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size \
+                    and stat.st_mtime < index['created'] - MTIME_GRACE:
+                entries[file] = entry
+                continue
+
+            try:
+                header = read_vault_header(path)
+            except (IOError, OSError):
+                continue
+            entries[file] = {
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'vault': header is not None,
+                'label': header[2] if header is not None else None,
+            }
+            # Saving also moves the grace period of recent files forward
+            changed = True
+
+        self.entries = entries
+        if changed or len(entries) != len(cached):
+            self.write(created)
+
+        return self
+
+    def headers(self):
+        '''
+        Return the header label (None before format 1.2) of each vault file.
+        '''
+        return dict((file, entry['label']) for file, entry in self.entries.items() if entry['vault'])
+
+    def header_ids(self):
+        '''
+        Return the (plugin, id) named by the header of each vault file, for
+        files labelled by this tool.
+        '''
+        return get_header_ids(self.headers())
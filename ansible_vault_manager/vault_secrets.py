@@ -0,0 +1,114 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os.path
+import threading
+from argparse import Namespace
+
+from ansible.parsing.vault import VaultLib, VaultSecret
+
+from .ansible_vault_manager import (
+    VaultManager,
+    get_file_index,
+    to_secret_bytes,
+    DEFAULT_JOBS,
+    PLUGIN_SEPARATOR,
+)
+from .metadata import METADATA_FILE, METADATA_PLUGIN_KEY, METADATA_ID_KEY, load_metadata
+
+'''
+In process ansible integration, to resolve all vault secrets of a metadata
+file without spawning the client script once per vault id.
+
+    from ansible_vault_manager.vault_secrets import load_vault_secrets
+    loader.set_vault_secrets(load_vault_secrets('inventory/vault_vars/'))
+'''
+
+
+def get_vault_manager(**options):
+    '''
+    Return a VaultManager usable as a library, options are the same as the
+    command line ones.
+    '''
+    args = Namespace(
+        action=None,
+        verbose=False,
+        no_cache=False,
+        cache_ttl=None,
+        jobs=DEFAULT_JOBS,
+    )
+    for key, value in options.items():
+        setattr(args, key, value)
+
+    return VaultManager(args)
+
+
+class ManagedVaultSecret(VaultSecret):
+    '''
+    Vault secret whose password is fetched through a keyring plugin on
+    first use, then kept in memory.
+    '''
+
+    def __init__(self, plugin_name, vault_id, manager=None, password=None):
+        super(ManagedVaultSecret, self).__init__()
+        self.plugin_name = plugin_name
+        self.vault_id = vault_id
+        self.manager = manager or get_vault_manager()
+        self._lock = threading.Lock()
+        if password is not None:
+            self._bytes = to_secret_bytes(password)
+
+    @property
+    def label(self):
+        return self.plugin_name + PLUGIN_SEPARATOR + self.vault_id
+
+    @property
+    def bytes(self):
+        if self._bytes is None:
+            self.load()
+        return self._bytes
+
+    def load(self):
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = to_secret_bytes(self.manager.fetch_password(self.plugin_name, self.vault_id))
+
+
+def load_vault_secrets(vault_path, lazy=False, files=None, groups=None, manager=None, **options):
+    '''
+    Return the (vault id label, secret) list of all usable ids of the
+    metadata in vault_path, ready for VaultLib or DataLoader.set_vault_secrets.
+
+    Passwords are resolved in bulk and concurrently, unusable ids are
+    skipped. With lazy, ids are only probed and passwords fetched on first
+    use. files and groups restrict ids like get-usable-ids options.
+
+    Raise MetadataException, or yaml.YAMLError, when the metadata can't be
+    loaded.
+    '''
+    if manager is None:
+        manager = get_vault_manager(**options)
+
+    vault_ids = load_metadata(os.path.join(os.path.abspath(vault_path), METADATA_FILE))['vault_ids']
+    if files or groups:
+        vault_ids = get_file_index(vault_path, vault_ids).filter(files, groups)
+
+    secrets = []
+    for id, (password, error) in zip(vault_ids, manager.resolve_passwords(vault_ids, probe=lazy)):
+        if error is not None or not password:
+            continue
+        secret = ManagedVaultSecret(
+            id[METADATA_PLUGIN_KEY],
+            id[METADATA_ID_KEY],
+            manager,
+            None if password is True else password
+        )
+        secrets.append((secret.label, secret))
+
+    return secrets
+
+
+def load_vault_lib(vault_path, **options):
+    '''
+    Return a VaultLib able to decrypt all files protected by the metadata
+    in vault_path, see load_vault_secrets.
+    '''
+    return VaultLib(load_vault_secrets(vault_path, **options))
@@ -0,0 +1,165 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os
+import time
+
+from .ansible_vault_manager import get_metadata, get_vault_lib, to_secret_bytes, PLUGIN_SEPARATOR
+from .metadata import METADATA_PLUGIN_KEY, METADATA_ID_KEY, METADATA_VAULT_FILES
+from .vault_index import HeaderIndex, read_outside_headers
+
+'''
+Integrity check of a vault path: every file listed in metadata must be a
+vault file decryptable with the password of its id.
+
+Secrets are resolved in bulk, vault files found through the header index,
+and files test-decrypted in a process pool. Files are matched to ids by their
+metadata entries, and by the label of their 1.2 header when present.
+'''
+
+
+def check_vault_file(path, secrets):
+    '''
+    Process pool worker: try to decrypt path with (label, password) secrets
+    in order. Return the label of the working secret and None, or None and
+    the error message.
+    '''
+    from ansible.parsing.vault import VaultSecret
+    VaultLib = get_vault_lib()
+    try:
+        with open(path, 'rb') as stream:
+            ciphertext = stream.read()
+    except (IOError, OSError) as e:
+        return None, str(e)
+
+    for label, password in secrets:
+        try:
+            VaultLib([(label, VaultSecret(to_secret_bytes(password)))]).decrypt(ciphertext)
+            return label, None
+        except Exception as e:
+            error = str(e).strip()
+
+    return None, error
+
+
+class VaultVerifier(object):
+    def __init__(self, manager, vault_path, processes=None):
+        self.manager = manager
+        self.vault_path = vault_path
+        self.processes = processes
+        self.timings = {}
+
+    def timed(self, step, start):
+        now = time.time()
+        self.timings[step] = round(now - start, 3)
+        return now
+
+    def run(self):
+        '''
+        Return the verification report, a dict of lists: failures (files
+        which can't be decrypted), orphans (vault files missing from
+        metadata), unreferenced_ids (ids protecting no existing file) and
+        unresolved_ids (ids whose password can't be fetched).
+        '''
+        start = step = time.time()
+        vault_ids = get_metadata(self.vault_path)['vault_ids']
+        labels = [id[METADATA_PLUGIN_KEY] + PLUGIN_SEPARATOR + id[METADATA_ID_KEY] for id in vault_ids]
+        step = self.timed('metadata', step)
+
+        passwords = {}
+        unresolved_ids = []
+        for label, (password, error) in zip(labels, self.manager.resolve_passwords(vault_ids)):
+            if error is not None or not password:
+                unresolved_ids.append({'id': label, 'error': str(error)})
+            else:
+                passwords[label] = password
+        step = self.timed('secrets', step)
+
+        # Labels of the ids listing each file, in metadata order
+        referenced = {}
+        for label, id in zip(labels, vault_ids):
+            for file in id.get(METADATA_VAULT_FILES) or []:
+                referenced.setdefault(os.path.normpath(file), []).append(label)
+
+        headers = HeaderIndex(self.vault_path).load().headers()
+        headers.update(read_outside_headers(self.vault_path, referenced))
+        step = self.timed('scan', step)
+
+        failures = []
+        orphans = []
+        used_labels = set()
+        tasks = []
+        for file in sorted(set(referenced) | set(headers)):
+            header_label = headers.get(file)
+            candidates = list(referenced.get(file, []))
+            if file not in referenced:
+                orphans.append({'file': file, 'id': header_label})
+            if file not in headers:
+                error = 'not vault encrypted' if os.path.exists(os.path.join(self.vault_path, file)) else 'missing'
+                failures.append({'file': file, 'id': candidates[0], 'error': error})
+                continue
+            if header_label in candidates:
+                candidates.remove(header_label)
+                candidates.insert(0, header_label)
+            elif header_label in passwords and file not in referenced:
+                candidates.append(header_label)
+            secrets = [(label, passwords[label]) for label in candidates if label in passwords]
+            if not secrets:
+                if file in referenced:
+                    failures.append({'file': file, 'id': candidates[0], 'error': 'password unavailable'})
+                continue
+            tasks.append((file, secrets))
+
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            futures = [
+                executor.submit(check_vault_file, os.path.join(self.vault_path, file), secrets)
+                for file, secrets in tasks
+            ]
+            for (file, secrets), future in zip(tasks, futures):
+                label, error = future.result()
+                if label is not None:
+                    used_labels.add(label)
+                elif file in referenced:
+                    failures.append({'file': file, 'id': secrets[0][0], 'error': error})
+        self.timed('decrypt', step)
+
+        listed_labels = set(label for file_labels in referenced.values() for label in file_labels)
+        header_labels = set(headers.values())
+        unreferenced_ids = [
+            label for label in labels
+            if label not in listed_labels and label not in header_labels and label not in used_labels
+        ]
+        self.timed('total', start)
+
+        return {
+            'vault_path': self.vault_path,
+            'files_checked': len(tasks),
+            'failures': failures,
+            'orphans': orphans,
+            'unreferenced_ids': unreferenced_ids,
+            'unresolved_ids': unresolved_ids,
+            'timings': self.timings,
+        }
+
+
+def format_report(report):
+    lines = []
+    for failure in report['failures']:
+        lines.append('FAILED     ' + failure['file'] + ' (' + str(failure['id']) + '): ' + failure['error'])
+    for orphan in report['orphans']:
+        lines.append('ORPHAN     ' + orphan['file'] + ('' if orphan['id'] is None else ' (' + orphan['id'] + ')'))
+    for label in report['unreferenced_ids']:
+        lines.append('UNUSED ID  ' + label)
+    for unresolved in report['unresolved_ids']:
+        lines.append('UNRESOLVED ' + unresolved['id'] + ': ' + unresolved['error'])
+    lines.append(
+        '{0} files checked, {1} failures, {2} orphans, {3} unreferenced ids, {4} unresolved ids in {5:.2f}s'.format(
+            report['files_checked'],
+            len(report['failures']),
+            len(report['orphans']),
+            len(report['unreferenced_ids']),
+            len(report['unresolved_ids']),
+            report['timings']['total']
+        )
+    )
+
+    return '\n'.join(lines)
@@ -0,0 +1,119 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from .metadata import METADATA_FILE, get_metadata_sources
+
+'''
+Identity list files written by the warm action.
+
+Each file is a shell script exporting ANSIBLE_VAULT_IDENTITY_LIST, valid
+until its expiry time and while the metadata files it was computed from are
+unchanged. Once stale, sourcing it runs get-usable-ids instead. Its header
+records the fingerprint of the resolved metadata, so get-usable-ids reuses a
+fresh file of the cache dir without resolving any id.
+'''
+
+IDENTITY_LIST_ENV = 'ANSIBLE_VAULT_IDENTITY_LIST'
+IDENTITY_FILE_VERSION = 1
+HEADER_PREFIX = '# avm-'
+
+
+def get_identity_file_path(vault_path):
+    import hashlib
+    from .cache import get_cache_dir
+    key = hashlib.sha256(os.path.realpath(vault_path).encode('utf-8')).hexdigest()
+    return get_cache_dir('identities', key + '.sh')
+
+
+def metadata_fingerprint(vault_metadata):
+    import hashlib
+    import json
+    return hashlib.sha256(json.dumps(vault_metadata, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def format_identity_file(path, vault_path, identities, fingerprint, expires, client_script):
+    vault_path = os.path.realpath(vault_path)
+    sources = get_metadata_sources(os.path.join(vault_path, METADATA_FILE))
+    if identities:
+        export = 'export ' + IDENTITY_LIST_ENV + '=' + quote(','.join(identities))
+    else:
+        # Nothing to export, ansible fails on an empty identity
+        export = ':'
+    lines = [
+        '# Written by ansible-vault-manager-client warm, source it to export ' + IDENTITY_LIST_ENV,
+        HEADER_PREFIX + 'version=' + str(IDENTITY_FILE_VERSION),
+        HEADER_PREFIX + 'vault-path=' + vault_path,
+        HEADER_PREFIX + 'fingerprint=' + fingerprint,
+        HEADER_PREFIX + 'expires=' + str(int(expires)),
+        HEADER_PREFIX + 'identities=' + ','.join(identities),
+        '__avm_fresh=1',
+        '[ "$(date +%s)" -lt ' + str(int(expires)) + ' ] || __avm_fresh=',
+        'for __avm_source in ' + ' '.join(quote(source) for source in sources) + '; do',
+        '    [ "$__avm_source" -nt ' + quote(path) + ' ] && __avm_fresh=',
+        'done',
+        'if [ -n "$__avm_fresh" ]; then',
+        '    ' + export,
+        'else',
+        '    __avm_ids=$(' + quote(client_script) + ' get-usable-ids --vault-path ' + quote(vault_path) + ')',
+        '    [ -n "$__avm_ids" ] && export ' + IDENTITY_LIST_ENV + '="$__avm_ids"',
+        'fi',
+        'unset __avm_fresh __avm_source __avm_ids',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def write_identity_file(path, vault_path, identities, fingerprint, expires, client_script):
+    from .cache import ensure_private_dir, atomic_write
+    if path == get_identity_file_path(vault_path):
+        ensure_private_dir(os.path.dirname(path))
+    content = format_identity_file(path, vault_path, identities, fingerprint, expires, client_script)
+    atomic_write(path, content.encode('utf-8'), 0o644)
+
+
+def read_identity_file(path):
+    '''
+    Return the header values of an identity file, None when it is missing
+    or was written by another version.
+    '''
+    headers = {}
+    try:
+        with open(path, 'r') as stream:
+            for line in stream:
+                if not line.startswith(HEADER_PREFIX):
+                    continue
+                key, _, value = line[len(HEADER_PREFIX):].rstrip('\n').partition('=')
+                headers[key] = value
+    except (IOError, OSError):
+        return None
+
+    if headers.get('version') != str(IDENTITY_FILE_VERSION):
+        return None
+
+    return headers
+
+
+def load_identities(vault_path, vault_metadata):
+    '''
+    Return the identity list warmed for vault_path, None when there is no
+    fresh identity file for its current metadata.
+    '''
+    headers = read_identity_file(get_identity_file_path(vault_path))
+    if headers is None:
+        return None
+
+    try:
+        expires = int(headers['expires'])
+    except (KeyError, ValueError):
+        return None
+    if time.time() >= expires or headers.get('fingerprint') != metadata_fingerprint(vault_metadata):
+        return None
+    if headers.get('vault-path') != os.path.realpath(vault_path):
+        return None
+
+    return [identity for identity in headers.get('identities', '').split(',') if identity]
@@ -0,0 +1,188 @@
+'''
+Offline stand-in for the SSM API calls of the aws_ssm keyring plugin, with
+artificial latency and throttling, used by the benchmark suite.
+
+Clients are put in the plugin client pool for each configured (profile,
+region), answering whatever the plugin timeout, so no credentials nor
+network are needed. Only the calls made by the plugin are implemented,
+list operations in a single page. Parameters come from a
+JSON settings file:
+
+    {
+        "parameters": {"/bench/p1": ["value of version 1", "version 2"]},
+        "clients": [["bench", "eu-west-1"]],
+        "latency": 0.02,
+        "rate": 40
+    }
+
+latency is the seconds each call sleeps, rate the calls per second each
+client accepts (token bucket, burst of one second) before answering with a
+ThrottlingException, 0 for no limit. Client processes started by the suite
+call install_from_env(), reading the settings file named by $AVM_BENCH_FAKE_SSM.
+'''
+from __future__ import print_function
+import json
+import os
+import threading
+import time
+
+FAKE_SSM_ENV = 'AVM_BENCH_FAKE_SSM'
+
+
+class TokenBucket(object):
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class FakeSSMClient(object):
+    def __init__(self, parameters, latency=0.0, rate=0):
+        # Name -> list of values, version N at index N - 1
+        self.parameters = parameters
+        self.latency = latency
+        self.bucket = TokenBucket(rate) if rate else None
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttled = 0
+
+    def call(self, operation):
+        from botocore.exceptions import ClientError
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.bucket is not None and not self.bucket.take():
+            with self.lock:
+                self.throttled += 1
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation)
+
+    def error(self, operation, code, message):
+        from botocore.exceptions import ClientError
+        return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+    def lookup(self, selector):
+        '''
+        Return the parameter dict of a name or name:version selector, or
+        the error code when it does not exist.
+        '''
+        name, _, version = selector.partition(':')
+        values = self.parameters.get(name)
+        if values is None:
+            return 'ParameterNotFound'
+        if version and (not version.isdigit() or not 0 < int(version) <= len(values)):
+            return 'ParameterVersionNotFound'
+        number = int(version) if version else len(values)
+        parameter = {'Name': name, 'Value': values[number - 1], 'Version': number, 'Type': 'SecureString'}
+        if version:
+            parameter['Selector'] = ':' + version
+        return parameter
+
+    def get_parameter(self, Name, WithDecryption=False):
+        self.call('GetParameter')
+        parameter = self.lookup(Name)
+        if not isinstance(parameter, dict):
+            raise self.error('GetParameter', parameter, 'Parameter ' + Name + ' not found')
+        return {'Parameter': parameter}
+
+    def get_parameters(self, Names, WithDecryption=False):
+        self.call('GetParameters')
+        if len(Names) > 10:
+            raise self.error('GetParameters', 'ValidationException', 'Too many names')
+        parameters, invalid = [], []
+        for selector in Names:
+            parameter = self.lookup(selector)
+            if isinstance(parameter, dict):
+                parameters.append(parameter)
+            else:
+                invalid.append(selector)
+        return {'Parameters': parameters, 'InvalidParameters': invalid}
+
+    def describe_parameters(self, ParameterFilters=()):
+        self.call('DescribeParameters')
+        names = [name for filter in ParameterFilters for name in filter['Values']]
+        return {'Parameters': [
+            {'Name': name, 'Version': len(self.parameters[name])} for name in names if name in self.parameters
+        ]}
+
+    def get_parameter_history(self, Name, WithDecryption=False):
+        self.call('GetParameterHistory')
+        if Name not in self.parameters:
+            raise self.error('GetParameterHistory', 'ParameterNotFound', 'Parameter ' + Name + ' not found')
+        return {'Parameters': [
+            {'Name': Name, 'Value': value, 'Version': index + 1, 'Labels': []}
+            for index, value in enumerate(self.parameters[Name])
+        ]}
+
+    def put_parameter(self, Name, Value, Type='SecureString', Overwrite=False):
+        self.call('PutParameter')
+        with self.lock:
+            values = self.parameters.setdefault(Name, [])
+            if values and not Overwrite:
+                raise self.error('PutParameter', 'ParameterAlreadyExists', 'Parameter ' + Name + ' exists')
+            values.append(Value)
+            return {'Version': len(values)}
+
+    def add_tags_to_resource(self, **kwargs):
+        self.call('AddTagsToResource')
+        return {}
+
+    def delete_parameter(self, Name):
+        self.call('DeleteParameter')
+        with self.lock:
+            if self.parameters.pop(Name, None) is None:
+                raise self.error('DeleteParameter', 'ParameterNotFound', 'Parameter ' + Name + ' not found')
+        return {}
+
+
+class FakeClientPool(dict):
+    '''
+    Plugin client pool whose fake clients, keyed by (profile, region),
+    answer for any timeout of the (profile, region, timeout) pool keys.
+    '''
+
+    def get(self, key, default=None):
+        return dict.get(self, key[:2], dict.get(self, key, default))
+
+
+def install(parameters, clients, latency=0.0, rate=0):
+    '''
+    Put a fake client for each (profile, region) of clients in the aws_ssm
+    plugin client pool, sharing parameters. Return the clients.
+    '''
+    from ansible_vault_manager.keyring_plugins import aws_ssm
+    installed = {}
+    for profile, region in clients:
+        installed[(profile, region)] = FakeSSMClient(parameters, latency, rate)
+    with aws_ssm._ssm_clients_lock:
+        pool = FakeClientPool(aws_ssm._ssm_clients)
+        pool.update(installed)
+        aws_ssm._ssm_clients = pool
+
+    return installed
+
+
+def install_from_env():
+    settings_file = os.environ.get(FAKE_SSM_ENV)
+    if not settings_file:
+        return None
+    with open(settings_file, 'r') as stream:
+        settings = json.load(stream)
+
+    return install(
+        settings['parameters'],
+        [tuple(client) for client in settings['clients']],
+        settings.get('latency', 0.0),
+        settings.get('rate', 0)
+    )
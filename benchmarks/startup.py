@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+Startup benchmark of the fetch hot path: ansible runs the client once per
+vault id, so interpreter startup and imports dominate.
+
+Runs fetch against a temporary local_fs keyring, and reports median wall
+time and cumulative import time of the package as JSON.
+
+    python benchmarks/startup.py --runs 20
+'''
+from __future__ import print_function
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+CLIENT_CODE = 'from ansible_vault_manager.ansible_vault_manager import main; main()'
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)$')
+
+
+def make_keyring(workdir):
+    basepath = os.path.join(workdir, 'keyring')
+    os.makedirs(basepath)
+    with open(os.path.join(basepath, 'benchmark.1'), 'w') as stream:
+        stream.write('benchmark-password')
+
+    return 'local_fs%' + basepath + ':benchmark'
+
+
+def client_command(vault_id, extra_args=()):
+    return [sys.executable, '-c', CLIENT_CODE, 'fetch', '--vault-id', vault_id] + list(extra_args)
+
+
+def parse_importtime(stderr):
+    '''
+    Return cumulative import time in microseconds of each top level module.
+    '''
+    imports = {}
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match and len(match.group(3)) == 1:
+            imports[match.group(4)] = int(match.group(2))
+
+    return imports
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure(vault_id, runs, env, extra_args=()):
+    command = client_command(vault_id, extra_args)
+    walls = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_output(command, env=env)
+        walls.append(time.time() - start)
+
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime'] + command[1:],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    stdout, stderr = process.communicate()
+    imports = parse_importtime(stderr)
+    package_imports = dict((name, value) for name, value in imports.items() if name.startswith('ansible_vault_manager'))
+
+    return {
+        'runs': runs,
+        'wall_median_ms': round(median(walls) * 1000, 2),
+        'wall_min_ms': round(min(walls) * 1000, 2),
+        'import_total_ms': round(sum(imports.values()) / 1000.0, 2),
+        'import_package_ms': round(sum(package_imports.values()) / 1000.0, 2),
+        'imports_ms': dict((name, round(value / 1000.0, 2)) for name, value in package_imports.items()),
+    }
+
+
+def measure_interpreter(runs, env):
+    walls = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_output([sys.executable, '-c', 'pass'], env=env)
+        walls.append(time.time() - start)
+
+    return round(median(walls) * 1000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark fetch startup time against local_fs')
+    parser.add_argument('--runs', type=int, default=10, help='Number of timed runs.')
+    parser.add_argument('--output', help='Write JSON results to this file instead of stdout.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='avm-bench-')
+    try:
+        env = dict(os.environ)
+        env['XDG_CACHE_HOME'] = os.path.join(workdir, 'cache')
+        env['XDG_CONFIG_HOME'] = os.path.join(workdir, 'config')
+        env['ANSIBLE_VAULT_MANAGER_AGENT_SOCKET'] = os.path.join(workdir, 'no-agent.sock')
+        vault_id = make_keyring(workdir)
+
+        results = {
+            'python': sys.version.split()[0],
+            'baseline_interpreter_ms': measure_interpreter(args.runs, env),
+            'fetch_no_cache': measure(vault_id, args.runs, env, ['--no-cache']),
+            'fetch_cached': measure(vault_id, args.runs, env),
+        }
+    finally:
+        shutil.rmtree(workdir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
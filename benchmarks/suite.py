@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+'''
+Offline benchmark suite of the main code paths, against local_fs and a fake
+SSM backend with artificial latency and throttling (see fake_ssm).
+
+A synthetic vault path is generated: N vault ids, split between local_fs and
+aws_ssm, spread over a chain of D included metadata files, and M vault
+files encrypted with them. Then it measures metadata load (cold and from
+the snapshot), fetch startup, get-usable-ids end to end (cold, cached and
+lazy), create --manifest and rekey throughput.
+
+Results are JSON, compare them with a previous run with --compare:
+
+    python benchmarks/suite.py --ids 200 --depth 5 --files 50 --output before.json
+    python benchmarks/suite.py --ids 200 --depth 5 --files 50 --compare before.json
+'''
+from __future__ import print_function
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_ssm import FAKE_SSM_ENV
+from startup import median
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+CLIENT_CODE = (
+    'import sys; sys.path.insert(0, ' + repr(BENCHMARKS_DIR) + '); '
+    'import fake_ssm; fake_ssm.install_from_env(); '
+    'from ansible_vault_manager.ansible_vault_manager import main; main()'
+)
+SSM_PROFILE = 'bench'
+SSM_REGION = 'eu-west-1'
+
+
+def client_command(*args):
+    return [sys.executable, '-c', CLIENT_CODE] + list(args)
+
+
+def write_yaml(path, data):
+    import yaml
+    with open(path, 'w') as stream:
+        yaml.safe_dump(data, stream, default_flow_style=False)
+
+
+def make_tree(workdir, ids, ssm_ratio, depth, files):
+    '''
+    Write the synthetic vault path and local_fs keyring. Return (vault_path,
+    vault id labels, local_fs basepath, fake SSM parameters).
+    '''
+    from ansible_vault_manager.vault_format import encrypt_stream
+    import io
+
+    vault_path = os.path.join(workdir, 'vault')
+    shared_path = os.path.join(workdir, 'shared')
+    basepath = os.path.join(workdir, 'keyring')
+    for path in (vault_path, shared_path, basepath):
+        os.makedirs(path)
+
+    entries = []
+    parameters = {}
+    ssm_ids = int(ids * ssm_ratio)
+    for i in range(ids):
+        password = 'password-{0}'.format(i)
+        if i < ssm_ids:
+            name = '/bench/p{0}'.format(i)
+            parameters[name] = [password]
+            entries.append(({'plugin': 'aws_ssm', 'id': ':'.join([SSM_PROFILE, SSM_REGION, name, '1'])}, password))
+        else:
+            with open(os.path.join(basepath, 'k{0}.1'.format(i)), 'w') as stream:
+                stream.write(password)
+            entries.append(({'plugin': 'local_fs', 'id': basepath + ':k{0}:1'.format(i)}, password))
+
+    for i in range(files):
+        entry, password = entries[i % ids]
+        file = os.path.join('group_vars', 'g{0}.yml'.format(i))
+        entry.setdefault('files', []).append(file)
+        path = os.path.join(vault_path, file)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as stream:
+            encrypt_stream(
+                io.BytesIO('secret_{0}: value\n'.format(i).encode('utf-8')),
+                stream,
+                password.encode('utf-8'),
+                entry['plugin'] + '%' + entry['id']
+            )
+
+    # Ids are spread over the vault metadata file and its include chain
+    levels = depth + 1
+    for level in range(levels):
+        level_entries = [entry for index, (entry, password) in enumerate(entries) if index % levels == level]
+        metadata = {'vault_ids': level_entries}
+        if level + 1 < levels:
+            metadata['include'] = [os.path.join(shared_path, 'level_{0}.yml'.format(level + 1))]
+        if level == 0:
+            write_yaml(os.path.join(vault_path, '_metadata.yml'), metadata)
+        else:
+            write_yaml(os.path.join(shared_path, 'level_{0}.yml'.format(level)), metadata)
+
+    labels = [entry['plugin'] + '%' + entry['id'] for entry, password in entries]
+    return vault_path, labels, basepath, parameters
+
+
+def write_ssm_settings(workdir, parameters, latency, rate):
+    settings_file = os.path.join(workdir, 'fake_ssm.json')
+    with open(settings_file, 'w') as stream:
+        json.dump({
+            'parameters': parameters,
+            'clients': [[SSM_PROFILE, SSM_REGION]],
+            'latency': latency,
+            'rate': rate,
+        }, stream)
+
+    return settings_file
+
+
+def timed_runs(function, runs, prepare=None):
+    walls = []
+    result = None
+    for i in range(runs):
+        if prepare is not None:
+            prepare()
+        start = time.time()
+        result = function()
+        walls.append(time.time() - start)
+
+    return {
+        'runs': runs,
+        'wall_median_ms': round(median(walls) * 1000, 2),
+        'wall_min_ms': round(min(walls) * 1000, 2),
+    }, result
+
+
+def run_client(env, *args):
+    '''
+    Return stdout and stderr of a client run, raise RuntimeError when it fails.
+    '''
+    process = subprocess.Popen(
+        client_command(*args),
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    stdout, stderr = process.communicate()
+    if process.returncode:
+        raise RuntimeError(' '.join(args) + ' failed:\n' + stderr)
+
+    return stdout, stderr
+
+
+def failed(error):
+    '''
+    Result of a benchmark whose client run failed, e.g. throttled by the fake
+    SSM: the last line of its error.
+    '''
+    return {'error': str(error).strip().splitlines()[-1]}
+
+
+def bench_metadata(vault_path, runs):
+    from ansible_vault_manager.metadata import load_metadata, get_snapshot_path
+    metadata_file = os.path.join(vault_path, '_metadata.yml')
+
+    def remove_snapshot():
+        if os.path.exists(get_snapshot_path(metadata_file)):
+            os.unlink(get_snapshot_path(metadata_file))
+
+    cold, metadata = timed_runs(lambda: load_metadata(metadata_file), runs, remove_snapshot)
+    cold['ids'] = len(metadata['vault_ids'])
+    snapshot, metadata = timed_runs(lambda: load_metadata(metadata_file), runs)
+
+    return {'metadata_load_cold': cold, 'metadata_load_snapshot': snapshot}
+
+
+def bench_fetch(env, labels, runs):
+    results = {}
+    for plugin in ('local_fs', 'aws_ssm'):
+        plugin_labels = [label for label in labels if label.startswith(plugin + '%')]
+        if plugin_labels:
+            results['fetch_' + plugin], output = timed_runs(
+                lambda: run_client(env, '--no-cache', 'fetch', '--no-agent', '--vault-id', plugin_labels[0]), runs
+            )
+
+    return results
+
+
+def bench_usable_ids(env, vault_path, runs):
+    results = {}
+    for name, args in (
+        ('get_usable_ids_cold', ['--no-cache', 'get-usable-ids']),
+        ('get_usable_ids_lazy', ['--no-cache', 'get-usable-ids', '--lazy']),
+        ('get_usable_ids_cached', ['get-usable-ids']),
+    ):
+        if name == 'get_usable_ids_cached':
+            run_client(env, *(args + ['--vault-path', vault_path]))
+        results[name], output = timed_runs(lambda: run_client(env, *(args + ['--vault-path', vault_path])), runs)
+        results[name]['usable_ids'] = len([identity for identity in output[0].strip().split(',') if identity])
+
+    return results
+
+
+def bench_create(env, workdir, basepath, files):
+    create_path = os.path.join(workdir, 'create')
+    os.makedirs(create_path)
+    manifest = []
+    for i in range(files):
+        if i % 2:
+            entry = {'plugin': 'aws_ssm', 'plugin_params': {'profile': SSM_PROFILE, 'region': SSM_REGION,
+                                                            'path': '/bench/created/'}}
+        else:
+            entry = {'plugin': 'local_fs', 'plugin_params': {'basepath': basepath}}
+        entry['file'] = 'created_{0}.yml'.format(i)
+        manifest.append(entry)
+    manifest_file = os.path.join(workdir, 'manifest.yml')
+    write_yaml(manifest_file, manifest)
+
+    try:
+        result, output = timed_runs(
+            lambda: run_client(env, 'create', '--vault-path', create_path, '--manifest', manifest_file), 1
+        )
+    except RuntimeError as e:
+        return {'create_manifest': failed(e)}
+    result['files'] = files
+    result['files_per_second'] = round(files / (result['wall_median_ms'] / 1000.0), 2)
+    return {'create_manifest': result}
+
+
+def bench_rekey(env, vault_path, basepath):
+    '''
+    Only ids of the vault metadata file are rotated, not those of includes.
+    '''
+    try:
+        result, output = timed_runs(
+            lambda: run_client(
+                env, 'rekey', '--vault-path', vault_path,
+                '--plugin', 'local_fs', '--plugin-param', 'basepath=' + basepath
+            ),
+            1
+        )
+    except RuntimeError as e:
+        return {'rekey': failed(e)}
+    files = int(re.search(r'Rekeyed (\d+) files', output[1]).group(1))
+    result['files'] = files
+    result['files_per_second'] = round(files / (result['wall_median_ms'] / 1000.0), 2)
+    return {'rekey': result}
+
+
+def compare(results, baseline, max_regression):
+    '''
+    Print the median wall time change of each benchmark against baseline,
+    return False when one regressed more than max_regression percent.
+    '''
+    succeeded = True
+    for name, result in sorted(results['benchmarks'].items()):
+        before = baseline.get('benchmarks', {}).get(name)
+        if 'error' in result:
+            print('{0:<28} failed: {1}'.format(name, result['error']), file=sys.stderr)
+            succeeded = False
+            continue
+        if before is None or not before.get('wall_median_ms'):
+            print('{0:<28} {1:>10.2f}ms      (new)'.format(name, result['wall_median_ms']), file=sys.stderr)
+            continue
+        change = (result['wall_median_ms'] - before['wall_median_ms']) * 100.0 / before['wall_median_ms']
+        flag = ''
+        if max_regression is not None and change > max_regression:
+            flag = '  REGRESSION'
+            succeeded = False
+        print('{0:<28} {1:>10.2f}ms {2:>+8.1f}%{3}'.format(name, result['wall_median_ms'], change, flag),
+              file=sys.stderr)
+
+    return succeeded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark suite against local_fs and a fake SSM')
+    parser.add_argument('--ids', type=int, default=200, help='Number of vault ids.')
+    parser.add_argument('--ssm-ratio', type=float, default=0.5, help='Part of the ids stored on the fake SSM.')
+    parser.add_argument('--depth', type=int, default=5, help='Length of the include chain.')
+    parser.add_argument('--files', type=int, default=50, help='Number of vault files.')
+    parser.add_argument('--ssm-latency', type=float, default=20, help='Milliseconds each fake SSM call takes.')
+    parser.add_argument('--ssm-rate', type=float, default=40, help='Calls per second before throttling, 0 for none.')
+    parser.add_argument('--runs', type=int, default=5, help='Number of timed runs.')
+    parser.add_argument('--skip-writes', action='store_true', help='Do not run the create and rekey benchmarks.')
+    parser.add_argument('--output', help='Write JSON results to this file instead of stdout.')
+    parser.add_argument('--compare', metavar='FILE', help='Print changes against the JSON results of a previous run.')
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help='With --compare, exit 1 when a median is slower by more than this percentage.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='avm-bench-')
+    try:
+        # Cache and config dirs of this process and of clients are isolated
+        os.environ['XDG_CACHE_HOME'] = os.path.join(workdir, 'cache')
+        os.environ['XDG_CONFIG_HOME'] = os.path.join(workdir, 'config')
+        os.environ['ANSIBLE_VAULT_MANAGER_AGENT_SOCKET'] = os.path.join(workdir, 'no-agent.sock')
+        vault_path, labels, basepath, parameters = make_tree(
+            workdir, args.ids, args.ssm_ratio, args.depth, args.files
+        )
+        env = dict(os.environ)
+        env[FAKE_SSM_ENV] = write_ssm_settings(workdir, parameters, args.ssm_latency / 1000.0, args.ssm_rate)
+
+        benchmarks = {}
+        benchmarks.update(bench_metadata(vault_path, args.runs))
+        benchmarks.update(bench_fetch(env, labels, args.runs))
+        benchmarks.update(bench_usable_ids(env, vault_path, args.runs))
+        if not args.skip_writes:
+            benchmarks.update(bench_create(env, workdir, basepath, args.files))
+            benchmarks.update(bench_rekey(env, vault_path, basepath))
+    finally:
+        shutil.rmtree(workdir)
+
+    results = {
+        'python': sys.version.split()[0],
+        'parameters': {
+            'ids': args.ids,
+            'ssm_ratio': args.ssm_ratio,
+            'depth': args.depth,
+            'files': args.files,
+            'ssm_latency_ms': args.ssm_latency,
+            'ssm_rate': args.ssm_rate,
+        },
+        'benchmarks': benchmarks,
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, 'r') as stream:
+            baseline = json.load(stream)
+        if baseline.get('parameters') != results['parameters']:
+            print('Warning: baseline was run with other parameters', file=sys.stderr)
+        if not compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
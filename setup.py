@@ -16,8 +16,12 @@ setup(
     packages=find_packages(),
     install_requires=[
        "future",
+       "futures; python_version < '3'",
        "PyYAML",
     ],
+    extras_require={
+        'cache': ['cryptography'],
+    },
     long_description=long_description,
     entry_points={
         'console_scripts': [
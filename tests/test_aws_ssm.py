@@ -0,0 +1,59 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import time
+
+import pytest
+
+pytest.importorskip('boto3')
+
+from ansible_vault_manager.keyring_plugins import KeyringThrottlingException  # noqa: E402
+from ansible_vault_manager.keyring_plugins.aws_ssm import RateLimiter  # noqa: E402
+
+
+def test_rate_below_one_call_per_second():
+    limiter = RateLimiter(0.5)
+    start = time.time()
+
+    # A call is allowed right away, the next one two seconds later
+    limiter.acquire(deadline=start + 0.1)
+    with pytest.raises(KeyringThrottlingException):
+        limiter.acquire(deadline=time.time() + 0.5)
+    assert time.time() - start < 0.5
+
+    limiter.updated -= 2
+    limiter.acquire(deadline=time.time() + 0.1)
+
+
+def test_rate_below_one_call_per_second_burst():
+    limiter = RateLimiter(0.5)
+    limiter.acquire()
+    limiter.updated -= 60
+
+    # Idle time does not allow more than one call at once
+    limiter.acquire(deadline=time.time() + 0.1)
+    with pytest.raises(KeyringThrottlingException):
+        limiter.acquire(deadline=time.time() + 0.1)
+
+
+def test_acquire_waits_for_a_token():
+    limiter = RateLimiter(20)
+    limiter.tokens = 0.0
+    start = time.time()
+
+    limiter.acquire(deadline=start + 1)
+
+    assert 0.02 <= time.time() - start < 0.5
+
+
+def test_throttled_halves_rate_down_to_minimum():
+    limiter = RateLimiter(8)
+    limiter.throttled()
+    assert limiter.rate == pytest.approx(4, abs=0.1)
+    # Throttles of the same burst count once
+    limiter.throttled()
+    assert limiter.rate == pytest.approx(4, abs=0.1)
+
+    limiter = RateLimiter(0.5)
+    limiter.throttled()
+    assert limiter.rate == 0.5
+    limiter.updated -= 2
+    limiter.acquire(deadline=time.time() + 0.1)
@@ -0,0 +1,125 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os
+import stat
+
+import pytest
+
+from ansible_vault_manager.keyring_plugins import (
+    KeyringException, KeyringNotFoundException, KeyringAccessDeniedException
+)
+from ansible_vault_manager.keyring_plugins.local_fs import (
+    KeyringPlugin, KEYSTORE_HEADER, append_keystore, get_keystore_path, migrate_keystore, read_keystore
+)
+
+
+def test_keystore_round_trip(tmpdir):
+    basepath = str(tmpdir)
+    append_keystore(basepath, [('first', 1, 'one'), ('second', 1, 'two')])
+    append_keystore(basepath, [('first', 2, 'one again')])
+
+    assert read_keystore(basepath) == {('first', 1): 'one', ('second', 1): 'two', ('first', 2): 'one again'}
+    assert stat.S_IMODE(os.stat(get_keystore_path(basepath)).st_mode) == 0o600
+
+    plugin = KeyringPlugin()
+    assert plugin.fetch(basepath + ':first:2') == 'one again'
+    assert plugin.fetch_many([basepath + ':first', basepath + ':second:1']) == {
+        basepath + ':first': 'one',
+        basepath + ':second:1': 'two',
+    }
+
+
+def test_keystore_set_password(tmpdir):
+    basepath = str(tmpdir)
+    append_keystore(basepath, [])
+    plugin = KeyringPlugin()
+
+    assert plugin.set_password(basepath + ':name', 'one') == 1
+    assert plugin.set_password(basepath + ':name:1', 'two') == 2
+    assert plugin.fetch(basepath + ':name:2') == 'two'
+    # Keystore ids are not written as password files
+    assert sorted(os.listdir(basepath)) == [os.path.basename(get_keystore_path(basepath))]
+    with pytest.raises(KeyringException):
+        plugin.set_password(basepath + ':name', 'three')
+
+
+def test_keystore_tombstones(tmpdir):
+    basepath = str(tmpdir)
+    append_keystore(basepath, [('name', 1, 'one'), ('name', 2, 'two')])
+    plugin = KeyringPlugin()
+
+    plugin.delete_password(basepath + ':name:2')
+
+    assert read_keystore(basepath)[('name', 2)] is None
+    with pytest.raises(KeyringNotFoundException):
+        plugin.fetch(basepath + ':name:2')
+    assert plugin.fetch(basepath + ':name:1') == 'one'
+    results = plugin.probe([basepath + ':name:1', basepath + ':name:2'])
+    assert results[basepath + ':name:1'] is True
+    assert isinstance(results[basepath + ':name:2'], KeyringNotFoundException)
+    # A removed version can be stored again
+    append_keystore(basepath, [('name', 2, 'again')])
+    assert plugin.fetch(basepath + ':name:2') == 'again'
+
+
+def test_keystore_truncated_trailing_write(tmpdir):
+    basepath = str(tmpdir)
+    path = get_keystore_path(basepath)
+    append_keystore(basepath, [('name', 1, 'one')])
+    committed_size = os.path.getsize(path)
+
+    # Records written but interrupted before the header update
+    with open(path, 'ab') as stream:
+        stream.write(b'\x00\x00\x00\x02\x00\x04na')
+
+    assert read_keystore(basepath) == {('name', 1): 'one'}
+
+    append_keystore(basepath, [('name', 2, 'two')])
+
+    assert read_keystore(basepath) == {('name', 1): 'one', ('name', 2): 'two'}
+    with open(path, 'rb') as stream:
+        content = stream.read()
+    assert KEYSTORE_HEADER.unpack_from(content, 0)[1:] == (len(content), 2)
+    assert len(content) > committed_size
+
+
+def test_keystore_corrupted_header(tmpdir):
+    basepath = str(tmpdir)
+    tmpdir.join(os.path.basename(get_keystore_path(basepath))).write_binary(b'AVMKS\x00\x00\x01\x00')
+
+    with pytest.raises(KeyringException):
+        read_keystore(basepath)
+
+
+def test_migrate_keystore(tmpdir):
+    basepath = str(tmpdir)
+    tmpdir.join('first.1').write('one')
+    tmpdir.join('first.2').write('two')
+    tmpdir.join('second.1').write('other')
+    tmpdir.join('notes.txt').write('not a password')
+    tmpdir.join('first.1').chmod(0o640)
+    tmpdir.join('first.2').chmod(0o644)
+    tmpdir.join('second.1').chmod(0o660)
+
+    count, skipped = migrate_keystore(basepath)
+
+    assert (count, skipped) == (3, {})
+    assert read_keystore(basepath) == {('first', 1): 'one', ('first', 2): 'two', ('second', 1): 'other'}
+    # Most restrictive mode of the copied files
+    assert stat.S_IMODE(os.stat(get_keystore_path(basepath)).st_mode) == 0o640
+    # Already copied files are not copied again
+    assert migrate_keystore(basepath) == (0, {})
+
+
+@pytest.mark.skipif(os.geteuid() == 0, reason='permissions are not enforced for root')
+def test_migrate_keystore_skips_unreadable_files(tmpdir):
+    basepath = str(tmpdir)
+    tmpdir.join('first.1').write('one')
+    tmpdir.join('second.1').write('two')
+    tmpdir.join('second.1').chmod(0o000)
+
+    count, skipped = migrate_keystore(basepath)
+
+    assert count == 1
+    assert list(skipped) == [str(tmpdir.join('second.1'))]
+    assert isinstance(skipped[str(tmpdir.join('second.1'))], KeyringAccessDeniedException)
+    assert read_keystore(basepath) == {('first', 1): 'one'}
@@ -0,0 +1,84 @@
+from __future__ import print_function, absolute_import, unicode_literals
+from concurrent.futures import ProcessPoolExecutor
+
+from ansible_vault_manager.metadata import METADATA_FILE, FileIndex, MetadataTransaction, load_metadata_file
+
+WORKERS = 4
+APPENDS = 10
+
+METADATA = '''# Managed by ansible-vault-manager
+vault_ids:
+  # Shared vars
+  - plugin: local_fs
+    id: /mnt/secrets:initial
+    files:
+      - group_vars/all/vault.yml
+'''
+
+
+def append_entries(metadata_file, worker):
+    for i in range(APPENDS):
+        with MetadataTransaction(metadata_file) as transaction:
+            transaction.append_ids([{
+                'plugin': 'local_fs',
+                'id': '/mnt/secrets:{0}-{1}'.format(worker, i),
+                'files': ['host_vars/{0}-{1}.yml'.format(worker, i)],
+            }])
+
+
+def test_append_keeps_layout(tmpdir):
+    metadata_file = tmpdir.join(METADATA_FILE)
+    metadata_file.write(METADATA)
+
+    with MetadataTransaction(str(metadata_file)) as transaction:
+        transaction.append_ids([{'plugin': 'local_fs', 'id': '/mnt/secrets:new', 'files': ['new.yml']}])
+
+    content = metadata_file.read()
+    assert content.startswith(METADATA)
+    assert [entry['id'] for entry in load_metadata_file(str(metadata_file))['vault_ids']] == [
+        '/mnt/secrets:initial', '/mnt/secrets:new'
+    ]
+
+
+def test_failed_transaction_leaves_file(tmpdir):
+    metadata_file = tmpdir.join(METADATA_FILE)
+    metadata_file.write(METADATA)
+
+    try:
+        with MetadataTransaction(str(metadata_file)) as transaction:
+            transaction.append_ids([{'plugin': 'local_fs', 'id': '/mnt/secrets:new', 'files': ['new.yml']}])
+            raise ValueError('interrupted')
+    except ValueError:
+        pass
+
+    assert metadata_file.read() == METADATA
+
+
+def test_concurrent_appends(tmpdir):
+    metadata_file = tmpdir.join(METADATA_FILE)
+    metadata_file.write(METADATA)
+
+    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+        futures = [executor.submit(append_entries, str(metadata_file), worker) for worker in range(WORKERS)]
+        for future in futures:
+            future.result()
+
+    ids = [entry['id'] for entry in load_metadata_file(str(metadata_file))['vault_ids']]
+    expected = ['/mnt/secrets:{0}-{1}'.format(worker, i) for worker in range(WORKERS) for i in range(APPENDS)]
+    assert ids[0] == '/mnt/secrets:initial'
+    assert sorted(ids[1:]) == sorted(expected)
+    assert metadata_file.read().startswith(METADATA)
+
+
+def test_file_index_match_groups():
+    index = FileIndex([
+        {'plugin': 'local_fs', 'id': '/mnt/secrets:web', 'files': ['group_vars/web/vault.yml']},
+        {'plugin': 'local_fs', 'id': '/mnt/secrets:db', 'files': ['group_vars/db.yml']},
+        {'plugin': 'local_fs', 'id': '/mnt/secrets:host', 'files': ['host_vars/web01/vault.yml']},
+    ])
+
+    assert index.match_files(groups=['web']) == ['group_vars/web/vault.yml']
+    assert index.match_files(groups=['db']) == ['group_vars/db.yml']
+    assert index.match_files(groups=['web*']) == ['group_vars/web/vault.yml', 'host_vars/web01/vault.yml']
+    assert index.match_files(patterns=['group_vars/*']) == ['group_vars/web/vault.yml', 'group_vars/db.yml']
+    assert [id['id'] for id in index.filter(groups=['db'])] == ['/mnt/secrets:db']
@@ -0,0 +1,95 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('cryptography')
+pytest.importorskip('ansible')
+
+from ansible.parsing.vault import VaultLib, VaultSecret  # noqa: E402
+
+from ansible_vault_manager.ansible_vault_manager import VaultManager, parse_commandline, PLUGIN_SEPARATOR  # noqa: E402
+from ansible_vault_manager.metadata import METADATA_FILE, dump_metadata, load_metadata_file  # noqa: E402
+from ansible_vault_manager.vault_format import encrypt_file  # noqa: E402
+
+# local_fs storing nothing in "broken" basepaths
+PLUGIN = '''
+from ansible_vault_manager.keyring_plugins import KeyringException
+from ansible_vault_manager.keyring_plugins.local_fs import KeyringPlugin as LocalFsPlugin
+
+
+class KeyringPlugin(LocalFsPlugin):
+    def set_password(self, id, password):
+        if self.parse_vault_id(id)[0].endswith('broken'):
+            raise KeyringException('Store unavailable: ' + id)
+        return super(KeyringPlugin, self).set_password(id, password)
+'''
+PLUGIN_NAME = 'rekey_test_fs'
+
+
+@pytest.fixture
+def vault(tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmpdir.join('config')))
+    tmpdir.mkdir('plugins').join(PLUGIN_NAME + '.py').write(PLUGIN)
+    vault_path = tmpdir.mkdir('vault')
+    vault_ids = []
+    for name, basepath in [('first', tmpdir.mkdir('ok')), ('second', tmpdir.mkdir('broken'))]:
+        basepath.join(name + '.1').write('password of ' + name)
+        id = str(basepath) + ':' + name + ':1'
+        source = tmpdir.join(name + '.yml')
+        source.write(name + ': secret\n')
+        encrypt_file(
+            str(source), str(vault_path.join(name + '.yml')),
+            b'password of ' + name.encode('utf-8'), PLUGIN_NAME + PLUGIN_SEPARATOR + id
+        )
+        vault_ids.append({'plugin': PLUGIN_NAME, 'id': id, 'files': [name + '.yml']})
+    vault_path.join(METADATA_FILE).write(dump_metadata({'vault_ids': vault_ids}))
+
+    return tmpdir
+
+
+def run_rekey(monkeypatch, tmpdir, *args):
+    monkeypatch.setattr(sys, 'argv', [
+        'ansible-vault-manager-client', '--no-cache', '--plugin-path', str(tmpdir.join('plugins')),
+        'rekey', '--vault-path', str(tmpdir.join('vault')), '--processes', '1'
+    ] + list(args))
+    parser, args = parse_commandline()
+    VaultManager(args)
+
+
+def snapshot(path):
+    return dict((name, path.join(name).read_binary()) for name in os.listdir(str(path)))
+
+
+def test_rekey(vault, monkeypatch):
+    run_rekey(monkeypatch, vault, 'first.yml')
+
+    vault_ids = load_metadata_file(str(vault.join('vault', METADATA_FILE)))['vault_ids']
+    assert [entry['files'] for entry in vault_ids] == [['first.yml'], ['second.yml']]
+    new_id = vault_ids[0]['id']
+    basepath, name, version = new_id.split(':')
+    # Stored next to the current id, old password kept
+    assert (basepath, version) == (str(vault.join('ok')), '1')
+    assert sorted(os.listdir(basepath)) == sorted(['first.1', name + '.1'])
+    password = vault.join('ok', name + '.1').read_binary()
+    label = PLUGIN_NAME + PLUGIN_SEPARATOR + new_id
+    ciphertext = vault.join('vault', 'first.yml').read_binary()
+    assert VaultLib([(label, VaultSecret(password))]).decrypt(ciphertext) == b'first: secret\n'
+    assert ciphertext.splitlines()[0].decode('utf-8').endswith(label)
+    assert sorted(os.listdir(str(vault.join('vault')))) == sorted([METADATA_FILE, 'first.yml', 'second.yml'])
+
+
+def test_rekey_rollback_on_failed_store(vault, monkeypatch):
+    vault_files = snapshot(vault.join('vault'))
+    passwords = snapshot(vault.join('ok'))
+
+    with pytest.raises(SystemExit) as e:
+        run_rekey(monkeypatch, vault)
+
+    assert e.value.code == 2
+    # The password stored before the failure is removed, files and
+    # metadata are left unchanged
+    assert snapshot(vault.join('ok')) == passwords
+    assert snapshot(vault.join('vault')) == vault_files
@@ -0,0 +1,95 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import hashlib
+import io
+import os
+
+import pytest
+
+pytest.importorskip('cryptography')
+pytest.importorskip('ansible')
+
+from ansible.parsing.vault import VaultLib, VaultSecret  # noqa: E402
+
+from ansible_vault_manager.vault_format import (  # noqa: E402
+    decrypt_stream, encrypt_stream, encrypt_file, read_vault_header
+)
+
+PASSWORD = b'correct horse battery staple'
+LABEL = 'local_fs/tmp/secrets:6f1c'
+CONTENTS = [
+    b'',
+    b'a',
+    b'0123456789abcde',
+    b'0123456789abcdef',
+    b'0123456789abcdef0',
+    b'key: value\n' * 1000,
+    os.urandom(5000),
+]
+
+
+def get_vault_lib():
+    return VaultLib([(LABEL, VaultSecret(PASSWORD))])
+
+
+@pytest.mark.parametrize('content', CONTENTS)
+@pytest.mark.parametrize('chunk_size', [64, 1024 * 1024])
+def test_encrypt_stream_decrypts_with_vaultlib(content, chunk_size):
+    target = io.BytesIO()
+    digest = encrypt_stream(io.BytesIO(content), target, PASSWORD, LABEL, chunk_size)
+
+    assert get_vault_lib().decrypt(target.getvalue()) == content
+    assert digest == hashlib.sha256(content).digest()
+
+
+@pytest.mark.parametrize('content', CONTENTS)
+def test_encrypt_stream_matches_vaultlib_layout(content):
+    target = io.BytesIO()
+    encrypt_stream(io.BytesIO(content), target, PASSWORD, LABEL, 64)
+    expected = get_vault_lib().encrypt(content, VaultSecret(PASSWORD), vault_id=LABEL)
+
+    # Salt and ciphertext differ, sizes and line wrapping must not
+    lines = target.getvalue().splitlines(True)
+    expected_lines = expected.splitlines(True)
+    assert lines[0] == expected_lines[0]
+    assert [len(line) for line in lines] == [len(line) for line in expected_lines]
+    assert len(target.getvalue()) == len(expected)
+
+
+def test_encrypt_file(tmpdir):
+    source = tmpdir.join('vars.yml')
+    source.write_binary(b'secret: 42\n')
+    target = tmpdir.join('vars.yml.vault')
+
+    digest = encrypt_file(str(source), str(target), PASSWORD, LABEL)
+
+    assert digest == hashlib.sha256(b'secret: 42\n').digest()
+    assert get_vault_lib().decrypt(target.read_binary()) == b'secret: 42\n'
+    assert read_vault_header(str(target)) == ('1.2', 'AES256', LABEL)
+    assert read_vault_header(str(source)) is None
+
+
+@pytest.mark.parametrize('content', CONTENTS)
+@pytest.mark.parametrize('chunk_size', [64, 1024 * 1024])
+def test_decrypt_stream_reads_vaultlib_output(content, chunk_size):
+    vaulttext = get_vault_lib().encrypt(content, VaultSecret(PASSWORD), vault_id=LABEL)
+    source = io.BytesIO(vaulttext)
+    source.readline()
+
+    assert b''.join(decrypt_stream(source, PASSWORD, chunk_size)) == content
+
+
+def test_decrypt_stream_checks_hmac():
+    target = io.BytesIO()
+    encrypt_stream(io.BytesIO(b'key: value\n' * 100), target, PASSWORD, LABEL, 64)
+    lines = target.getvalue().splitlines(True)
+    # Flip a ciphertext byte, keeping the hex valid
+    lines[-2] = lines[-2][:11] + (b'1' if lines[-2][11:12] != b'1' else b'2') + lines[-2][12:]
+    source = io.BytesIO(b''.join(lines))
+    source.readline()
+
+    with pytest.raises(ValueError):
+        b''.join(decrypt_stream(source, PASSWORD, 64))
+    source.seek(0)
+    source.readline()
+    with pytest.raises(ValueError):
+        b''.join(decrypt_stream(source, b'wrong password', 64))
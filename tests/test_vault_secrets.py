@@ -0,0 +1,41 @@
+from __future__ import print_function, absolute_import, unicode_literals
+
+import pytest
+
+pytest.importorskip('ansible')
+
+import yaml  # noqa: E402
+
+from ansible_vault_manager.metadata import METADATA_FILE, MetadataException, dump_metadata  # noqa: E402
+from ansible_vault_manager.vault_secrets import load_vault_lib, load_vault_secrets  # noqa: E402
+
+
+@pytest.fixture
+def vault_path(tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmpdir.join('config')))
+    return tmpdir.mkdir('vault')
+
+
+def test_load_vault_secrets(vault_path, tmpdir):
+    tmpdir.mkdir('secrets').join('name.1').write('password')
+    vault_path.join(METADATA_FILE).write(dump_metadata({'vault_ids': [
+        {'plugin': 'local_fs', 'id': str(tmpdir.join('secrets')) + ':name:1'},
+        {'plugin': 'local_fs', 'id': str(tmpdir.join('secrets')) + ':missing:1'},
+    ]}))
+
+    secrets = load_vault_secrets(str(vault_path), no_cache=True)
+
+    assert [label for label, secret in secrets] == ['local_fs%' + str(tmpdir.join('secrets')) + ':name:1']
+    assert secrets[0][1].bytes == b'password'
+    assert load_vault_lib(str(vault_path), no_cache=True).secrets[0][0] == secrets[0][0]
+
+
+def test_invalid_metadata_raises(vault_path):
+    vault_path.join(METADATA_FILE).write('vault_ids: [\n')
+    with pytest.raises(yaml.YAMLError):
+        load_vault_secrets(str(vault_path), no_cache=True)
+
+    vault_path.join(METADATA_FILE).write(dump_metadata({'include': [METADATA_FILE]}))
+    with pytest.raises(MetadataException):
+        load_vault_secrets(str(vault_path), no_cache=True)